@@ -1,21 +1,36 @@
 __author__ = 'Senén'
 __students__ = 'Senén'
 
-import yaml, time, pymongo, json
-from typing import Generator, Any, Self
-from random import randint
+import yaml, time, pymongo, json, asyncio, copy, hashlib, sqlite3, threading, unicodedata, os, re, csv, mmap, struct, bisect, difflib, weakref, base64, queue, multiprocessing, inspect
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from typing import Callable, Generator, Any, Self
+from random import randint, random
+from contextlib import contextmanager
+from abc import ABC, abstractmethod
+from contextvars import ContextVar
+from collections import OrderedDict
+from datetime import datetime
+from itertools import count
 
 from geopy.geocoders import Nominatim
 from geopy.exc import GeocoderTimedOut
 from geojson import Point
 from bson.objectid import ObjectId
+from bson.raw_bson import RawBSONDocument
+from bson.codec_options import CodecOptions
+import bson
 
 from pymongo.collection import Collection
 from pymongo.command_cursor import CommandCursor
 from pymongo.cursor import Cursor
-from pymongo import MongoClient
+from pymongo import MongoClient, AsyncMongoClient
+from pymongo.asynchronous.collection import AsyncCollection
+from pymongo.asynchronous.command_cursor import AsyncCommandCursor
+from pymongo.asynchronous.cursor import AsyncCursor
 from pymongo.server_api import ServerApi
-from pymongo.errors import DuplicateKeyError
+from pymongo.client_session import ClientSession
+from pymongo.errors import DuplicateKeyError, BulkWriteError, OperationFailure
+from pymongo import InsertOne, UpdateOne, ReplaceOne, DeleteOne, IndexModel
 
 
 # pretty print 
@@ -23,158 +38,3124 @@ def format(data):
     return json.dumps(data, indent=4, default=str)
 
 
+# print every document written by save(), set it to False on hot paths
+verbose = True
+
+
+class Profiler:
+    """
+    Collects the latency of the ODM operations (find, aggregate, insert,
+    update, delete, bulk_write and geocode) per model, with the number of
+    documents and BSON bytes involved. Install it with ODM.profiler = Profiler().
+
+    Attributes
+    ----------
+    explain_sample_rate : float
+        Fraction of find/aggregate calls that are also explained to record
+        whether they used an index (IXSCAN) or a collection scan (COLLSCAN)
+    hooks : list[Callable[[dict], None]]
+        Called with every recorded event
+    events : list[dict]
+        Last recorded events, up to max_events
+    """
+    def __init__(self, explain_sample_rate: float = 0.0, hooks: list | None = None, max_events: int = 10_000):
+        self.explain_sample_rate = explain_sample_rate
+        self.hooks = list(hooks or [])
+        self.max_events = max_events
+        self.events: list[dict] = []
+        self._stats: dict[tuple[str, str], dict[str, Any]] = {}
+        self._lock = threading.Lock()
+
+    def record(self, model: str, operation: str, seconds: float, documents: int = 0, nbytes: int = 0, plan: str | None = None) -> None:
+        event = {'model': model, 'operation': operation, 'seconds': seconds, 'documents': documents, 'bytes': nbytes, 'plan': plan}
+        with self._lock:
+            stats = self._stats.setdefault((model, operation), {'count': 0, 'seconds': 0.0, 'max_seconds': 0.0, 'documents': 0, 'bytes': 0, 'plans': {}})
+            stats['count'] += 1
+            stats['seconds'] += seconds
+            stats['max_seconds'] = max(stats['max_seconds'], seconds)
+            stats['documents'] += documents
+            stats['bytes'] += nbytes
+            if plan:
+                stats['plans'][plan] = stats['plans'].get(plan, 0) + 1
+            self.events.append(event)
+            del self.events[:-self.max_events]
+        for hook in self.hooks:
+            hook(event)
+
+    def sample_explain(self) -> bool:
+        return self.explain_sample_rate > 0 and random() < self.explain_sample_rate
+
+    def summary(self) -> dict[str, dict[str, dict[str, Any]]]:
+        """
+        Returns {model: {operation: stats}}, stats having count, total,
+        average and max seconds, documents, bytes and the explained plans.
+        """
+        summary = {}
+        with self._lock:
+            for (model, operation), stats in self._stats.items():
+                summary.setdefault(model, {})[operation] = {**stats, 'plans': dict(stats['plans']), 'avg_seconds': stats['seconds'] / stats['count']}
+        return summary
+
+    def report(self) -> str:
+        lines = [f'{"model":<20} {"operation":<12} {"count":>7} {"avg ms":>9} {"max ms":>9} {"docs":>9} {"bytes":>11}  plans']
+        for model, operations in sorted(self.summary().items()):
+            for operation, stats in sorted(operations.items()):
+                plans = ', '.join(f'{plan}: {n}' for plan, n in stats['plans'].items())
+                lines.append(f'{model:<20} {operation:<12} {stats["count"]:>7} {stats["avg_seconds"] * 1e3:>9.2f} '
+                             f'{stats["max_seconds"] * 1e3:>9.2f} {stats["documents"]:>9} {stats["bytes"]:>11}  {plans}')
+        return '\n'.join(lines)
+
+    def reset(self) -> None:
+        with self._lock:
+            self._stats.clear()
+            self.events.clear()
+
+
+# set to a Profiler to instrument every model, None costs nothing
+profiler: Profiler | None = None
+
+
+@contextmanager
+def _profiled(model: str, operation: str) -> Generator:
+    """
+    Times the body and records it in the profiler, if there is one. The
+    body can fill the yielded dict with 'documents', 'nbytes' and 'plan'.
+    """
+    if profiler is None:
+        yield {}
+        return
+    details = {}
+    start = time.perf_counter()
+    try: yield details
+    finally: profiler.record(model, operation, time.perf_counter() - start, **details)
+
+
+def _plan(explain: dict) -> str:
+    """
+    Summarises an explain() output as COLLSCAN if any stage scans the
+    whole collection, IXSCAN if any uses an index, or the first stage found.
+    """
+    stages = set()
+    def walk(value):
+        if isinstance(value, dict):
+            if isinstance(value.get('stage'), str):
+                stages.add(value['stage'])
+            for item in value.values(): walk(item)
+        elif isinstance(value, list):
+            for item in value: walk(item)
+    walk(explain)
+    if 'COLLSCAN' in stages: return 'COLLSCAN'
+    if stages & {'IXSCAN', 'GEO_NEAR_2DSPHERE', 'TEXT_MATCH', 'IDHACK', 'EXPRESS_IXSCAN', 'EXPRESS_IDHACK'}: return 'IXSCAN'
+    return min(stages) if stages else 'UNKNOWN'
+
+
+def _docs_examined(explain: dict) -> int:
+    """
+    Adds up every totalDocsExamined of an executionStats explain, which
+    includes the documents read by $lookup stages.
+    """
+    if isinstance(explain, dict):
+        return sum(value if key == 'totalDocsExamined' and isinstance(value, int) else _docs_examined(value) for key, value in explain.items())
+    if isinstance(explain, list):
+        return sum(_docs_examined(item) for item in explain)
+    return 0
+
+
+# sentinel for "no entry", since None is a valid (negative) cached value
+_MISSING = object()
+
+
+class LRUCache:
+    """
+    Thread-safe bounded mapping that evicts the least recently used entry
+    and, optionally, entries older than a time-to-live.
+
+    Attributes
+    ----------
+    maxsize : int
+        Maximum number of entries kept in memory
+    ttl : float | None
+        Seconds an entry stays valid, None for no expiry
+    hits, misses, evictions : int
+        Usage counters
+    """
+    def __init__(self, maxsize: int = 1024, ttl: float | None = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = self.misses = self.evictions = 0
+        self._entries: OrderedDict[Any, tuple[float | None, Any]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Any, default: Any = _MISSING) -> Any:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires, value = entry
+                if expires is None or expires > time.monotonic():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+            self.misses += 1
+            return default
+
+    def put(self, key: Any, value: Any, ttl: float | None = _MISSING) -> None:
+        ttl = self.ttl if ttl is _MISSING else ttl
+        with self._lock:
+            self._entries[key] = (None if ttl is None else time.monotonic() + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def pop(self, key: Any) -> None:
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def stats(self) -> dict[str, int]:
+        return {'size': len(self._entries), 'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+
+class GeocodeCache:
+    """
+    Two layer cache of geocoding results: an in-process LRU in front of a
+    SQLite file that is shared by every process using the same path.
+    Addresses that could not be resolved are cached too (negative results),
+    with their own, shorter, time-to-live.
+
+    Attributes
+    ----------
+    path : str | None
+        SQLite file for the persistent layer, None to keep it in memory only
+    hits, disk_hits, misses : int
+        Lookups served from memory, from disk and not found at all
+    """
+    def __init__(self, path: str | None = './.geocode_cache.sqlite', maxsize: int = 4096,
+                 ttl: float = 30 * 24 * 3600, negative_ttl: float = 24 * 3600):
+        self.path = path
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.hits = self.disk_hits = self.misses = 0
+        self._memory = LRUCache(maxsize)
+        self._conn: sqlite3.Connection | None = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def normalize(address: str) -> str:
+        return ' '.join(unicodedata.normalize('NFKC', address).casefold().split())
+
+    def _connection(self) -> sqlite3.Connection:
+        # opened lazily so that importing the module does not touch the disk
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False, isolation_level=None)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('CREATE TABLE IF NOT EXISTS geocode (address TEXT PRIMARY KEY, lon REAL, lat REAL, expires REAL)')
+        return self._conn
+
+    def get(self, address: str) -> tuple[float, float] | None:
+        """
+        Returns the cached (longitude, latitude) of an address, None if the
+        address is known not to exist, or _MISSING if it has not been seen.
+        """
+        key = self.normalize(address)
+        value = self._memory.get(key)
+        if value is not _MISSING:
+            self.hits += 1
+            return value
+        if self.path is not None:
+            with self._lock:
+                row = self._connection().execute('SELECT lon, lat, expires FROM geocode WHERE address = ?', (key,)).fetchone()
+            if row and row[2] > time.time():
+                value = None if row[0] is None else (row[0], row[1])
+                self._memory.put(key, value, row[2] - time.time())
+                self.disk_hits += 1
+                return value
+        self.misses += 1
+        return _MISSING
+
+    def put(self, address: str, coordinates: tuple[float, float] | None) -> None:
+        key = self.normalize(address)
+        ttl = self.negative_ttl if coordinates is None else self.ttl
+        self._memory.put(key, coordinates, ttl)
+        if self.path is not None:
+            lon, lat = coordinates if coordinates is not None else (None, None)
+            with self._lock:
+                self._connection().execute('INSERT OR REPLACE INTO geocode VALUES (?, ?, ?, ?)', (key, lon, lat, time.time() + ttl))
+
+    def clear(self) -> None:
+        self._memory.clear()
+        if self.path is not None:
+            with self._lock:
+                self._connection().execute('DELETE FROM geocode')
+
+    def stats(self) -> dict[str, int]:
+        return {'hits': self.hits, 'disk_hits': self.disk_hits, 'misses': self.misses, 'memory_size': len(self._memory)}
+
+
+# shared by every model, replace it to change the file or the expiry times
+geocode_cache = GeocodeCache()
+
+
+class RateLimiter:
+    """
+    Spaces out calls so that at most 'rate' of them start per second,
+    across every thread sharing the limiter.
+    """
+    def __init__(self, rate: float):
+        self.interval = 1 / rate
+        self._next = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self) -> None:
+        with self._lock:
+            now = time.monotonic()
+            delay = self._next - now
+            self._next = max(now, self._next) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+# Nominatim allows a single request per second per client
+nominatim_rate_limiter = RateLimiter(1.0)
+
+
+class Geocoder(ABC):
+    """
+    Interface of the geocoding backends used by getLocationPoint. Backends
+    must implement geocode, otherwise they can't be instantiated.
+
+    Attributes
+    ----------
+    cacheable : bool
+        Whether results should go through the geocode_cache. Local backends
+        are faster than the cache itself and turn it off.
+
+    Methods
+    -------
+    geocode(address) -> tuple[float, float] | None
+        Returns the (longitude, latitude) of the address or None if it does
+        not exist. Transient failures raise GeocoderTimedOut.
+    """
+    cacheable = True
+
+    @abstractmethod
+    def geocode(self, address: str) -> tuple[float, float] | None:
+        ...
+
+
+class NominatimGeocoder(Geocoder):
+    """
+    Geocoder backed by the public Nominatim service, throttled to one request
+    per second as its usage policy requires. The limiter is shared, so
+    concurrent geocoding (see Model.save_many) never exceeds that rate.
+    """
+    def __init__(self, retries: int = 5, rate_limiter: RateLimiter = nominatim_rate_limiter):
+        self.retries = retries
+        self.rate_limiter = rate_limiter
+
+    def geocode(self, address: str) -> tuple[float, float] | None:
+        not_found = False
+        for _ in range(self.retries):
+            try:
+                self.rate_limiter.wait()
+                # Use a random name for the user_agent
+                location = Nominatim(user_agent=f'random-name-{randint(0, 1000)}').geocode(address)
+                if location:
+                    return (location.longitude, location.latitude)
+                not_found = True
+            except GeocoderTimedOut:
+                continue
+        if not_found:
+            return None
+        raise GeocoderTimedOut(f'Nominatim timed out for {address!r}')
+
+
+class GazetteerGeocoder(Geocoder):
+    """
+    Offline geocoder that resolves addresses against a local gazetteer.
+
+    The gazetteer is a CSV file with 'name,lon,lat' rows, where name is a
+    postcode, street or city. It is compiled once into a sorted binary index
+    next to it ('<path>.idx') which is memory-mapped, so opening it is cheap
+    and the operating system shares its pages between processes.
+
+    An address is looked up, in order, by its full text, its postcode, each
+    of its comma separated parts, the first name starting with its first
+    part and finally by the closest names around each part (fuzzy match).
+    """
+    cacheable = False
+    _MAGIC = b'GZX1'
+    _POSTCODE = re.compile(r'\b\d{5}\b')
+
+    def __init__(self, path: str, fuzzy_cutoff: float = 0.8, fuzzy_window: int = 32):
+        self.path = path
+        self.fuzzy_cutoff = fuzzy_cutoff
+        self.fuzzy_window = fuzzy_window
+        index_path = f'{path}.idx'
+        if not os.path.exists(index_path) or os.path.getmtime(index_path) < os.path.getmtime(path):
+            self.build_index(path, index_path)
+        with open(index_path, 'rb') as index_file:
+            self._mmap = mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self._count = struct.unpack_from('<4sI', self._mmap, 0)
+        if magic != self._MAGIC:
+            raise ValueError(f'\'{index_path}\' is not a gazetteer index')
+        coords_end = 8 + 16 * self._count
+        offsets_end = coords_end + 8 * (self._count + 1)
+        view = memoryview(self._mmap)
+        self._coords = view[8:coords_end].cast('d')
+        self._offsets = view[coords_end:offsets_end].cast('Q')
+        self._names = view[offsets_end:]
+
+    @staticmethod
+    def normalize(text: str) -> str:
+        # same as the cache key but without accents, gazetteers are rarely consistent about them
+        text = unicodedata.normalize('NFKD', text)
+        return ' '.join(''.join(c for c in text if not unicodedata.combining(c)).casefold().split())
+
+    @classmethod
+    def build_index(cls, path: str, index_path: str) -> None:
+        entries = {}
+        with open(path, newline='', encoding='utf-8') as gazetteer:
+            for row in csv.reader(gazetteer):
+                if len(row) < 3 or row[0].startswith('#'):
+                    continue
+                try: entries[cls.normalize(row[0])] = (float(row[1]), float(row[2]))
+                except ValueError: continue # header or malformed row
+        names = sorted(entries)
+        encoded = [name.encode() for name in names]
+        offsets = [0]
+        for name in encoded:
+            offsets.append(offsets[-1] + len(name))
+        with open(index_path, 'wb') as index_file:
+            index_file.write(struct.pack('<4sI', cls._MAGIC, len(names)))
+            for name in names:
+                index_file.write(struct.pack('<dd', *entries[name]))
+            index_file.write(struct.pack(f'<{len(offsets)}Q', *offsets))
+            index_file.write(b''.join(encoded))
+
+    def __len__(self) -> int:
+        return self._count
+
+    def __getitem__(self, i: int) -> str:
+        # lets bisect search the names straight from the mapped file
+        return bytes(self._names[self._offsets[i]:self._offsets[i + 1]]).decode()
+
+    def _exact(self, name: str) -> tuple[float, float] | None:
+        i = bisect.bisect_left(self, name)
+        if i < self._count and self[i] == name:
+            return (self._coords[2 * i], self._coords[2 * i + 1])
+        return None
+
+    def geocode(self, address: str) -> tuple[float, float] | None:
+        full = self.normalize(address)
+        parts = [part.strip() for part in full.split(',') if part.strip()]
+        postcode = self._POSTCODE.search(full)
+        for name in [full] + ([postcode.group()] if postcode else []) + parts:
+            coordinates = self._exact(name)
+            if coordinates: return coordinates
+        if not parts:
+            return None
+        i = bisect.bisect_left(self, parts[0])
+        if i < self._count and self[i].startswith(parts[0]):
+            return (self._coords[2 * i], self._coords[2 * i + 1])
+        for part in parts:
+            i = bisect.bisect_left(self, part)
+            window = range(max(0, i - self.fuzzy_window), min(self._count, i + self.fuzzy_window))
+            names = {self[j]: j for j in window}
+            match = difflib.get_close_matches(part, names, n=1, cutoff=self.fuzzy_cutoff)
+            if match:
+                j = names[match[0]]
+                return (self._coords[2 * j], self._coords[2 * j + 1])
+        return None
+
+
+# backend used by getLocationPoint, replace it to geocode offline
+geocoder: Geocoder = NominatimGeocoder()
+
+
 def getLocationPoint(address: str) -> Point:
-    location = None
-    retries = 0
-    while retries < 5:
-        retries += 1
-        try:
-            time.sleep(1)
-            # Use a random name for the user_agent
-            location = Nominatim(user_agent=f'random-name-{randint(0, 1000)}').geocode(address)
-            if location: 
-                return Point([location.longitude, location.latitude])
-        except GeocoderTimedOut:
+    if geocoder.cacheable:
+        cached = geocode_cache.get(address)
+        if cached is None:
+            raise ValueError('No se pudieron obtener coordenadas')
+        if cached is not _MISSING:
+            return Point(list(cached))
+    try:
+        with _profiled('geocoder', 'geocode') as details:
+            coordinates = geocoder.geocode(address)
+            details['documents'] = 1
+    except GeocoderTimedOut:
+        # not cached, a timeout may succeed later
+        raise ValueError('No se pudieron obtener coordenadas')
+    if geocoder.cacheable:
+        geocode_cache.put(address, coordinates)
+    if coordinates is None:
+        raise ValueError('No se pudieron obtener coordenadas')
+    return Point(list(coordinates))
+
+
+# (uri, pool size) => client shared by every initApp of the process
+_clients: dict[tuple[str, int], MongoClient] = {}
+# event loop => {(uri, pool size) => client}, asyncio clients can't outlive their loop
+_async_clients: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+_clients_lock = threading.Lock()
+
+
+def getClient(mongodb_uri: str = "mongodb://localhost:27017/", max_pool_size: int = 100) -> MongoClient:
+    """
+    Returns the process wide client for the uri, creating it the first time.
+    The connection pool is shared by all the models initialized with it.
+    """
+    key = (mongodb_uri, max_pool_size)
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None:
+            client = _clients[key] = MongoClient(mongodb_uri, server_api=ServerApi('1'), maxPoolSize=max_pool_size)
+    return client
+
+
+def getAsyncClient(mongodb_uri: str = "mongodb://localhost:27017/", max_pool_size: int = 100) -> AsyncMongoClient:
+    """
+    Same as getClient for the asyncio client, one per running event loop.
+    """
+    clients = _async_clients.setdefault(asyncio.get_running_loop(), {})
+    key = (mongodb_uri, max_pool_size)
+    if key not in clients:
+        clients[key] = AsyncMongoClient(mongodb_uri, server_api=ServerApi('1'), maxPoolSize=max_pool_size)
+    return clients[key]
+
+
+def closeClients() -> None:
+    """
+    Closes the clients returned by getClient, e.g. before a worker exits.
+    """
+    with _clients_lock:
+        for client in _clients.values():
+            client.close()
+        _clients.clear()
+
+
+def initApp(definitions_path: str = "./models.yml", mongodb_uri="mongodb://localhost:27017/", db_name="abd", scope=globals(),
+            cache_size: int = 1024, cache_ttl: float | None = None, max_pool_size: int = 100, manage_indexes: bool = True) -> None:
+    """
+    Creates a Model subclass per model in the definitions file. The client
+    comes from getClient and the parsed file is cached, so initializing
+    again only costs the index checks, and not even those with
+    manage_indexes=False (e.g. read only workers whose indexes are managed
+    by another process).
+    """
+    db = getClient(mongodb_uri, max_pool_size)[db_name]
+    try:
+        for model_name, (required_vars, admissible_vars, indexes, references, views) in _load_definitions(definitions_path).items():
+            model_class = type(model_name, (Model,), {'__slots__': ()})
+            model_class.init_class(db.get_collection(model_name), indexes, required_vars, admissible_vars, cache_size, cache_ttl, manage_indexes,
+                                   references, views)
+            model_class._origin = (os.path.abspath(definitions_path), mongodb_uri, db_name)
+            scope[model_name] = model_class
+    except FileNotFoundError:
+        print(f'\'{definitions_path}\' not found') 
+
+
+async def initAppAsync(definitions_path: str = "./models.yml", mongodb_uri="mongodb://localhost:27017/", db_name="abd", scope=globals(),
+                       cache_size: int = 1024, cache_ttl: float | None = None, max_pool_size: int = 100, manage_indexes: bool = True) -> None:
+    """
+    Same as initApp but the classes are AsyncModel subclasses using pymongo's
+    asyncio client, so their queries can be awaited from an event loop.
+    """
+    db = getAsyncClient(mongodb_uri, max_pool_size)[db_name]
+    try:
+        for model_name, (required_vars, admissible_vars, indexes, references, views) in _load_definitions(definitions_path).items():
+            model_class = type(model_name, (AsyncModel,), {'__slots__': ()})
+            await model_class.init_class(db.get_collection(model_name), indexes, required_vars, admissible_vars, cache_size, cache_ttl,
+                                         manage_indexes, references, views)
+            scope[model_name] = model_class
+    except FileNotFoundError:
+        print(f'\'{definitions_path}\' not found') 
+
+
+# absolute path => (modification time, definitions)
+_definitions_cache: dict[str, tuple[int, dict]] = {}
+
+
+def _load_definitions(definitions_path: str) -> dict[str, tuple[list[str], list[str], dict, dict[str, str], dict[str, dict]]]:
+    """
+    Parses models.yml into (required_vars, admissible_vars, indexes, references,
+    views) per model. The result is cached until the file is modified.
+
+    references maps the path of a field holding ObjectIds (nested in arrays
+    or not) to the model they reference, optionally with the policy applied
+    when the referenced documents are deleted (see Model.delete_many):
+
+        references:
+          company: Company
+          education.education_centre: {model: EducationalCentre, on_delete: restrict}
+
+    views maps the name of a collection to the aggregate (group_by) or the
+    filtered copy (copy) of the model documents it materializes, see
+    Model.view.
+    """
+    path = os.path.abspath(definitions_path)
+    modified = os.stat(path).st_mtime_ns
+    cached = _definitions_cache.get(path)
+    if cached is not None and cached[0] == modified:
+        return cached[1]
+    definitions = {}
+    with open(definitions_path) as models_file:
+        for model_name, model_data  in yaml.safe_load(models_file).items():
+            indexes = { 
+                'unique_indexes': model_data['unique_indexes'], 
+                'regular_indexes': model_data['regular_indexes'], 
+                'location_index': model_data['location_index'] + '_loc',
+                'indexes': model_data.get('indexes', []),
+            }
+            references = model_data.get('references') or {}
+            for reference, target in references.items():
+                if reference.split('.')[0] not in model_data['required_vars'] + model_data['admissible_vars']:
+                    raise ValueError(f'reference \'{reference}\' of {model_name} is not one of its attributes')
+                if isinstance(target, dict) and ('model' not in target or target.keys() - {'model', 'on_delete'}):
+                    raise ValueError(f'reference \'{reference}\' of {model_name} must be a model name or {{model, on_delete}}')
+                if isinstance(target, dict) and target.get('on_delete') not in (None, *_ON_DELETE):
+                    raise ValueError(f'on_delete of \'{reference}\' of {model_name} must be one of {_ON_DELETE}')
+            views = model_data.get('views') or {}
+            for view_name, view in views.items():
+                if view.keys() - _VIEW_OPTIONS:
+                    raise ValueError(f'unknown option \'{(view.keys() - _VIEW_OPTIONS).pop()}\' in view \'{view_name}\' of {model_name}')
+                if bool(view.get('copy')) == ('group_by' in view):
+                    raise ValueError(f'view \'{view_name}\' of {model_name} needs either group_by or copy')
+            definitions[model_name] = (model_data['required_vars'], model_data['admissible_vars'], indexes, references, views)
+    _definitions_cache[path] = (modified, definitions)
+    return definitions
+
+
+# models.yml 'indexes' options => create_index options
+_INDEX_OPTIONS = {
+    'unique': 'unique',
+    'sparse': 'sparse',
+    'partial_filter': 'partialFilterExpression',
+    'ttl': 'expireAfterSeconds',
+    'weights': 'weights',
+    'collation': 'collation',
+    'default_language': 'default_language',
+    'name': 'name',
+}
+
+
+def _index_specs(indexes: dict) -> list[tuple[list[tuple[str, Any]], dict]]:
+    """
+    Turns the index sections of a model definition into (keys, options)
+    pairs. Besides unique_indexes, regular_indexes and location_index, a
+    model can declare any index under 'indexes':
+
+        indexes:
+          - keys: [[company, 1], [name, -1]]       # compound, with direction
+          - keys: [education.education_centre]      # multikey nested path, ascending
+          - keys: [[description, text]]
+            weights: {description: 10}
+          - keys: [email]
+            unique: true
+            partial_filter: {email: {$exists: true}}
+            collation: {locale: es, strength: 2}
+          - keys: [[expires_at, 1]]
+            ttl: 0
+    """
+    specs = [([(index, pymongo.ASCENDING)], {'unique': True, 'sparse': True}) for index in indexes['unique_indexes']]
+    specs += [([(index, pymongo.ASCENDING)], {}) for index in indexes['regular_indexes']]
+    specs.append(([(indexes['location_index'], pymongo.GEOSPHERE)], {}))
+    for index in indexes.get('indexes', []):
+        keys = [(key, pymongo.ASCENDING) if isinstance(key, str) else tuple(key) for key in index['keys']]
+        unknown = index.keys() - _INDEX_OPTIONS.keys() - {'keys'}
+        if unknown:
+            raise ValueError(f'unknown index option \'{unknown.pop()}\' in {index}')
+        specs.append((keys, {_INDEX_OPTIONS[option]: value for option, value in index.items() if option != 'keys'}))
+    return specs
+
+
+# fields the server fills in, with these defaults, in the collation of the indexes it lists
+_COLLATION_DEFAULTS = {'caseLevel': False, 'caseFirst': 'off', 'strength': 3, 'numericOrdering': False,
+                       'alternate': 'non-ignorable', 'maxVariable': 'punct', 'normalization': False, 'backwards': False}
+
+
+def _collation_signature(collation: dict | None) -> tuple | None:
+    # declared and listed collations compared field by field, None for the binary (simple) one
+    collation = dict(collation or {})
+    if collation.get('locale', 'simple') == 'simple':
+        return None
+    collation.pop('version', None) # ICU version of the server, not an option
+    return tuple(sorted((_COLLATION_DEFAULTS | collation).items()))
+
+
+def _index_signature(keys: list[tuple[str, Any]], options: dict) -> tuple:
+    """
+    What identifies an index regardless of its name. Text indexes are stored
+    by the server as _fts/_ftsx keys with the fields in 'weights', so declared
+    ones are rewritten the same way, and collations are completed with the
+    defaults the server lists them with.
+    """
+    text_fields = {field for field, kind in keys if kind == 'text' and field != '_fts'}
+    normalized = tuple((field, kind) for field, kind in keys if field not in text_fields and field not in ('_fts', '_ftsx'))
+    text = bool(text_fields) or '_fts' in dict(keys)
+    if text:
+        weights = {field: 1 for field in text_fields} | dict(options.get('weights') or {})
+        normalized += (('_fts', 'text'), ('_ftsx', 1), ('weights', tuple(sorted(weights.items()))))
+    return (normalized,
+            bool(options.get('unique')),
+            bool(options.get('sparse')),
+            json.dumps(options.get('partialFilterExpression'), sort_keys=True, default=str),
+            options.get('expireAfterSeconds'),
+            _collation_signature(options.get('collation')),
+            (options.get('default_language') or 'english') if text else None)
+
+
+def _text_weights(keys: list[tuple[str, Any]], options: dict) -> dict[str, int] | None:
+    # fields (with their weight) of a text index, declared or as listed by the server. None for other indexes
+    fields = {field: 1 for field, kind in keys if kind == 'text' and field != '_fts'}
+    if not fields and '_fts' not in dict(keys):
+        return None
+    return fields | dict(options.get('weights') or {})
+
+
+def _listed_text_index(existing: list[dict]) -> dict[str, int] | None:
+    # fields and weights of the text index among the indexes listed by the server, None if there is none
+    return next((weights for index in existing if (weights := _text_weights(list(index['key'].items()), index))), None)
+
+
+def _index_plan(specs: list[tuple[list, dict]], existing: list[dict]) -> tuple[list[IndexModel], list[str]]:
+    """
+    Compares the declared indexes with the ones the collection has. Returns
+    the IndexModels to create and the names of the existing indexes that are
+    not declared (stale) or declared with other options (they must be dropped
+    by hand, the ODM never drops indexes).
+    """
+    existing_signatures, existing_keys = {}, {}
+    for index in existing:
+        if index['name'] == '_id_':
+            continue
+        options = dict(index)
+        if '_fts' in index['key']:
+            options['weights'] = index.get('weights', {})
+        signature = _index_signature(list(index['key'].items()), options)
+        existing_signatures[signature] = index['name']
+        existing_keys[signature[0]] = index['name']
+    to_create, declared = [], set()
+    for keys, options in specs:
+        signature = _index_signature(keys, options)
+        declared.add(signature)
+        # same keys with other options would fail to create, it is reported as stale instead
+        if signature not in existing_signatures and signature[0] not in existing_keys:
+            to_create.append(IndexModel(keys, **options))
+    stale = [name for signature, name in existing_signatures.items() if signature not in declared]
+    return to_create, stale
+
+
+# every model built by initApp/initAppAsync, by (database, collection, async).
+# Sync and async classes of the same collection are separate models
+_models: dict[tuple[str, str, bool], type['Model']] = {}
+
+# results of Model.aggregate(..., cache=True) as BSON, decoded on every hit so
+# callers can't change them for the next one, see _aggregate_cache_key
+aggregate_cache = LRUCache(maxsize=256)
+
+class _CachedCursor:
+    """
+    Documents of a cached aggregation, consumed once like the cursor of an
+    uncached one.
+    """
+    __slots__ = ('_docs',)
+
+    def __init__(self, docs: list[dict]):
+        self._docs = iter(docs)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> dict:
+        return next(self._docs)
+
+    def to_list(self) -> list[dict]:
+        return list(self._docs)
+
+
+class _AsyncCachedCursor(_CachedCursor):
+    # same for the asyncio models, iterated with async for
+    __slots__ = ()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> dict:
+        try: return next(self._docs)
+        except StopIteration: raise StopAsyncIteration
+
+    async def to_list(self) -> list[dict]:
+        return list(self._docs)
+
+
+# write versions are unique across models and initApp calls, so a class built
+# again for the same collection never matches entries cached by the old one
+_write_versions = count()
+
+
+def _pipeline_collections(pipeline: list[dict], found: set[str]) -> bool:
+    """
+    Adds to found every collection the pipeline reads through $lookup,
+    $graphLookup, $unionWith and $facet. Returns False if the pipeline
+    writes ($out/$merge), which makes it uncacheable.
+    """
+    for stage in pipeline:
+        for operator, spec in stage.items():
+            if operator in ('$out', '$merge'):
+                return False
+            if operator in ('$lookup', '$graphLookup') and 'from' in spec:
+                found.add(spec['from'])
+            if operator == '$unionWith':
+                found.add(spec if isinstance(spec, str) else spec['coll'])
+            sub_pipelines = list(spec.values()) if operator == '$facet' else [spec.get('pipeline')] if isinstance(spec, dict) else []
+            for sub_pipeline in sub_pipelines:
+                if sub_pipeline and not _pipeline_collections(sub_pipeline, found):
+                    return False
+    return True
+
+
+def _collection_models(database: str, collection: str) -> list[type['Model']]:
+    # the sync and async models of a collection, both write to the same documents
+    return [_models[database, collection, asynchronous] for asynchronous in (False, True) if (database, collection, asynchronous) in _models]
+
+
+def _aggregate_cache_key(model: type['Model'], pipeline: list[dict]) -> tuple | None:
+    """
+    Key of a cached aggregation: the database and the hash of the pipeline
+    (BSON keeps the key order, which matters in stages like $sort) plus the
+    write version of every collection it reads, so any save or delete on them
+    makes old entries unreachable. None if the pipeline must not be cached.
+    """
+    database, collections = model._db.database.name, {model._db.name}
+    if not _pipeline_collections(pipeline, collections):
+        return None
+    versions = {name: tuple(other._write_version for other in _collection_models(database, name)) for name in collections}
+    if not all(versions.values()):
+        return None # writes to collections outside the ODM cannot be tracked
+    digest = hashlib.sha1(bson.encode({'pipeline': pipeline})).hexdigest()
+    return (database, model._db.name, digest, tuple(sorted(versions.items())))
+
+
+def _bump_out_target(model: type['Model'], pipeline: list[dict]) -> None:
+    # a $out/$merge into another model changes its documents too
+    for stage in pipeline[-1:]:
+        target = stage.get('$out', stage.get('$merge', {}).get('into') if '$merge' in stage else None)
+        database = model._db.database.name
+        if isinstance(target, dict):
+            database, target = target.get('db', database), target.get('coll')
+        if isinstance(target, str):
+            for other in _collection_models(database, target):
+                other._written()
+
+
+# most foreign keys a $lookup filter may resolve to and still be pushed down
+optimizer_max_ids = 1000
+
+# operators that only match when the joined array has a matching element
+_EXISTENTIAL_OPERATORS = {'$eq', '$in', '$gt', '$gte', '$lt', '$lte', '$regex', '$options', '$all', '$elemMatch'}
+
+# stages whose output no longer carries the fields of their input
+_CLOSING_STAGES = {'$group', '$replaceRoot', '$replaceWith', '$count', '$bucket', '$bucketAuto', '$sortByCount'}
+
+
+def _existential(condition: Any) -> bool:
+    # a negative condition ($ne, $exists: false, null...) also matches people
+    # without any joined document, so it can't be resolved on the foreign side
+    if condition is None:
+        return False
+    if isinstance(condition, dict) and any(key.startswith('$') for key in condition):
+        return all(operator in _EXISTENTIAL_OPERATORS and value is not None for operator, value in condition.items()) \
+            and None not in condition.get('$in', [])
+    return True
+
+
+def _field_uses(value: Any, field: str, uses: set[str]) -> bool:
+    """
+    Adds to uses the sub paths of field that value references, either as
+    '$field.x' expressions or as 'field.x' keys. Returns False if the field
+    or the whole document is referenced, so every sub path may be needed.
+    """
+    if isinstance(value, str):
+        if value == f'${field}' or value.startswith(('$$ROOT', '$$CURRENT')):
+            return False
+        if value.startswith(f'${field}.'):
+            uses.add(value[len(field) + 2:])
+        return True
+    if isinstance(value, dict):
+        for key, item in value.items():
+            if key == field:
+                return False
+            if key.startswith(f'{field}.'):
+                uses.add(key[len(field) + 1:])
+            if key == 'localField' and isinstance(item, str):
+                item = f'${item}'
+            if not _field_uses(item, field, uses):
+                return False
+        return True
+    if isinstance(value, list):
+        return all(_field_uses(item, field, uses) for item in value)
+    return True
+
+
+def _unwinds(stage: dict, field: str) -> bool:
+    spec = stage.get('$unwind')
+    return (spec if isinstance(spec, str) else spec.get('path') if isinstance(spec, dict) else None) == f'${field}'
+
+
+def _simple_lookup(stage: dict) -> bool:
+    spec = stage.get('$lookup')
+    return isinstance(spec, dict) and {'from', 'localField', 'foreignField', 'as'} <= spec.keys() and 'pipeline' not in spec
+
+
+def _lookup_pushdowns(pipeline: list[dict]) -> list[tuple[int, dict, list[dict]]]:
+    """
+    Finds the $lookup stages followed (optionally after unwinding them) by a
+    $match on the joined documents, e.g. {'the_company.name': 'Microsoft'}.
+    Returns (stage index, $lookup spec, filters on the foreign collection):
+    one filter per condition, or a single one when the array is unwound,
+    since each condition may hold for a different joined document otherwise.
+    """
+    pushdowns = []
+    for i, stage in enumerate(pipeline):
+        if not _simple_lookup(stage):
+            continue
+        spec = stage['$lookup']
+        j = i + 1
+        unwound = j < len(pipeline) and _unwinds(pipeline[j], spec['as'])
+        j += unwound
+        if j >= len(pipeline) or '$match' not in pipeline[j]:
+            continue
+        prefix = spec['as'] + '.'
+        filters = {key[len(prefix):]: condition for key, condition in pipeline[j]['$match'].items()
+                   if key.startswith(prefix) and _existential(condition)}
+        if filters:
+            pushdowns.append((i, spec, [filters] if unwound else [{key: condition} for key, condition in filters.items()]))
+    return pushdowns
+
+
+def _lookup_projection(field: str, rest: list[dict]) -> dict | None:
+    """
+    Projection keeping only the sub paths of the joined documents (stored in
+    field) that the following stages use, or None if they may need all of it.
+    """
+    uses = set()
+    for stage in rest:
+        operator, spec = next(iter(stage.items()))
+        if operator in ('$facet', '$out', '$merge'):
+            return None
+        if _unwinds(stage, field):
+            continue
+        if not _field_uses(spec, field, uses):
+            return None
+        inclusion = operator == '$project' and any(value not in (0, False) for key, value in spec.items() if key != '_id')
+        if operator in _CLOSING_STAGES or inclusion:
+            # 'a' and 'a.b' together are a path collision
+            paths = sorted(uses)
+            return {path: 1 for path in paths if not any(path.startswith(f'{other}.') for other in paths)} or {'_id': 1}
+    return None
+
+
+def _and(first: dict, second: dict) -> dict:
+    if first.keys() & second.keys():
+        return {'$and': [first, second]}
+    return {**first, **second}
+
+
+def _merge_projects(first: dict, second: dict) -> dict | None:
+    # only plain inclusions, a computed field may read one the first one computed
+    if not all(value in (1, True) or key == '_id' and value in (0, False) for project in (first, second) for key, value in project.items()):
+        return None
+    merged = {key: 1 for key in second if key in first and key != '_id'}
+    if not merged or any('.' in key for key in merged):
+        return None
+    if not first.get('_id', 1) or not second.get('_id', 1):
+        merged['_id'] = 0
+    return merged
+
+
+def _foreign_keys(docs: list[dict], field: str) -> list | None:
+    """
+    Distinct values of field in the documents a foreign filter selected,
+    read with a limit of optimizer_max_ids + 1: None if the limit was
+    reached, as there may be more keys than can be pushed down.
+    """
+    if len(docs) > optimizer_max_ids:
+        return None
+    return list(dict.fromkeys(value for doc in docs for value in _path_values(doc, field)[0]))
+
+
+def _optimize_pipeline(pipeline: list[dict], foreign_keys: dict[int, list[list | None]]) -> tuple[list[dict], list[str]]:
+    """
+    Rewrites an aggregation pipeline so it does less work, returning the new
+    pipeline and a description of every rewrite:
+
+    - a $lookup followed by a $match on the joined documents gets a $match on
+      its localField before it, with the foreign keys selected by that filter
+      (foreign_keys, per stage index from _lookup_pushdowns). The original
+      $match stays, it only runs on far fewer documents. Filters selecting
+      more than optimizer_max_ids keys (None in foreign_keys) are not pushed down.
+    - joined documents are projected to the fields the later stages use
+    - adjacent $match stages are merged, as well as $project stages of plain
+      inclusions, and a $match right after $geoNear moves into its query
+    """
+    stages = copy.deepcopy(pipeline)
+    rewrites = []
+
+    pushed = []
+    for i, stage in enumerate(stages):
+        keys = foreign_keys.get(i)
+        if keys and all(ids is not None and len(ids) <= optimizer_max_ids for ids in keys):
+            spec = stage['$lookup']
+            conditions = [{spec['localField']: {'$in': ids}} for ids in keys]
+            pushed.append({'$match': conditions[0] if len(conditions) == 1 else {'$and': conditions}})
+            rewrites.append(f"$lookup {spec['from']}: {' and '.join(str(len(ids)) for ids in keys)} "
+                            f"{spec['foreignField']} pushed down as a $match on {spec['localField']}")
+        pushed.append(stage)
+    stages = pushed
+
+    for i, stage in enumerate(stages):
+        if _simple_lookup(stage):
+            spec = stage['$lookup']
+            projection = _lookup_projection(spec['as'], stages[i + 1:])
+            if projection is not None:
+                spec['pipeline'] = [{'$project': projection}]
+                rewrites.append(f"$lookup {spec['from']}: projected to {list(projection)}")
+
+    merged = []
+    for stage in stages:
+        previous = merged[-1] if merged else {}
+        if '$match' in stage and '$match' in previous:
+            previous['$match'] = _and(previous['$match'], stage['$match'])
+            rewrites.append('adjacent $match stages merged')
             continue
-    raise ValueError('No se pudieron obtener coordenadas')
+        if '$match' in stage and '$geoNear' in previous:
+            spec, uses = previous['$geoNear'], set()
+            computed = [spec[option] for option in ('distanceField', 'includeLocs') if option in spec]
+            if all(_field_uses(stage['$match'], field, uses) and not uses for field in computed):
+                spec['query'] = _and(spec['query'], stage['$match']) if spec.get('query') else stage['$match']
+                rewrites.append('$match moved into the $geoNear query')
+                continue
+        if '$project' in stage and '$project' in previous:
+            project = _merge_projects(previous['$project'], stage['$project'])
+            if project is not None:
+                previous['$project'] = project
+                rewrites.append('adjacent $project stages merged')
+                continue
+        merged.append(stage)
+    return merged, rewrites
+
+
+class _Field:
+    """
+    Descriptor generated for every declared attribute, so reading it is a
+    dict lookup instead of a failed attribute search followed by __getattr__.
+    """
+    __slots__ = ('name',)
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def __get__(self, instance: 'Model | None', owner: type) -> Any:
+        if instance is None:
+            return self
+        try: value = instance._data[self.name]
+        except KeyError:
+            if not instance._load_missing(self.name):
+                raise AttributeError(f'"{self.name}" is not a valid attribute for {owner.__name__}')
+            return getattr(instance, self.name)
+        if type(value) in _MUTABLE_TYPES:
+            return instance._track(self.name, value)
+        return value
+
+
+# values that can be changed in place (RawBSONDocument is read-only but it is decoded into a dict when read)
+_MUTABLE_TYPES = (list, dict, RawBSONDocument)
+
+
+class _Snapshot:
+    """
+    A list or dict field as it was first read, kept as BSON to diff against
+    when saving: encoding is cheaper than a deep copy, raw documents are kept
+    as they were read, and it is only decoded if the field did change.
+    """
+    __slots__ = ('raw', 'wrapped')
+
+    def __init__(self, value: Any):
+        self.wrapped = type(value) is not RawBSONDocument
+        self.raw = self._encode(value) if self.wrapped else value.raw
+
+    def _encode(self, value: Any) -> bytes:
+        return bson.encode({'': value}) if self.wrapped else bson.encode(value)
+
+    def changed(self, value: Any) -> bool:
+        # the same bytes are the same value, other bytes may still be (e.g. keys reordered), _diff tells
+        return type(value) not in (list, dict) or (not self.wrapped and type(value) is list) or self._encode(value) != self.raw
+
+    def value(self) -> Any:
+        return bson.decode(self.raw)[''] if self.wrapped else bson.decode(self.raw)
+
+
+def _decode(value: Any) -> Any:
+    # turns lazily decoded raw BSON (also nested in lists) into plain python objects
+    if type(value) is RawBSONDocument:
+        return bson.decode(value.raw)
+    if type(value) is list:
+        return [_decode(item) for item in value]
+    return value
+
+
+def _path_values(document: dict, path: str) -> tuple[list, bool]:
+    """
+    Values found at a dotted path, going through arrays like MongoDB does,
+    and whether an array was found on the way (so the path holds many).
+    """
+    values, many = [document], False
+    for part in path.split('.'):
+        found = []
+        for value in values:
+            value = value.get(part) if isinstance(value, (dict, RawBSONDocument)) else None
+            if isinstance(value, list):
+                many = True
+                found.extend(value)
+            elif value is not None:
+                found.append(value)
+        values = found
+    return values, many
+
+
+def _encode_token(state: dict) -> str:
+    # continuation tokens are opaque to callers: url safe base64 of a BSON document
+    return base64.urlsafe_b64encode(bson.encode(state)).decode()
+
+
+def _decode_token(token: str) -> dict:
+    try: return bson.decode(base64.urlsafe_b64decode(token.encode()))
+    except Exception: raise ValueError(f'invalid continuation token \'{token}\'')
+
+
+# field $geoNear writes the distance to, moved to the instance meta() when hydrating
+_DISTANCE_FIELD = '_distance'
+
+
+def _geometry(point: Any) -> dict:
+    """
+    GeoJSON point for near queries: a geojson Point (or its dict) or a
+    [longitude, latitude] pair. Addresses are geocoded with getLocationPoint.
+    """
+    if isinstance(point, str):
+        point = getLocationPoint(point)
+    if isinstance(point, dict):
+        return dict(point)
+    longitude, latitude = point
+    return {'type': 'Point', 'coordinates': [longitude, latitude]}
+
+
+# models.yml 'views' options
+_VIEW_OPTIONS = {'group_by', 'match', 'count', 'sum', 'size', 'copy', 'fields'}
+
+
+def _any_value(values: list, test: Callable[[Any], bool]) -> bool:
+    for value in values:
+        try:
+            if test(value):
+                return True
+        except TypeError: # values of types that do not compare never match, as in MongoDB
+            pass
+    return False
+
+
+# query operator => test of the values found at the path
+_VIEW_OPERATORS: dict[str, Callable[[list, Any], bool]] = {
+    '$eq': lambda values, operand: not values if operand is None else operand in values,
+    '$ne': lambda values, operand: bool(values) if operand is None else operand not in values,
+    '$gt': lambda values, operand: _any_value(values, lambda value: value > operand),
+    '$gte': lambda values, operand: _any_value(values, lambda value: value >= operand),
+    '$lt': lambda values, operand: _any_value(values, lambda value: value < operand),
+    '$lte': lambda values, operand: _any_value(values, lambda value: value <= operand),
+    '$in': lambda values, operand: any(value in operand for value in values),
+    '$nin': lambda values, operand: not any(value in operand for value in values),
+    '$exists': lambda values, operand: bool(values) == bool(operand),
+}
+
+
+def _matches(document: dict, query: dict) -> bool:
+    """
+    Evaluates the match filter of a view on a document, without a round trip.
+    Supports equality and the operators of _VIEW_OPERATORS on dotted paths
+    (an array matches if any element does), combined with $and and $or.
+    """
+    for key, condition in query.items():
+        if key == '$and':
+            if not all(_matches(document, part) for part in condition):
+                return False
+        elif key == '$or':
+            if not any(_matches(document, part) for part in condition):
+                return False
+        else:
+            values = _path_values(document, key)[0]
+            operators = condition if isinstance(condition, dict) and condition and all(name.startswith('$') for name in condition) else {'$eq': condition}
+            for operator, operand in operators.items():
+                if operator not in _VIEW_OPERATORS:
+                    raise ValueError(f'operator {operator} is not supported in view filters')
+                if not _VIEW_OPERATORS[operator](values, operand):
+                    return False
+    return True
+
+
+def _view_rows(view: dict, document: dict | None) -> dict[Any, dict[str, int | float]]:
+    """
+    Contribution of a document to a grouped view: group key => field =>
+    amount. Every value at the group_by path is a key, like after unwinding
+    the arrays on the way, so a person with two studies counts in both centres.
+    """
+    if document is None or not _matches(document, view.get('match', {})):
+        return {}
+    amounts = {view['count']: 1} if 'count' in view else {}
+    for field, path in view.get('sum', {}).items():
+        amounts[field] = sum(value for value in _path_values(document, path)[0] if isinstance(value, (int, float)) and not isinstance(value, bool))
+    for field, path in view.get('size', {}).items():
+        amounts[field] = len(_path_values(document, path)[0])
+    rows = {}
+    for key in _path_values(document, view['group_by'])[0]:
+        row = rows.setdefault(key, dict.fromkeys(amounts, 0))
+        for field, amount in amounts.items():
+            row[field] += amount
+    return rows
+
+
+def _copy_write(view: dict, before: dict | None, after: dict | None) -> ReplaceOne | DeleteOne | None:
+    # write keeping a filtered copy view in line with one document
+    if after is not None and _matches(after, view.get('match', {})):
+        document = after if 'fields' not in view else {field: after[field] for field in ['_id', *view['fields']] if field in after}
+        return ReplaceOne({'_id': after['_id']}, document, upsert=True)
+    if before is not None and _matches(before, view.get('match', {})):
+        return DeleteOne({'_id': before['_id']})
+    return None
+
+
+def _view_pipeline(name: str, view: dict) -> list[dict]:
+    """
+    Aggregation pipeline computing a whole view from its source collection
+    with the same semantics as the incremental updates, $out to the view.
+    """
+    pipeline = [{'$match': view['match']}] if view.get('match') else []
+    if view.get('copy'):
+        if 'fields' in view:
+            pipeline.append({'$project': dict.fromkeys(view['fields'], 1)})
+        return pipeline + [{'$out': name}]
+    # the amounts are computed per document, before unwinding it
+    amounts = {field: {'$sum': f'${path}'} for field, path in view.get('sum', {}).items()}
+    for field, path in view.get('size', {}).items():
+        amounts[field] = {'$cond': [{'$isArray': f'${path}'}, {'$size': f'${path}'}, {'$cond': [{'$eq': [{'$ifNull': [f'${path}', None]}, None]}, 0, 1]}]}
+    if amounts:
+        pipeline.append({'$addFields': {f'_view_{field}': expression for field, expression in amounts.items()}})
+    parts = view['group_by'].split('.')
+    pipeline += [{'$unwind': '$' + '.'.join(parts[:i])} for i in range(1, len(parts) + 1)]
+    group = {'_id': f'${view["group_by"]}'}
+    if 'count' in view:
+        group[view['count']] = {'$sum': 1}
+    group.update({field: {'$sum': f'$_view_{field}'} for field in amounts})
+    return pipeline + [{'$group': group}, {'$out': name}]
+
+
+# on_delete policies of the references in models.yml
+_ON_DELETE = ('cascade', 'nullify', 'restrict')
+
+# ids per $in of the writes applying them, so no query gets near the 16MB BSON limit
+delete_batch_size = 50_000
+
+# referencing documents read at once when nullifying the references of a model
+# with views, which need them before and after (the others take one update_many)
+nullify_batch_size = 1000
+
+
+def _chunks(ids: list, size: int) -> Generator:
+    for start in range(0, len(ids), size):
+        yield ids[start:start + size]
+
+
+def _contains(ids: set, value: Any) -> bool:
+    try: return value in ids
+    except TypeError: return False # unhashable values are never ids
+
+
+def _without_ids(value: Any, parts: list[str], ids: set) -> Any:
+    """
+    value with the ids found at the path parts set to None, or removed from
+    the arrays holding them, going through arrays like _path_values. The
+    same as the update of _nullify_expression, to keep the views in line.
+    """
+    if not parts:
+        if isinstance(value, list):
+            return [item for item in value if not _contains(ids, item)]
+        return None if _contains(ids, value) else value
+    if isinstance(value, list):
+        return [_without_ids(item, parts, ids) for item in value]
+    if isinstance(value, (dict, RawBSONDocument)) and parts[0] in value:
+        return {**value, parts[0]: _without_ids(value[parts[0]], parts[1:], ids)}
+    return value
+
+
+def _nullify_expression(value: str, parts: list[str], ids: list, depth: int = 0) -> dict:
+    # aggregation expression of value ('$field' or '$$variable') doing what _without_ids does, for a pipeline update
+    if not parts:
+        name = f'id{depth}'
+        return {'$cond': [{'$isArray': value},
+                          {'$filter': {'input': value, 'as': name, 'cond': {'$not': [{'$in': [f'$${name}', {'$literal': ids}]}]}}},
+                          {'$cond': [{'$in': [value, {'$literal': ids}]}, None, value]}]}
+    name = f'item{depth}'
+
+    def nested(document):
+        return {'$cond': [{'$eq': [{'$type': document}, 'object']},
+                          {'$mergeObjects': [document, {parts[0]: _nullify_expression(f'{document}.{parts[0]}', parts[1:], ids, depth + 1)}]},
+                          document]}
+    return {'$cond': [{'$isArray': value}, {'$map': {'input': value, 'as': name, 'in': nested(f'$${name}')}}, nested(value)]}
+
+
+def _nullify_update(path: str, ids: list) -> list[dict]:
+    parts = path.split('.')
+    return [{'$set': {parts[0]: _nullify_expression(f'${parts[0]}', parts[1:], ids)}}]
+
+
+# field the text score is projected to, moved to the instance meta() when hydrating
+_SCORE_FIELD = '_score'
+
+# ranked ids per $in reading the results of a search without text index, best
+# first, until limit of them match the filter
+search_batch_size = 1000
+
+
+class TextSearchIndex:
+    """
+    In-memory inverted index over some string fields of a collection, used
+    by Model.search when the collection has no text index.
+
+    Queries follow the $text syntax: documents matching any term are ranked
+    by the sum of weight * (term frequency in the field) * idf, '-term'
+    excludes documents and the terms of a "quoted phrase" must all appear
+    (not necessarily together, positions are not indexed).
+
+    Attributes
+    ----------
+    weights : dict[str, int]
+        Indexed field paths and their weights
+    postings : dict[str, dict[ObjectId, float]]
+        Term => document id => weighted frequency
+    """
+    def __init__(self, weights: dict[str, int]):
+        self.weights = dict(weights)
+        self.postings: dict[str, dict[ObjectId, float]] = {}
+        self.documents = 0
+
+    @staticmethod
+    def tokens(text: str) -> list[str]:
+        return re.findall(r'\w+', GazetteerGeocoder.normalize(text))
+
+    def add(self, id: ObjectId, document: dict) -> None:
+        self.documents += 1
+        for field, weight in self.weights.items():
+            for value in _path_values(document, field)[0]:
+                if not isinstance(value, str):
+                    continue
+                tokens = self.tokens(value)
+                for token in tokens:
+                    posting = self.postings.setdefault(token, {})
+                    posting[id] = posting.get(id, 0.0) + weight / len(tokens)
+
+    def search(self, query: str) -> list[tuple[ObjectId, float]]:
+        """
+        Returns the (id, score) of the matching documents, best first.
+        """
+        phrases = re.findall(r'"([^"]*)"', query)
+        words = re.sub(r'"[^"]*"', ' ', query).split()
+        excluded = {token for word in words if word.startswith('-') for token in self.tokens(word[1:])}
+        required = {token for phrase in phrases for token in self.tokens(phrase)}
+        terms = {token for word in words if not word.startswith('-') for token in self.tokens(word)} | required
+        scores = {}
+        for term in terms:
+            posting = self.postings.get(term, {})
+            idf = 1.0 + (self.documents / len(posting) if posting else 0.0)
+            for id, frequency in posting.items():
+                scores[id] = scores.get(id, 0.0) + frequency * idf
+        for term in required:
+            scores = {id: score for id, score in scores.items() if id in self.postings.get(term, {})}
+        for term in excluded:
+            scores = {id: score for id, score in scores.items() if id not in self.postings.get(term, {})}
+        return sorted(scores.items(), key=lambda item: item[1], reverse=True)
+
+
+class _All:
+    """
+    Yielded by the steps of an operation (see _run) to read a cursor: its
+    documents come back as a list or, with each, are passed to it as they
+    arrive, so they are never all in memory at once.
+    """
+    __slots__ = ('cursor', 'each')
+
+    def __init__(self, cursor: Any, each: Callable[[Any], None] | None = None):
+        self.cursor = cursor
+        self.each = each
+
+
+def _run(steps: Generator) -> Any:
+    """
+    Runs the steps of a database operation. Operations are generators written
+    once for Model and AsyncModel: they yield the result of every pymongo
+    call they make and get it back, cursors wrapped in _All read. With the
+    synchronous client the calls are made when they are yielded, so results
+    are sent back as they are. Errors are raised back into the generator at
+    its yield. Returns what the generator returns.
+    """
+    send, value = steps.send, None
+    while True:
+        try: request = send(value)
+        except StopIteration as stop: return stop.value
+        send = steps.send
+        try:
+            if type(request) is not _All:
+                value = request
+            elif request.each is None:
+                value = list(request.cursor)
+            else:
+                for doc in request.cursor:
+                    request.each(doc)
+                value = None
+        except Exception as e:
+            send, value = steps.throw, e
+
+
+async def _run_async(steps: Generator) -> Any:
+    """
+    _run for AsyncModel: the steps yield the coroutines of the asyncio client
+    (or plain values, e.g. cached ones), which are awaited here.
+    """
+    send, value = steps.send, None
+    while True:
+        try: request = send(value)
+        except StopIteration as stop: return stop.value
+        send = steps.send
+        try:
+            if type(request) is not _All:
+                value = await request if inspect.isawaitable(request) else request
+            else:
+                cursor = await request.cursor if inspect.isawaitable(request.cursor) else request.cursor # aggregate and list_indexes
+                if request.each is None:
+                    value = await cursor.to_list()
+                else:
+                    async for doc in cursor:
+                        request.each(doc)
+                    value = None
+        except Exception as e:
+            send, value = steps.throw, e
+
+
+class _Partial:
+    """
+    Shared by the instances that a find with fields=[...] read in one batch:
+    the fields they loaded and the instances themselves, so reading a field
+    that was not loaded fetches it for the whole batch with one query.
+    """
+    __slots__ = ('model', 'loaded', 'instances')
+
+    def __init__(self, model: type['Model'], loaded: frozenset[str]):
+        self.model = model
+        self.loaded = set(loaded) | {'_id'}
+        self.instances: list[Model] = []
+
+    def query(self, names: list[str] | None) -> tuple[dict, dict | None]:
+        # filter and projection of the fields names of the batch, every field not loaded if None
+        return {'_id': {'$in': [instance._data['_id'] for instance in self.instances]}}, dict.fromkeys(names, 1) if names else None
+
+    def fill(self, docs: list[dict], names: list[str] | None) -> None:
+        # adds the fetched fields, except those changed (or deleted) since the find
+        found = {doc['_id']: doc for doc in docs}
+        for instance in self.instances:
+            doc = found.get(instance._data['_id'])
+            if doc is None:
+                continue # deleted meanwhile
+            data = instance._writable()
+            for name in names or doc.keys():
+                if name in doc and name not in data and name not in instance._modified_vars:
+                    data[name] = doc[name]
+        if names is None: # complete documents now
+            for instance in self.instances:
+                object.__delattr__(instance, '_partial')
+            self.instances = []
+        else:
+            self.loaded.update(names)
+
+    def load_steps(self, names: list[str] | None = None) -> Generator:
+        filter, projection = self.query(names)
+        with _profiled(self.model.__name__, 'load') as details:
+            docs = yield _All(self.model._db.find(filter, projection))
+            details['documents'] = len(docs)
+        self.fill(docs, names)
+
+    def load(self, names: list[str] | None = None) -> None:
+        _run(self.load_steps(names))
+
+
+class Model:
+    # instances only hold these references, no per-instance __dict__.
+    # _refs is only set once a reference is resolved, _meta by geo queries,
+    # _partial by finds that read only some fields
+    __slots__ = ('_data', '_modified_vars', '_refs', '_meta', '_partial')
+
+    _required_vars: frozenset[str]
+    _admissible_vars: frozenset[str]
+    _allowed_vars: frozenset[str] # every attribute that can be assigned, precomputed by _compile
+    _location_var: None 
+    _db: Collection
+    _identity_map: LRUCache
+    _write_version: int # bumped by every write, versions the aggregate cache
+    _index_report: dict[str, list[str]] | None # indexes created and stale ones found by init_class, None if not managed
+    _data: dict[str, str | dict]
+    _modified_vars: dict[str, Any] # original value of every field changed since the last save, a _Snapshot if only read
+    _refs: dict[str, tuple[list, Any]] # reference path => (ids, resolved instances)
+    _meta: dict[str, Any] # query metadata, e.g. 'distance' or 'score'
+    _partial: _Partial # the fields loaded, for instances that did not read all of them
+    _references: dict[str, str] = {} # reference path => name of the referenced model
+    _on_delete: dict[str, str] = {} # reference path => policy when the referenced documents are deleted
+    _views: dict[str, dict] = {} # view collection => its definition, maintained by every write
+    _origin: tuple[str, str, str] | None = None # definitions file, uri and database of initApp, to build the class again in other processes
+    _text_declared: dict[str, int] | None # fields and weights of the text index in the models file
+    _text_index: Any # same for the text index of the collection, None if it has none, _MISSING until checked
+    _search_indexes: dict[tuple, tuple[int, TextSearchIndex]] # fallback indexes and the write version they were built at
+    _asynchronous = False # registered apart from the sync class of the same collection, see _models
+    _locate = staticmethod(getLocationPoint) # geocodes the location attribute, a coroutine function in AsyncModel
+
+    def __init__(self, **kwargs: dict[str, str | dict]):
+        # generic version, the classes built by initApp get a specialised copy from _compile
+        unknown = kwargs.keys() - self._allowed_vars - {'_id'}
+        if unknown:
+            raise AttributeError(f'\'{unknown.pop()}\' not allowed in {self.__class__.__name__}')
+        if not self._required_vars <= kwargs.keys():
+            raise AttributeError(f'\'{next(iter(self._required_vars - kwargs.keys()))}\' is required in {self.__class__.__name__}')
+        object.__setattr__(self, '_data', kwargs) # bypass the overriden __setattr__
+        # built by hand with an '_id': every field is written, '_id' marks the stored document as unknown
+        object.__setattr__(self, '_modified_vars', dict.fromkeys(kwargs, _MISSING) if '_id' in kwargs else {})
+
+
+    @classmethod
+    def _compile(cls, required_vars: set[str], admissible_vars: set[str], location_var: str) -> None:
+        """
+        Precomputes the attribute sets of the class and builds a constructor
+        specialised for them, so validating a new instance is two set
+        operations on local variables.
+        """
+        cls._required_vars = required = frozenset(required_vars)
+        cls._admissible_vars = frozenset(admissible_vars)
+        cls._location_var = location_var
+        cls._allowed_vars = frozenset(required_vars) | frozenset(admissible_vars) | {location_var}
+        allowed = cls._allowed_vars | {'_id'}
+        name = cls.__name__
+        set_slot = object.__setattr__
+
+        def __init__(self, **kwargs: dict[str, str | dict]):
+            if not kwargs.keys() <= allowed:
+                raise AttributeError(f'\'{(kwargs.keys() - allowed).pop()}\' not allowed in {name}')
+            if not required <= kwargs.keys():
+                raise AttributeError(f'\'{next(iter(required - kwargs.keys()))}\' is required in {name}')
+            set_slot(self, '_data', kwargs)
+            set_slot(self, '_modified_vars', dict.fromkeys(kwargs, _MISSING) if '_id' in kwargs else {})
+
+        cls.__init__ = __init__
+        for field in allowed:
+            # never shadow methods or class attributes with a field of the same name
+            if not hasattr(cls, field):
+                setattr(cls, field, _Field(field))
+
+
+    @classmethod
+    def _from_doc(cls, doc: dict) -> Self:
+        """
+        Builds an instance around a document read from the database, taking
+        ownership of the dict without copying or validating it.
+        """
+        instance = object.__new__(cls)
+        object.__setattr__(instance, '_data', doc)
+        object.__setattr__(instance, '_modified_vars', {})
+        return instance
+
+
+    def __setattr__(self, name: str, value: str | dict) -> None:
+        if name not in self._allowed_vars:
+            raise AttributeError(f'\'{name}\' not allowed in {self.__class__.__name__}')
+        else:
+            data = self._writable()
+            if name not in data and self._load_missing(name):
+                data = self._data
+            self._modified_vars.setdefault(name, data.get(name, _MISSING))
+            data[name] = value
+
+
+    def __delattr__(self, name: str) -> None:
+        if name not in self._data:
+            self._load_missing(name)
+        if name not in self._data or name == '_id':
+            raise AttributeError(f'"{name}" is not a valid attribute for {self.__class__.__name__}')
+        data = self._writable()
+        self._modified_vars.setdefault(name, data[name])
+        del data[name]
+
+
+    def _writable(self) -> dict:
+        """
+        Returns _data as a dict, converting it first if the instance was read
+        in raw mode. Only the top level is converted, nested values stay lazy.
+        """
+        data = self._data
+        if type(data) is RawBSONDocument:
+            data = dict(data.items())
+            object.__setattr__(self, '_data', data)
+        return data
+
+
+    def _track(self, name: str, value: Any) -> Any:
+        """
+        Called when a list or dict field is read: as it can be changed in
+        place, a _Snapshot of it is kept to diff against when saving.
+
+        Only reads are tracked: a list or dict taken before save() and
+        changed in place after it is not saved again, as the instance never
+        sees it being read again. Read the field again after saving.
+        """
+        snapshot = None
+        if name not in self._modified_vars and '_id' in self._data:
+            snapshot = _Snapshot(value) # before decoding, raw documents are kept as they are
+        if type(self._data) is RawBSONDocument or type(value) is RawBSONDocument:
+            value = _decode(value)
+            self._writable()[name] = value
+        if snapshot is not None:
+            self._modified_vars[name] = snapshot
+        return value
+
+
+    def __getattr__(self, name: str) -> Any:
+        # only called for names that are not slots or class attributes, so they must be fields.
+        # object.__getattribute__ avoids recursing back here if _data is not set yet (e.g. copy)
+        try: value = object.__getattribute__(self, '_data')[name]
+        except KeyError:
+            if not self._load_missing(name):
+                raise AttributeError(f'"{name}" is not a valid attribute for {self.__class__.__name__}')
+            return getattr(self, name)
+        if type(value) in _MUTABLE_TYPES:
+            return self._track(name, value)
+        return value
+
+
+    def _load_missing(self, name: str) -> bool:
+        """
+        Fetches a field that a partial instance (see find's fields) did not
+        load, for its whole batch, returning whether it did. Fields are also
+        fetched before being changed, so the views see their previous value.
+        """
+        try: partial = object.__getattribute__(self, '_partial')
+        except AttributeError: return False
+        if name in partial.loaded or name not in self._allowed_vars:
+            return False
+        partial.load([name])
+        return True
+
+
+    def _load_all(self) -> None:
+        # completes a partial instance (and its batch) with every field it did not load
+        try: partial = object.__getattribute__(self, '_partial')
+        except AttributeError: return
+        partial.load()
+
+
+    def _load_steps(self, names: list[str] | None = None) -> Generator:
+        # steps loading the fields (every one by default) that a partial instance did not, for its batch
+        try: partial = object.__getattribute__(self, '_partial')
+        except AttributeError: return
+        names = [name for name in names if name not in partial.loaded] if names else None
+        if names != []:
+            yield from partial.load_steps(names)
+
+
+    @staticmethod
+    def _diff(path: str, old: Any, new: Any, set_: dict, unset: dict) -> None:
+        if old is _MISSING and new is _MISSING:
+            return
+        if new is _MISSING:
+            unset[path] = ''
+        elif old is _MISSING:
+            set_[path] = new
+        elif type(old) is dict and type(new) is dict:
+            for key in old.keys() | new.keys():
+                Model._diff(f'{path}.{key}', old.get(key, _MISSING), new.get(key, _MISSING), set_, unset)
+        elif type(old) is list and type(new) is list and len(old) == len(new):
+            for i, (old_item, new_item) in enumerate(zip(old, new)):
+                Model._diff(f'{path}.{i}', old_item, new_item, set_, unset)
+        elif old != new or type(old) is not type(new):
+            set_[path] = new
+
+
+    def _update_document(self) -> dict[str, dict] | None:
+        """
+        Returns the minimal update with the changes made since the last save,
+        with nested lists and dicts diffed per path, or None if nothing changed.
+        """
+        set_, unset = {}, {}
+        for name, old in self._modified_vars.items():
+            new = self._data.get(name, _MISSING)
+            if type(old) is _Snapshot:
+                if not old.changed(new):
+                    continue # only read
+                old = old.value()
+            if name != '_id':
+                self._diff(name, old, new, set_, unset)
+        update = {}
+        if set_: update['$set'] = set_
+        if unset: update['$unset'] = unset
+        return update or None
+
+
+    def _needs_location(self) -> bool:
+        # the location_index attribute was given but its coordinates have not been resolved yet
+        return self._location_var[0:-4] in self._data.keys() and self._location_var not in self._data
+
+
+    def save(self) -> None:
+        unit = _active_session.get()
+        if unit is not None:
+            unit.add(self) # written when the session is flushed
+            return
+        _run(self._save_steps())
+
+
+    def _save_steps(self) -> Generator:
+        if '_id' in self._data:
+            update = self._update_document()
+            if update is None:
+                return # nothing changed since the last save
+            if self._views:
+                yield from self._load_steps() # the views need the whole document
+                yield from self._adopt_steps([self])
+                if (update := self._update_document()) is None:
+                    return
+            before = self._previous_document() if self._views and '_id' not in self._modified_vars else None
+            try: 
+                with _profiled(type(self).__name__, 'update') as details:
+                    yield self._db.update_one({'_id': self._data['_id']}, update, upsert='_id' in self._modified_vars)
+                    if profiler: details.update(documents=1, nbytes=len(bson.encode(update)))
+                self._modified_vars.clear()
+                self._identity_map.put(self._data['_id'], self)
+                self._written()
+                yield from self._view_steps([(before, self._data)])
+                if verbose: print(f'updated => {format(update)}\n')
+            except DuplicateKeyError: 
+                print(f'DuplicateKeyError when updating {format(self._data)}\n')
+        else:
+            try:
+                # get the coordinates for the location_index IF the class has the location_var in its ._data (if an attribute flagged as location_index has been defined / passed in the constructor) 
+                if self._needs_location():
+                    self._data[self._location_var] = yield self._locate(self._data[self._location_var[0:-4]])
+                with _profiled(type(self).__name__, 'insert') as details:
+                    yield self._db.insert_one(self._data)
+                    if profiler: details.update(documents=1, nbytes=len(bson.encode(self._data)))
+                self._modified_vars.clear()
+                self._identity_map.put(self._data['_id'], self)
+                self._written()
+                yield from self._view_steps([(None, self._data)])
+                if verbose: print(f'inserted => {format(self._data)}\n')
+            except DuplicateKeyError: 
+                print(f'DuplicateKeyError when inserting {format(self._data)}\n')
+
+
+    @classmethod
+    def save_many(cls, instances: list[Self], batch_size: int = 1000, geocode_workers: int = 8, insert: bool = False) -> dict[str, Any]:
+        """
+        Saves many instances with unordered bulk writes instead of one
+        round trip per instance. New instances get their '_id' assigned.
+
+        Locations are resolved first, concurrently and through the shared
+        geocoder rate limit, so only distinct, uncached addresses cost time.
+
+        Parameters
+        ----------
+        instances : list[Self]
+            Instances to insert (no '_id') or update (with '_id'). Those built
+            by hand with an '_id' write every field given and are inserted
+            if their document doesn't exist
+        batch_size : int
+            Maximum number of operations per bulk_write
+        geocode_workers : int
+            Threads resolving addresses
+        insert : bool
+            Insert every instance, also those that already have an '_id'
+            (e.g. documents exported from another database)
+
+        Returns
+        -------
+        dict[str, Any]
+            'inserted' and 'updated' counts and 'errors', a list of
+            (instance, message) for the documents that could not be written
+        """
+        return _run(cls._save_many_steps(instances, batch_size, insert, geocode_workers))
+
+
+    @classmethod
+    def _save_many_steps(cls, instances: list[Self], batch_size: int, insert: bool, geocode_workers: int = 8) -> Generator:
+        points = yield cls._geocode(instances, insert, geocode_workers)
+        if cls._views:
+            for instance in instances:
+                yield from instance._load_steps() # the views need the whole documents
+            if not insert:
+                yield from cls._adopt_steps(instances)
+        result = {'inserted': 0, 'updated': 0, 'errors': []}
+        operations, targets, assigned = cls._bulk_operations(instances, points, result, insert)
+        yield from cls._bulk_write_steps(operations, targets, assigned, result, batch_size)
+        changes = cls._view_changes(operations, targets, result)
+        cls._bulk_done(targets, result)
+        yield from cls._view_steps(changes)
+        return result
+
+
+    @classmethod
+    def _geocode(cls, instances: list[Self], insert: bool = False, workers: int = 8) -> dict[str, Point | Exception]:
+        # geocode stage: one lookup per distinct address
+        points = {}
+        def resolve(address):
+            try: points[address] = getLocationPoint(address)
+            except ValueError as e: points[address] = e
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(resolve, cls._pending_addresses(instances, insert)))
+        return points
+
+
+    @classmethod
+    def _bulk_write_steps(cls, operations: list, targets: list[Self], assigned: set[int], result: dict[str, Any], batch_size: int = 1000,
+                          session: ClientSession | None = None) -> Generator:
+        # inside a transaction (session given) a failed write must abort it, so it is raised
+        for start in range(0, len(operations), batch_size):
+            try:
+                with _profiled(cls.__name__, 'bulk_write') as details:
+                    details['documents'] = len(operations[start:start + batch_size])
+                    bulk = yield cls._db.bulk_write(operations[start:start + batch_size], ordered=False, session=session)
+                result['inserted'] += bulk.inserted_count + bulk.upserted_count
+                result['updated'] += bulk.matched_count
+            except BulkWriteError as e:
+                if session is not None:
+                    raise
+                cls._bulk_errors(e, targets, assigned, start, result)
+
+
+    @classmethod
+    def _pending_addresses(cls, instances: list[Self], insert: bool = False) -> set[str]:
+        return {instance._data[cls._location_var[0:-4]] for instance in instances if (insert or '_id' not in instance._data) and instance._needs_location()}
+
+
+    @classmethod
+    def _bulk_operations(cls, instances: list[Self], points: dict[str, Point | Exception], result: dict[str, Any],
+                         insert: bool = False) -> tuple[list, list[Self], set[int]]:
+        # builds one write per instance, targets[i] is the instance written by operations[i].
+        # assigned has the python ids of the instances that got a new '_id' here
+        operations, targets, assigned = [], [], set()
+        for instance in instances:
+            if '_id' in instance._data and not insert:
+                update = instance._update_document()
+                if update is None:
+                    continue
+                operations.append(UpdateOne({'_id': instance._data['_id']}, update, upsert='_id' in instance._modified_vars))
+            else:
+                if instance._needs_location():
+                    point = points[instance._data[cls._location_var[0:-4]]]
+                    if isinstance(point, Exception):
+                        result['errors'].append((instance, str(point)))
+                        continue
+                    instance._data[cls._location_var] = point
+                if '_id' not in instance._data:
+                    instance._data['_id'] = ObjectId()
+                    assigned.add(id(instance))
+                operations.append(InsertOne(instance._data))
+            targets.append(instance)
+        return operations, targets, assigned
+
+
+    @staticmethod
+    def _bulk_errors(e: BulkWriteError, targets: list[Self], assigned: set[int], start: int, result: dict[str, Any]) -> None:
+        result['inserted'] += e.details['nInserted'] + e.details['nUpserted']
+        result['updated'] += e.details['nMatched']
+        for error in e.details['writeErrors']:
+            instance = targets[start + error['index']]
+            if id(instance) in assigned:
+                del instance._data['_id'] # it was not inserted, keep it new
+            result['errors'].append((instance, error['errmsg']))
+
+
+    @classmethod
+    def _bulk_done(cls, targets: list[Self], result: dict[str, Any]) -> dict[str, Any]:
+        if result['inserted'] or result['updated']:
+            cls._written()
+        failed = {id(instance) for instance, _ in result['errors']}
+        for instance in targets:
+            if id(instance) not in failed:
+                instance._modified_vars.clear()
+                cls._identity_map.put(instance._data['_id'], instance)
+
+        if verbose: print(f'bulk saved {cls.__name__} => inserted: {result["inserted"]}, updated: {result["updated"]}, errors: {len(result["errors"])}\n')
+        return result
+
+
+    @classmethod
+    def insert_many(cls, documents: list[dict], **kwargs) -> tuple[list[Self], dict[str, Any]]:
+        """
+        Builds instances from plain documents and inserts them with save_many,
+        keeping the '_id' of the documents that have one.
+
+        Returns
+        -------
+        tuple[list[Self], dict[str, Any]]
+            The created instances and the save_many report
+        """
+        instances = [cls(**document) for document in documents]
+        return instances, cls.save_many(instances, insert=True, **kwargs)
+
+
+    def delete(self) -> None:
+        """
+        Deletes the document by its '_id', applying the on_delete policies
+        of the references to it (see delete_many). Unsaved instances have
+        nothing to delete.
+        """
+        unit = _active_session.get()
+        if unit is not None:
+            unit.delete(self)
+            return
+        _run(self._delete_steps())
+
+
+    def _delete_steps(self) -> Generator:
+        if '_id' not in self._data:
+            return 0
+        if not self._views or '_id' in self._modified_vars: # read as stored by the delete if built by hand
+            return (yield from self._delete_ids_steps([self._data['_id']]))
+        yield from self._load_steps() # the views need the whole document, as stored
+        return (yield from self._delete_ids_steps([self._data['_id']], [self._previous_document()]))
+
+
+    @classmethod
+    def delete_many(cls, filter: dict[str, str | dict]) -> int:
+        """
+        Deletes the documents matching the filter and applies the on_delete
+        policy of every reference to them declared in the models file:
+
+        - restrict: nothing is deleted if a document references one of them,
+          a ValueError is raised instead
+        - nullify: the references are set to None (removed from arrays of ids)
+        - cascade: the referencing documents are deleted too, with their own
+          policies applied in turn
+
+        Every policy costs one update_many or delete_many per referencing
+        path with $in of the ids (per delete_batch_size of them), which the
+        index on the path answers, not a write per referencing document.
+        Without a session transaction, a failure can leave part of it done.
+
+        Returns
+        -------
+        int
+            Documents of this model deleted
+        """
+        return _run(cls._delete_many_steps(filter))
+
+
+    @classmethod
+    def _delete_many_steps(cls, filter: dict[str, str | dict]) -> Generator:
+        if not cls._referencing() and not cls._views:
+            with _profiled(cls.__name__, 'delete') as details:
+                details['documents'] = (yield cls._db.delete_many(filter)).deleted_count
+            cls._identity_map.clear() # the ids are unknown
+            cls._written()
+            return details['documents']
+        docs = yield _All(cls._db.find(filter, {'_id': 1}))
+        return (yield from cls._delete_ids_steps([doc['_id'] for doc in docs]))
+
+
+    @classmethod
+    def _referencing(cls) -> list[tuple[type['Model'], str, str]]:
+        # (model, path, policy) of the references to this model with an on_delete policy
+        return [(model, path, policy) for model in _models.values() for path, policy in model._on_delete.items()
+                if model._model(model._references[path]) is cls]
+
+
+    @classmethod
+    def _delete_ids_steps(cls, ids: list, documents: list[dict] | None = None, session: ClientSession | None = None) -> Generator:
+        # deletes by '_id' applying the policies, documents are the stored ones of cls if the caller has them. Returns how many
+        plan = yield from _delete_plan_steps({cls: ids}, session)
+        return (yield from _delete_plan_write_steps(plan, {cls}, {(cls, doc['_id']): doc for doc in documents or []}, session))
+
+
+    @classmethod
+    def _adopt_steps(cls, instances: list[Self], session: ClientSession | None = None) -> Generator:
+        """
+        Reads the stored documents of the instances built by hand with an
+        '_id', which don't know what the views last saw of them. The fields
+        they weren't given are taken from it and the given ones diffed
+        against it. Those without a stored document stay upserts.
+        """
+        built = {instance._data['_id']: instance for instance in instances if '_id' in instance._modified_vars}
+        if not built:
+            return
+        for doc in (yield _All(cls._db.find({'_id': {'$in': list(built)}}, session=session))):
+            instance = built[doc['_id']]
+            object.__setattr__(instance, '_modified_vars', {name: doc.get(name, _MISSING) for name in instance._modified_vars if name != '_id'})
+            object.__setattr__(instance, '_data', {**doc, **instance._data})
+
+
+    def _previous_document(self) -> dict:
+        # the document as stored before the pending changes, what the views last saw of it
+        self._load_all()
+        document = dict(self._data)
+        for name, value in self._modified_vars.items():
+            if value is _MISSING:
+                document.pop(name, None)
+            else:
+                document[name] = value.value() if type(value) is _Snapshot else value
+        return document
+
+
+    @classmethod
+    def _view_changes(cls, operations: list, targets: list[Self], result: dict[str, Any]) -> list[tuple[dict | None, dict]]:
+        # (before, after) of every document a bulk write stored, taken before _bulk_done forgets the changes
+        if not cls._views:
+            return []
+        failed = {id(instance) for instance, _ in result['errors']}
+        return [(None if isinstance(operation, InsertOne) or '_id' in instance._modified_vars else instance._previous_document(), instance._data)
+                for operation, instance in zip(operations, targets) if id(instance) not in failed]
+
+
+    @classmethod
+    def _view_writes(cls, changes: list[tuple[dict | None, dict | None]]) -> dict[str, list]:
+        """
+        Writes bringing the views up to date with some stored documents, given
+        as (before, after) with None for a new or a deleted document. The
+        deltas of a grouped view are summed per group key first, so a bulk
+        save costs one $inc upsert per group touched, not per document.
+        """
+        writes = {}
+        for name, view in cls._views.items():
+            if view.get('copy'):
+                operations = [operation for before, after in changes if (operation := _copy_write(view, before, after)) is not None]
+            else:
+                deltas = {}
+                for before, after in changes:
+                    for sign, document in ((1, after), (-1, before)):
+                        for key, row in _view_rows(view, document).items():
+                            delta = deltas.setdefault(key, {})
+                            for field, amount in row.items():
+                                delta[field] = delta.get(field, 0) + sign * amount
+                operations = []
+                for key, delta in deltas.items():
+                    delta = {field: amount for field, amount in delta.items() if amount}
+                    if delta:
+                        operations.append(UpdateOne({'_id': key}, {'$inc': delta}, upsert=True))
+                        if delta.get(view.get('count'), 0) < 0: # groups left empty are removed
+                            operations.append(DeleteOne({'_id': key, view['count']: {'$lte': 0}}))
+            if operations:
+                writes[name] = operations
+        return writes
+
+
+    @classmethod
+    def _view_steps(cls, changes: list[tuple[dict | None, dict | None]], session: ClientSession | None = None) -> Generator:
+        # one ordered bulk_write per view touched by the changes
+        if not cls._views:
+            return
+        for name, operations in cls._view_writes(changes).items():
+            with _profiled(cls.__name__, 'view') as details:
+                details['documents'] = len(operations)
+                yield cls._db.database[name].bulk_write(operations, ordered=True, session=session)
+
+
+    @classmethod
+    def view(cls, name: str, key: Any = _MISSING) -> dict | list[dict] | None:
+        """
+        Reads a view declared in the models file. Views are collections kept
+        up to date by every write of the ODM, so reading an aggregate is a
+        lookup by '_id' instead of running its pipeline.
+
+            views:
+              studies_per_company:          # one document per company
+                group_by: company
+                count: people               # documents in the group
+                size: {studies: education}  # sum of the number of values at the path
+                sum: {}                     # sum of the numbers at the path
+              graduates:                    # documents matching the filter
+                copy: true
+                match: {education.year_graduated: {$gte: 2017}}
+                fields: [name, email]       # all of them by default
+
+        Writes made outside the ODM, or lost between a write and its view
+        update, make views drift: run rebuild_views periodically.
+
+        Parameters
+        ----------
+        name : str
+            Name of the view (and of its collection)
+        key : Any
+            Group key (or '_id' of a copied document) to read, all of them by default
+
+        Returns
+        -------
+        dict | list[dict] | None
+            The document of the key, None if there is none, or every document of the view
+        """
+        return _run(cls._view_read_steps(name, key))
+
+
+    @classmethod
+    def _view_read_steps(cls, name: str, key: Any) -> Generator:
+        if name not in cls._views:
+            raise ValueError(f'\'{name}\' is not a view of {cls.__name__}')
+        if key is _MISSING:
+            return (yield _All(cls._db.database[name].find()))
+        return (yield cls._db.database[name].find_one({'_id': key}))
+
+
+    @classmethod
+    def rebuild_views(cls, *names: str) -> None:
+        """
+        Recomputes views (all of the model by default) from the whole
+        collection with an aggregation whose $out replaces each view at once.
+        """
+        _run(cls._rebuild_steps(names))
+
+
+    @classmethod
+    def _rebuild_steps(cls, names: tuple[str, ...]) -> Generator:
+        for name in names or cls._views:
+            if name not in cls._views:
+                raise ValueError(f'\'{name}\' is not a view of {cls.__name__}')
+            with _profiled(cls.__name__, 'rebuild_view'):
+                yield cls._db.aggregate(_view_pipeline(name, cls._views[name]))
+            if verbose: print(f'rebuilt view {name} of {cls.__name__}\n')
+
+
+    @classmethod
+    def find(cls, filter: dict[str, str | dict], batch_size: int | None = None, raw: bool = False, fields: list[str] | None = None) -> Any:
+        """
+        Returns a ModelCursor over the documents matching the filter.
+
+        Parameters
+        ----------
+        filter : dict
+            Query filter
+        batch_size : int | None
+            Documents per server round trip, also the size of iter_batches lists
+        raw : bool
+            Read documents as RawBSONDocument, so every field is only decoded
+            when it is accessed. Instances are converted to dicts on write.
+        fields : list[str] | None
+            Only read these attributes (and '_id'). Reading another one
+            fetches it for every instance of the same batch with one query,
+            and saves only write the fields changed, so the ones never
+            loaded are kept as they are in the database.
+        """
+        plan = _plan(cls._db.find(filter).explain()) if profiler and profiler.sample_explain() else None
+        return ModelCursor(cls, cls._cursor(filter, batch_size, raw, fields), batch_size, plan, filter, fields)
+
+
+    @classmethod
+    def _cursor(cls, filter: dict, batch_size: int | None, raw: bool, fields: list[str] | None) -> Cursor | AsyncCursor:
+        collection = cls._db
+        if raw:
+            collection = collection.with_options(codec_options=CodecOptions(document_class=RawBSONDocument))
+        cursor = collection.find(filter, cls._projection(fields))
+        if batch_size:
+            cursor.batch_size(batch_size)
+        return cursor
+
+
+    @classmethod
+    def _projection(cls, fields: list[str] | None) -> dict[str, int] | None:
+        if fields is None:
+            return None
+        unknown = set(fields) - cls._allowed_vars - {'_id'}
+        if unknown:
+            raise AttributeError(f'\'{unknown.pop()}\' not allowed in {cls.__name__}')
+        return dict.fromkeys(fields, 1)
+
+
+    @classmethod
+    def _near_pipeline(cls, point: dict, max_distance: float | None, min_distance: float | None, filter: dict | None,
+                       limit: int | None, after: str | None) -> tuple[list[dict], tuple[float, list]]:
+        # the $geoNear pipeline and the (distance, ids) position it resumes from
+        stage = {'near': point, 'key': cls._location_var, 'distanceField': _DISTANCE_FIELD, 'spherical': True}
+        query = dict(filter or {})
+        position = (min_distance or 0.0, [])
+        if after is not None:
+            # minDistance is inclusive: skip the ids already returned at the last distance
+            token = _decode_token(after)
+            position = (max(token['distance'], min_distance or 0.0), token['ids'])
+            query = {'$and': [query, {'_id': {'$nin': token['ids']}}]} if query else {'_id': {'$nin': token['ids']}}
+        if query:
+            stage['query'] = query
+        if max_distance is not None:
+            stage['maxDistance'] = max_distance
+        if position[0]:
+            stage['minDistance'] = position[0]
+        pipeline = [{'$geoNear': stage}]
+        if limit:
+            pipeline.append({'$limit': limit})
+        return pipeline, position
+
+
+    @classmethod
+    def near(cls, point: Any, max_distance: float | None = None, min_distance: float | None = None, filter: dict | None = None,
+             limit: int | None = None, after: str | None = None, batch_size: int | None = None) -> 'NearCursor':
+        """
+        Returns the documents nearest to point first, using the 2dsphere index
+        of the location attribute. The distance (meters) of every result is
+        in its meta()['distance'].
+
+        Parameters
+        ----------
+        point : Point | dict | tuple | str
+            GeoJSON point, (longitude, latitude) or an address to geocode
+        max_distance, min_distance : float | None
+            Meters from point
+        filter : dict | None
+            Query the documents must also match
+        limit : int | None
+            Maximum number of results, e.g. a page
+        after : str | None
+            NearCursor.next_token() of a previous query, to continue after its
+            last result instead of starting again from the nearest one
+        batch_size : int | None
+            Documents per server batch
+
+        Returns
+        -------
+        NearCursor
+            ModelCursor whose next_token() resumes after the last result read
+        """
+        pipeline, position = cls._near_pipeline(_geometry(point), max_distance, min_distance, filter, limit, after)
+        cursor = cls._db.aggregate(pipeline, batchSize=batch_size) if batch_size else cls._db.aggregate(pipeline)
+        return NearCursor(cls, cursor, batch_size, position)
+
+
+    @classmethod
+    def _within_filter(cls, shape: dict | list, filter: dict | None) -> dict:
+        if isinstance(shape, list):
+            ring = [list(coordinates) for coordinates in shape]
+            if ring[0] != ring[-1]:
+                ring.append(ring[0]) # GeoJSON rings are closed
+            shape = {'type': 'Polygon', 'coordinates': [ring]}
+        return {**(filter or {}), cls._location_var: {'$geoWithin': {'$geometry': dict(shape)}}}
+
+
+    @classmethod
+    def within(cls, shape: dict | list, filter: dict | None = None, batch_size: int | None = None) -> 'ModelCursor':
+        """
+        Returns the documents located inside shape, using the 2dsphere index.
+
+        Parameters
+        ----------
+        shape : dict | list
+            A circle as {'center': point, 'radius': meters} (any point near
+            accepts), which is a near query so results have their distance;
+            a GeoJSON Polygon or MultiPolygon; or a list of (longitude,
+            latitude) vertices of a polygon
+        filter : dict | None
+            Query the documents must also match
+        batch_size : int | None
+            Documents per server batch
+        """
+        if isinstance(shape, dict) and 'center' in shape:
+            return cls.near(shape['center'], max_distance=shape['radius'], filter=filter, batch_size=batch_size)
+        return cls.find(cls._within_filter(shape, filter), batch_size)
+
+
+    @classmethod
+    def search(cls, text: str, fields: list[str] | None = None, limit: int | None = None, filter: dict | None = None,
+               project: list[str] | None = None) -> list[Self] | list[dict]:
+        """
+        Full text search ranked by relevance, best first, with the score of
+        every model in its meta()['score'].
+
+        Uses the text index of the collection (declared in the models file
+        as an index with 'text' keys) when it covers exactly the fields to
+        search. Otherwise, or if the collection has no text index, the fields
+        are searched in a TextSearchIndex built from the collection, which is
+        kept in memory and rebuilt after writes through the ODM. Its results
+        are read best first, search_batch_size ids per query, until limit of
+        them match the filter.
+
+        Parameters
+        ----------
+        text : str
+            Terms, "phrases" and -excluded terms, as in $text
+        fields : list[str] | None
+            Fields to search, those of the text index by default
+        limit : int | None
+            Maximum number of results
+        filter : dict | None
+            Query the results must also match
+        project : list[str] | None
+            Return only these fields, as dicts with their 'score', instead of models
+
+        Returns
+        -------
+        list[Self] | list[dict]
+            Matching models, or projected documents, best first
+        """
+        return _run(cls._search_steps(text, fields, limit, filter, project))
+
+
+    @classmethod
+    def _search_steps(cls, text: str, fields: list[str] | None, limit: int | None, filter: dict | None,
+                      project: list[str] | None) -> Generator:
+        if cls._text_index is _MISSING:
+            cls._text_index = _listed_text_index((yield _All(cls._db.list_indexes())))
+        text_index = cls._text_index
+        if text_index is not None and (fields is None or set(fields) == text_index.keys()):
+            try: return (yield from cls._text_search_steps(text, limit, filter, project))
+            except OperationFailure: # e.g. the index was dropped since it was checked, the next search checks again
+                cls._text_index = _MISSING
+        weights = cls._search_weights(fields, text_index)
+        with _profiled(cls.__name__, 'search') as details:
+            key = tuple(sorted(weights.items()))
+            version, index = cls._search_indexes.get(key, (None, None))
+            if version != cls._write_version:
+                index = TextSearchIndex(weights)
+                yield _All(cls._db.find({}, {field: 1 for field in weights}), lambda doc: index.add(doc['_id'], doc))
+                cls._search_indexes[key] = (cls._write_version, index)
+            ranked = index.search(text)
+            if filter is None and limit:
+                ranked = ranked[:limit]
+            results, projection = [], {field: 1 for field in project} if project else None
+            for chunk in _chunks(ranked, search_batch_size):
+                found = yield _All(cls._db.find({**(filter or {}), '_id': {'$in': [id for id, _ in chunk]}}, projection))
+                docs = {doc['_id']: doc for doc in found}
+                results += [cls._search_result(docs[id], score, project) for id, score in chunk if id in docs]
+                if limit and len(results) >= limit:
+                    break
+            results = results[:limit]
+            details['documents'] = len(results)
+        return results
+
+
+    @classmethod
+    def _search_weights(cls, fields: list[str] | None, text_index: dict[str, int] | None) -> dict[str, int]:
+        # fallback fields: the given ones, weighted as declared if they are those of the text index
+        declared = cls._text_declared or text_index
+        if fields is None:
+            if declared is None:
+                raise ValueError(f'{cls.__name__} has no text index, the fields to search must be given')
+            return declared
+        if declared is not None and set(fields) == declared.keys():
+            return declared
+        return {field: 1 for field in fields}
+
+
+    @classmethod
+    def _text_search_steps(cls, text: str, limit: int | None, filter: dict | None, project: list[str] | None) -> Generator:
+        projection = {_SCORE_FIELD: {'$meta': 'textScore'}} | ({field: 1 for field in project} if project else {})
+        with _profiled(cls.__name__, 'search') as details:
+            cursor = cls._db.find({**(filter or {}), '$text': {'$search': text}}, projection).sort([(_SCORE_FIELD, {'$meta': 'textScore'})])
+            if limit:
+                cursor = cursor.limit(limit)
+            docs = yield _All(cursor)
+            results = [cls._search_result(doc, doc.pop(_SCORE_FIELD), project) for doc in docs]
+            details['documents'] = len(results)
+        return results
+
+
+    @classmethod
+    def _search_result(cls, doc: dict, score: float, project: list[str] | None) -> Self | dict:
+        if project:
+            doc['score'] = score
+            return doc
+        instance = cls._from_doc(doc)
+        object.__setattr__(instance, '_meta', {'score': score})
+        return instance
+
+    @classmethod
+    def _written(cls) -> None:
+        cls._write_version = next(_write_versions)
+
+
+    @classmethod
+    def aggregate(cls, pipeline: list[dict], cache: bool = False, optimize: bool = False) -> CommandCursor | _CachedCursor:
+        """
+        Runs an aggregate query on the collection of the model, optionally
+        rewritten first and with its result cached.
+
+        Parameters
+        ----------
+        pipeline : list[dict]
+            List of stages in the aggregate query
+        cache : bool
+            Keep the result in aggregate_cache until one of the collections
+            the pipeline reads is written through the ODM. Pipelines with
+            $out/$merge or reading collections outside the ODM always run.
+        optimize : bool
+            Run the pipeline rewritten by _optimize_pipeline, e.g. filtering
+            people by the ids of the companies a later $match selects instead
+            of joining every person first. See explain_optimization.
+
+        Returns
+        -------
+        pymongo.command_cursor.CommandCursor | _CachedCursor
+            cursor over the query result, a _CachedCursor over the cached
+            documents if cache is set, iterated the same way
+        """
+        result = _run(cls._aggregate_steps(pipeline, cache, optimize))
+        return _CachedCursor(result) if cache else result
+
+
+    @classmethod
+    def _aggregate_steps(cls, pipeline: list[dict], cache: bool, optimize: bool) -> Generator:
+        key = _aggregate_cache_key(cls, pipeline) if cache else None
+        if key is not None:
+            cached = aggregate_cache.get(key)
+            if cached is not _MISSING:
+                return [bson.decode(doc) for doc in cached]
+        if optimize:
+            pipeline, _ = yield from cls._optimize_steps(pipeline)
+        with _profiled(cls.__name__, 'aggregate') as details:
+            if cache:
+                result = yield _All(cls._db.aggregate(pipeline))
+                details['documents'] = len(result)
+            else:
+                result = yield cls._db.aggregate(pipeline)
+            if profiler and profiler.sample_explain():
+                details['plan'] = _plan((yield cls._db.database.command('aggregate', cls._db.name, pipeline=pipeline, explain=True)))
+        _bump_out_target(cls, pipeline)
+        if key is not None:
+            aggregate_cache.put(key, tuple(bson.encode(doc) for doc in result))
+        return result
+
+
+    @classmethod
+    def _optimize_steps(cls, pipeline: list[dict]) -> Generator:
+        # one query per pushed down filter, on the (usually small) foreign side
+        database = cls._db.database
+        foreign_keys = {}
+        for i, spec, filters in _lookup_pushdowns(pipeline):
+            foreign_keys[i] = []
+            for foreign_filter in filters:
+                cursor = database[spec['from']].find(foreign_filter, {spec['foreignField']: 1}).limit(optimizer_max_ids + 1)
+                foreign_keys[i].append(_foreign_keys((yield _All(cursor)), spec['foreignField']))
+        return _optimize_pipeline(pipeline, foreign_keys)
+
+
+    @classmethod
+    def explain_optimization(cls, pipeline: list[dict]) -> dict:
+        """
+        Explains the pipeline before and after _optimize_pipeline, to verify
+        each rewrite pays off.
+
+        Returns
+        -------
+        dict
+            'pipeline' (rewritten), 'rewrites' (descriptions) and 'before' and
+            'after' with the plan (COLLSCAN, IXSCAN...) and documents examined
+        """
+        return _run(cls._explain_steps(pipeline))
+
+
+    @classmethod
+    def _explain_steps(cls, pipeline: list[dict]) -> Generator:
+        optimized, rewrites = yield from cls._optimize_steps(pipeline)
+        result = {'pipeline': optimized, 'rewrites': rewrites}
+        for name, stages in (('before', pipeline), ('after', optimized)):
+            explain = yield cls._db.database.command('explain', {'aggregate': cls._db.name, 'pipeline': stages, 'cursor': {}},
+                                                     verbosity='executionStats')
+            result[name] = {'plan': _plan(explain), 'docs_examined': _docs_examined(explain)}
+        if verbose:
+            for rewrite in rewrites:
+                print(f'{cls.__name__}: {rewrite}')
+            print(f"{cls.__name__}: {result['before']['docs_examined']} => {result['after']['docs_examined']} documents examined")
+        return result
+
+
+    @classmethod
+    def find_by_id(cls, id: str | ObjectId) -> Self | None:
+        """
+        Searches for a document by its ID using cache and returns it.
+        If not found, returns None.
+
+        The cache is an identity map: while a document stays cached every
+        call returns the same instance, which save() keeps up to date and
+        delete() removes.
+
+        Parameters
+        ----------
+        id : str | ObjectId
+            ID of the document to search
+
+        Returns
+        -------
+        Self | None
+            Model of the found document or None if not found
+        """
+        return _run(cls._find_by_id_steps(id))
+
+
+    @classmethod
+    def _find_by_id_steps(cls, id: str | ObjectId) -> Generator:
+        id = ObjectId(id)
+        instance = cls._identity_map.get(id)
+        if instance is not _MISSING:
+            return instance
+        with _profiled(cls.__name__, 'find') as details:
+            res = yield cls._db.find_one({ '_id': id })
+            details['documents'] = int(res is not None)
+        if res is None: return None
+        instance = cls._from_doc(res)
+        cls._identity_map.put(id, instance)
+        return instance
+
+
+    @classmethod
+    def find_by_ids(cls, ids: list[ObjectId]) -> dict[ObjectId, Self]:
+        """
+        find_by_id for many ids: those not in the identity map are read with
+        a single $in query. Ids not found are left out of the result.
+        """
+        return _run(cls._find_by_ids_steps(ids))
+
+
+    @classmethod
+    def _find_by_ids_steps(cls, ids: list[ObjectId]) -> Generator:
+        found, missing = {}, []
+        for id in ids:
+            instance = cls._identity_map.get(id)
+            if instance is _MISSING: missing.append(id)
+            else: found[id] = instance
+        if missing:
+            def hydrate(doc):
+                found[doc['_id']] = instance = cls._from_doc(doc)
+                cls._identity_map.put(doc['_id'], instance)
+            with _profiled(cls.__name__, 'find') as details:
+                yield _All(cls._db.find({'_id': {'$in': missing}}), hydrate)
+                details['documents'] = len(found)
+        return found
+
+
+    @classmethod
+    def _model(cls, name: str) -> type['Model'] | None:
+        # model of the collection name in the same database, async if cls is
+        return _models.get((cls._db.database.name, name, cls._asynchronous))
+
+
+    @classmethod
+    def _reference(cls, path: str) -> type['Model']:
+        if path not in cls._references:
+            raise ValueError(f'\'{path}\' is not a reference of {cls.__name__}')
+        target = cls._model(cls._references[path])
+        if target is None:
+            raise ValueError(f'{cls._references[path]}, referenced by {cls.__name__}.{path}, has not been initialized')
+        return target
+
+
+    def _ref_state(self, path: str) -> tuple[list, bool, Any]:
+        # current ids at path and the instances resolved for them, if they didn't change since
+        if path.split('.')[0] not in self._data:
+            self._load_missing(path.split('.')[0])
+        values, many = _path_values(self._data, path)
+        try: refs = object.__getattribute__(self, '_refs')
+        except AttributeError:
+            refs = {}
+            object.__setattr__(self, '_refs', refs)
+        cached = refs.get(path)
+        return values, many, cached[1] if cached is not None and cached[0] == values else _MISSING
+
+
+    def _set_ref(self, path: str, values: list, many: bool, found: dict[ObjectId, 'Model']) -> Any:
+        resolved = [found.get(value) for value in values] if many else found.get(values[0]) if values else None
+        self._refs[path] = (values, resolved)
+        return resolved
+
+
+    def meta(self) -> dict[str, Any]:
+        """
+        Metadata of the query that returned the instance, e.g. the 'distance'
+        in meters of near results. Empty for other instances.
+        """
+        try: return object.__getattribute__(self, '_meta')
+        except AttributeError: return {}
+
+
+    def ref(self, path: str) -> Any:
+        """
+        Returns the instance referenced by a declared reference path, or the
+        list of them if the path goes through an array (None for dangling
+        ids). They are kept until the ids at the path change, and cursors can
+        load them for a whole batch at once with ModelCursor.prefetch.
+
+        Parameters
+        ----------
+        path : str
+            Reference path declared in the models file, e.g. 'company'
+        """
+        return _run(self._ref_steps(path))
+
+
+    def _ref_steps(self, path: str) -> Generator:
+        target = self._reference(path)
+        values, many, resolved = self._ref_state(path)
+        if resolved is _MISSING:
+            resolved = self._set_ref(path, values, many, (yield from target._find_by_ids_steps(values)))
+        return resolved
+
+
+    @classmethod
+    def _prefetch(cls, instances: list[Self], paths: tuple[str, ...]) -> None:
+        _run(cls._prefetch_steps(instances, paths))
+
+
+    @classmethod
+    def _prefetch_steps(cls, instances: list[Self], paths: tuple[str, ...]) -> Generator:
+        # one $in query per path for the ids of every instance
+        for path in paths:
+            target = cls._reference(path)
+            states = [(instance, *instance._ref_state(path)) for instance in instances]
+            found = yield from target._find_by_ids_steps(list(dict.fromkeys(id for _, values, _, _ in states for id in values)))
+            for instance, values, many, _ in states:
+                instance._set_ref(path, values, many, found)
+
+
+    @classmethod
+    def profile_summary(cls) -> dict[str, dict[str, Any]]:
+        """
+        Returns the profiler statistics of this model per operation, empty if profiling is off.
+        """
+        return profiler.summary().get(cls.__name__, {}) if profiler else {}
+
+
+    @classmethod
+    def cache_stats(cls) -> dict[str, int]:
+        """
+        Returns the size and the hit, miss and eviction counters of the find_by_id cache.
+        """
+        return cls._identity_map.stats()
+
+
+    @classmethod
+    def init_class(cls, db_collection: Collection, indexes: dict[str, str], required_vars: set[str], admissible_vars: set[str],
+                   cache_size: int = 1024, cache_ttl: float | None = None, manage_indexes: bool = True,
+                   references: dict[str, str | dict] | None = None, views: dict[str, dict] | None = None) -> None:
+        _run(cls._init_steps(db_collection, indexes, required_vars, admissible_vars, cache_size, cache_ttl, manage_indexes, references, views))
+
+
+    @classmethod
+    def _init_steps(cls, db_collection: Collection | AsyncCollection, indexes: dict[str, str], required_vars: set[str], admissible_vars: set[str],
+                    cache_size: int, cache_ttl: float | None, manage_indexes: bool, references: dict[str, str | dict] | None,
+                    views: dict[str, dict] | None) -> Generator:
+        cls._db = db_collection
+        cls._references = {path: target['model'] if isinstance(target, dict) else target for path, target in (references or {}).items()}
+        cls._on_delete = {path: target['on_delete'] for path, target in (references or {}).items() if isinstance(target, dict) and target.get('on_delete')}
+        cls._views = dict(views or {})
+        cls._identity_map = LRUCache(cache_size, cache_ttl)
+        cls._write_version = next(_write_versions)
+        _models[cls._db.database.name, cls._db.name, cls._asynchronous] = cls
+        cls._compile(required_vars, admissible_vars, indexes['location_index'])
+        cls._init_search(indexes)
+        if not manage_indexes:
+            cls._index_report = None
+            return
 
+        existing = yield _All(cls._db.list_indexes())
+        to_create, stale = _index_plan(_index_specs(indexes), existing)
+        if to_create:
+            yield cls._db.create_indexes(to_create)
+        else:
+            cls._text_index = _listed_text_index(existing) # already listed, searches don't need to check it
+        cls._report_indexes(to_create, stale)
 
-def initApp(definitions_path: str = "./models.yml", mongodb_uri="mongodb://localhost:27017/", db_name="abd", scope=globals()) -> None:
-    client = MongoClient(mongodb_uri, server_api=ServerApi('1'))
-    db = client[db_name]
-    try:
-        with open(definitions_path) as models_file:
-            for model_name, model_data  in yaml.safe_load(models_file).items():
-                required_vars = model_data['required_vars']
-                admissible_vars = model_data['admissible_vars']
-                indexes = { 
-                    'unique_indexes': model_data['unique_indexes'], 
-                    'regular_indexes': model_data['regular_indexes'], 
-                    'location_index': f'{model_data['location_index']}_loc'
-                }
-                model_class = type(model_name, (Model,), {})
-                model_class.init_class(db.get_collection(model_name), indexes, required_vars, admissible_vars) 
-                scope[model_name] = model_class
-    except FileNotFoundError:
-        print(f'\'{definitions_path}\' not found') 
 
+    @classmethod
+    def _init_search(cls, indexes: dict) -> None:
+        cls._text_declared = next((weights for keys, options in _index_specs(indexes) if (weights := _text_weights(keys, options))), None)
+        cls._text_index = _MISSING
+        cls._search_indexes = {}
 
-class Model:
-    _required_vars: set[str]
-    _admissible_vars: set[str]
-    _location_var: None 
-    _db: Collection
-    _data: dict[str, str | dict] = {} 
 
-    def __init__(self, **kwargs: dict[str, str | dict]):
-        super().__setattr__('_data', {}) # bypass the overriden __setattr__
-        # check for unallowed keys
-        for key in kwargs.keys():
-            if key not in self._required_vars and key not in self._admissible_vars and key != '_id' and key != self._location_var:
-                raise AttributeError(f'\'{key}\' not allowed in {self.__class__.__name__}')
-        self._data.update(kwargs)
+    @classmethod
+    def _report_indexes(cls, created: list[IndexModel], stale: list[str]) -> None:
+        cls._index_report = {'created': [index.document['name'] for index in created], 'stale': stale}
+        if verbose and created:
+            print(f'{cls.__name__}: created indexes {cls._index_report["created"]}')
+        if stale:
+            print(f'{cls.__name__}: indexes not declared in the models file (or with other options): {stale}')
+ 
 
+# unit of work the saves and deletes of the current thread (or task) are collected in
+_active_session: ContextVar['Session | None'] = ContextVar('_active_session', default=None)
 
-    def __setattr__(self, name: str, value: str | dict) -> None:
-        if name not in self._required_vars and name not in self._admissible_vars and name != self._location_var:
-            raise AttributeError(f'\'{name}\' not allowed in {self.__class__.__name__}')
-        else: self._data[name] = value
 
+def _merge_updates(updates: list[dict]) -> dict:
+    """
+    Merges the updates of several instances of one document in order: a
+    later path replaces an earlier one that is the same, a parent or a child.
+    """
+    merged = {}
+    for update in updates:
+        for operator in ('$set', '$unset'):
+            for path, value in update.get(operator, {}).items():
+                for other in [other for other in merged if other == path or other.startswith(f'{path}.') or path.startswith(f'{other}.')]:
+                    del merged[other]
+                merged[path] = (operator, value)
+    result = {}
+    for path, (operator, value) in merged.items():
+        result.setdefault(operator, {})[path] = value
+    return result
 
-    def __getattr__(self, name: str) -> Any:
-        # if name is one of these attributes, get it with its parent's __getattribute__
-        if name in {'_modified_vars', '_required_vars', '_admissible_vars', '_db', '_data', '_location_var'}:
-            return super().__getattribute__(name) 
-        # otherwise get it like this
-        try: return self._data[name]
-        except KeyError: raise AttributeError(f'"{name}" is not a valid attribute for {self.__class__.__name__}')
 
+def _instances(value: Any) -> Generator:
+    # model instances stored in a field (e.g. person.company = company), nested ones too
+    if isinstance(value, Model):
+        yield value
+    elif type(value) is dict:
+        for item in value.values():
+            yield from _instances(item)
+    elif type(value) is list:
+        for item in value:
+            yield from _instances(item)
 
-    def save(self) -> None:
-        if '_id' in self._data:
-            try: 
-                self._db.update_one({'_id': self._data['_id']}, {'$set': self._data})
-                print(f'updated => {format(self._data)}\n')
-            except DuplicateKeyError: 
-                print(f'DuplicateKeyError when updating {format(self._data)}\n')
-        else:
-            try:
-                # get the coordinates for the location_index IF the class has the location_var in its ._data (if an attribute flagged as location_index has been defined / passed in the constructor) 
-                if self._location_var[0:-4] in self._data.keys():
-                    self._data[self._location_var] = getLocationPoint(self._data[self._location_var[0:-4]])
-                self._db.insert_one(self._data)
-                print(f'inserted => {format(self._data)}\n')
-            except DuplicateKeyError: 
-                print(f'DuplicateKeyError when inserting {format(self._data)}\n')
 
+def _replace_instances(value: Any) -> Any:
+    # copy of value with the model instances of _instances replaced by their '_id'
+    if isinstance(value, Model):
+        return value._data['_id']
+    if type(value) is dict:
+        return {key: _replace_instances(item) for key, item in value.items()}
+    if type(value) is list:
+        return [_replace_instances(item) for item in value]
+    return value
 
-    def delete(self) -> None:
-        self._db.delete_one(self._data)
 
+def _dependency_order(models: list[type[Model]]) -> list[type[Model]]:
+    # referenced models first, so their documents exist before the ones pointing to them
+    ordered = []
+    def visit(model):
+        if model in ordered:
+            return
+        ordered.append(None) # placeholder against reference cycles
+        placeholder = len(ordered) - 1
+        for name in model._references.values():
+            target = model._model(name)
+            if target in models and target is not model:
+                visit(target)
+        ordered[placeholder] = model
+    for model in models:
+        visit(model)
+    return [model for model in ordered if model is not None]
 
-    @classmethod
-    def find(cls, filter: dict[str, str | dict]) -> Any:
-        cursor = cls._db.find(filter)
-        return ModelCursor(cls, cursor)
 
-    @classmethod
-    def aggregate(cls, pipeline: list[dict]) -> CommandCursor:
-        """
-        Returns the result of an aggregate query.
-        Nothing needs to be done in this function.
-        It will be used for queries requested
-        in the second project of the practice.
+def _delete_plan_steps(targets: dict[type[Model], list], session: ClientSession | None = None, writes: list[Model] = ()) -> Generator:
+    """
+    Follows the on_delete policies from the ids to delete of every target
+    model: returns the ids to delete per model, cascades included, and the
+    (model, path, ids) references to nullify. Restricted references raise a
+    ValueError here, before anything is written.
 
-        Parameters
-        ----------
-        pipeline : list[dict]
-            List of stages in the aggregate query
+    writes are instances to be written before the deletes, e.g. by a session:
+    the references in their fields count instead of the stored ones.
+    """
+    pending_writes: dict[type[Model], list[Model]] = {}
+    for instance in writes:
+        pending_writes.setdefault(type(instance), []).append(instance)
+    deletes: dict[type[Model], dict] = {}
+    nullify, restrict, pending = [], [], list(targets.items())
+    while pending:
+        model, batch = pending.pop()
+        known = deletes.setdefault(model, {})
+        batch = [id for id in batch if id not in known] # cycles, e.g. a cascade between users
+        if not batch:
+            continue
+        known.update(dict.fromkeys(batch))
+        for source, path, policy in model._referencing():
+            field = path.split('.')[0]
+            replacing = [instance for instance in pending_writes.get(source, []) if field in instance._data or field in instance._modified_vars]
+            for chunk in _chunks(batch, delete_batch_size):
+                query, ids = {path: {'$in': chunk}}, set(chunk)
+                if replacing:
+                    query['_id'] = {'$nin': [instance._data['_id'] for instance in replacing]}
+                local = [instance._data['_id'] for instance in replacing
+                         if any(_contains(ids, value) for value in _path_values(instance._data, path)[0])]
+                if policy == 'restrict':
+                    restrict.append((model, source, path, query, local))
+                elif policy == 'cascade':
+                    docs = yield _All(source._db.find(query, {'_id': 1}, session=session))
+                    pending.append((source, [doc['_id'] for doc in docs] + local))
+                else:
+                    nullify.append((source, path, chunk))
+    # once every document to delete is known, as those deleted together don't restrict each other
+    for model, source, path, query, local in restrict:
+        together = deletes.get(source, {})
+        referencing = next((id for id in local if id not in together), None)
+        if referencing is None and together:
+            query['_id'] = {'$nin': query.get('_id', {}).get('$nin', []) + list(together)}
+        if referencing is None and (doc := (yield source._db.find_one(query, {'_id': 1}, session=session))) is not None:
+            referencing = doc['_id']
+        if referencing is not None:
+            raise ValueError(f'{model.__name__} can\'t be deleted, {source.__name__} {referencing} references it ({path})')
+    return {model: list(known) for model, known in deletes.items()}, nullify
 
-        Returns
-        -------
-        pymongo.command_cursor.CommandCursor
-            pymongo cursor with the query result
-        """
-        return cls._db.aggregate(pipeline)
 
+def _delete_plan_write_steps(plan: tuple[dict[type[Model], list], list[tuple[type[Model], str, list]]], targets: set[type[Model]],
+                             documents: dict[tuple[type[Model], Any], dict], session: ClientSession | None = None) -> Generator:
+    """
+    Writes a plan of _delete_plan_steps, keeping identity maps and views up
+    to date. documents are the stored documents of some of them by (model,
+    '_id'), if the caller has them. Returns how many documents of the target
+    models were deleted.
+    """
+    deletes, nullify = plan
+    for source, path, chunk in nullify:
+        query, ids = {path: {'$in': chunk}}, set(chunk)
+        if not source._views:
+            with _profiled(source.__name__, 'nullify') as details:
+                details['documents'] = (yield source._db.update_many(query, _nullify_update(path, chunk), session=session)).modified_count
+        last = None
+        while source._views: # a page of documents at a time, in '_id' order
+            page = query if last is None else {**query, '_id': {'$gt': last}}
+            before = yield _All(source._db.find(page, session=session).sort('_id', 1).limit(nullify_batch_size))
+            if not before:
+                break
+            with _profiled(source.__name__, 'nullify') as details:
+                update = yield source._db.update_many({'_id': {'$in': [doc['_id'] for doc in before]}}, _nullify_update(path, chunk), session=session)
+                details['documents'] = update.modified_count
+            yield from source._view_steps([(doc, _without_ids(doc, path.split('.'), ids)) for doc in before], session)
+            if len(before) < nullify_batch_size:
+                break
+            last = before[-1]['_id']
+        source._identity_map.clear() # cached instances may hold the ids
+        source._written()
+    deleted = 0
+    for model, batch in reversed(deletes.items()): # cascaded documents first, so none is left dangling
+        for chunk in _chunks(batch, delete_batch_size):
+            query = {'_id': {'$in': chunk}}
+            before = []
+            if model._views:
+                if len(chunk) == 1 and (model, chunk[0]) in documents:
+                    before = [documents[(model, chunk[0])]]
+                else:
+                    before = yield _All(model._db.find(query, session=session))
+            with _profiled(model.__name__, 'delete') as details:
+                details['documents'] = (yield model._db.delete_many(query, session=session)).deleted_count
+            if details['documents'] < len(before):
+                # another writer deleted some of them meanwhile, and which ones is unknown: rebuild_views fixes the views
+                before = []
+            if model in targets:
+                deleted += details['documents']
+            for id in chunk:
+                model._identity_map.pop(id)
+            yield from model._view_steps([(doc, None) for doc in before], session)
+        model._written()
+    if verbose and (len(deletes) > len(targets) or nullify):
+        print(f'deleted {", ".join(model.__name__ for model in targets)} => {", ".join(f"{model.__name__}: {len(batch)}" for model, batch in deletes.items())}, '
+              f'nullified: {", ".join(f"{model.__name__}.{path}" for model, path, _ in nullify) or "none"}\n')
+    return deleted
 
-    @classmethod
-    def find_by_id(cls, id: str) -> Self | None:
+
+class Session:
+    """
+    Unit of work: while it is active (see session()), save() and delete()
+    of Model instances are collected instead of written, and flushed on exit
+    with one bulk_write and one delete_many per collection.
+
+    - saving an instance many times writes it once, with all its changes
+      (and instances of the same document are merged into one update)
+    - new instances get their '_id' before anything is written, and fields
+      holding model instances are stored as their '_id', so a graph of new
+      documents can be saved at once. Referenced models are written first.
+      If the flush fails, the instances not written are left new.
+    - deletes are made by '_id' with the on_delete policies of the references
+      to them (see Model.delete_many), checked before anything is written and
+      with the references the saves of the session will store
+    - with transaction=True everything is written in a transaction (MongoDB
+      needs a replica set for them) and any error aborts it
+
+    Asyncio models write directly, their saves are not collected.
+
+    Attributes
+    ----------
+    transaction : bool
+        Flush inside a transaction
+    batch_size : int
+        Maximum number of operations per bulk_write
+    result : dict[str, Any]
+        'inserted', 'updated' and 'deleted' counts and 'errors' of the flushes
+    """
+    def __init__(self, transaction: bool = False, batch_size: int = 1000):
+        self.transaction = transaction
+        self.batch_size = batch_size
+        self.result = {'inserted': 0, 'updated': 0, 'deleted': 0, 'errors': []}
+        self._saved: dict[int, Model] = {} # python id => instance, in order
+        self._deleted: dict[tuple[type, Any], Model] = {} # (model, '_id') => instance
+        self._token = None
+
+    def add(self, instance: Model) -> None:
         """
-        DO NOT IMPLEMENT UNTIL THE THIRD PROJECT
-        Searches for a document by its ID using cache and returns it.
-        If not found, returns None.
+        Marks a new or changed instance to be saved on flush.
+        """
+        self._saved.setdefault(id(instance), instance)
 
-        Parameters
-        ----------
-        id : str
-            ID of the document to search
+    def delete(self, instance: Model) -> None:
+        """
+        Marks an instance to be deleted on flush. Pending saves of it are
+        dropped, and a new instance is just forgotten.
+        """
+        self._saved.pop(id(instance), None)
+        if '_id' in instance._data:
+            self._deleted[(type(instance), instance._data['_id'])] = instance
 
-        Returns
-        -------
-        Self | None
-            Model of the found document or None if not found
+    def __enter__(self) -> Self:
+        self._token = _active_session.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        _active_session.reset(self._token)
+        if exc_type is None:
+            self.flush()
+
+    def flush(self) -> dict[str, Any]:
         """
-        res =  cls._db.find_one({ '_id': ObjectId(id) })
-        if res: return cls(**res) # this is how you pass kwargs
-        return None
+        Writes the pending saves and deletes, returning self.result.
+        """
+        saved, deleted = list(self._saved.values()), dict(self._deleted)
+        new = {id(instance) for instance in saved if '_id' not in instance._data}
+        # (instance, field, value) of the fields holding instances, stored as their '_id'
+        references = [(instance, name, value) for instance in saved for name, value in instance._data.items()
+                      if next(_instances(value), None) is not None]
+        for instance, name, value in references:
+            for referenced in _instances(value):
+                if '_id' not in referenced._data and id(referenced) not in new:
+                    raise ValueError(f'{type(instance).__name__}.{name} references a new {type(referenced).__name__} '
+                                     'that was not saved, in this session or before it')
+        # addresses are geocoded (network calls, rate limited) before any transaction is started, as in save_many
+        inserts: dict[type[Model], list[Model]] = {}
+        for instance in saved:
+            if id(instance) in new:
+                inserts.setdefault(type(instance), []).append(instance)
+        points = {model: model._geocode(instances, True) for model, instances in inserts.items()}
+        self._saved, self._deleted = {}, {}
+        for instance in saved:
+            if id(instance) in new:
+                instance._data['_id'] = ObjectId()
+        for instance, name, value in references:
+            instance._data[name] = _replace_instances(value)
+        models = _dependency_order(list(dict.fromkeys([type(instance) for instance in saved] + [model for model, _ in deleted])))
+        written = [] # (model, targets, result), finished once everything is written
+        targets = {}
+        for model, key in deleted:
+            targets.setdefault(model, []).append(key)
 
+        def write(session):
+            # the on_delete policies are followed (and restrict checked) before anything is written,
+            # and the documents to delete read whole as stored, for the views
+            plan = _run(_delete_plan_steps(targets, session, saved)) if targets else None
+            documents = {key: instance._previous_document() for key, instance in deleted.items() if key[0]._views and '_id' not in instance._modified_vars}
+            for model in models:
+                result = {'inserted': 0, 'updated': 0, 'errors': []}
+                operations, inserted, _ = model._bulk_operations(inserts.get(model, []), points.get(model, {}), result, True)
+                if model._views:
+                    _run(model._adopt_steps([instance for instance in saved if type(instance) is model and id(instance) not in new], session))
+                updates, updated = self._updates([instance for instance in saved if type(instance) is model and id(instance) not in new])
+                _run(model._bulk_write_steps(operations + updates, inserted + updated, set(), result, self.batch_size, session))
+                _run(model._view_steps(model._view_changes(operations + updates, inserted + updated, result), session))
+                written.append((model, inserted + updated, result))
+            if plan is None:
+                return 0
+            return _run(_delete_plan_write_steps(plan, set(targets), documents, session))
 
-    @classmethod
-    def init_class(cls, db_collection: Collection, indexes: dict[str, str], required_vars: set[str], admissible_vars: set[str]) -> None:
-        cls._db = db_collection
-        cls._required_vars = required_vars
-        cls._admissible_vars = admissible_vars
-        cls._location_var = indexes['location_index']
+        try:
+            if self.transaction and models:
+                with models[0]._db.database.client.start_session() as session, session.start_transaction():
+                    deleted_count = write(session)
+            else:
+                deleted_count = write(None)
+        except Exception:
+            # nothing was committed in a transaction, otherwise the models written before the error were
+            if self.transaction:
+                written = []
+            done = {id(instance) for _, instances, _ in written for instance in instances}
+            for instance in saved:
+                if id(instance) in new and id(instance) not in done:
+                    del instance._data['_id'] # still new
+            for instance, name, value in references:
+                if id(instance) not in done:
+                    instance._data[name] = value
+            self._finish(written, new)
+            raise
+        self.result['deleted'] += deleted_count
+        return self._finish(written, new)
 
-        for index in indexes['unique_indexes']:
-            cls._db.create_index([(index, pymongo.ASCENDING)], unique=True, sparse=True)
+    def _finish(self, written: list[tuple[type[Model], list[Model], dict[str, Any]]], new: set[int]) -> dict[str, Any]:
+        # adds the results of the bulk writes and updates the instances and identity maps after them
+        for model, instances, result in written:
+            for instance, _ in result['errors']:
+                if id(instance) in new:
+                    del instance._data['_id']
+            self.result['inserted'] += result['inserted']
+            self.result['updated'] += result['updated']
+            self.result['errors'] += result['errors']
+            model._bulk_done(instances, result)
+        return self.result
 
-        for index in indexes['regular_indexes']:
-            cls._db.create_index([(index, pymongo.ASCENDING)])
+    @staticmethod
+    def _updates(instances: list[Model]) -> tuple[list[UpdateOne], list[Model]]:
+        # one UpdateOne per document, merging the changes of every instance of it
+        documents: dict[Any, list[Model]] = {}
+        for instance in instances:
+            documents.setdefault(instance._data['_id'], []).append(instance)
+        operations, targets = [], []
+        for id, copies in documents.items():
+            updates = [update for update in (instance._update_document() for instance in copies) if update is not None]
+            if updates:
+                upsert = any('_id' in instance._modified_vars for instance in copies)
+                operations.append(UpdateOne({'_id': id}, updates[0] if len(updates) == 1 else _merge_updates(updates), upsert=upsert))
+                targets.append(copies[-1])
+                for instance in copies[:-1]:
+                    instance._modified_vars.clear()
+        return operations, targets
+
+
+def session(transaction: bool = False, batch_size: int = 1000) -> Session:
+    """
+    Starts a unit of work for the saves and deletes made inside the with
+    block, written together when it ends (nothing is written if it raises):
+
+        with session() as s:
+            company = Company(name='Acme', cif='B1')
+            company.save()
+            Person(name='Paco', email='paco@acme.com', company=company).save()
+        s.result # {'inserted': 2, ...}
+    """
+    return Session(transaction, batch_size)
+
+
+def _numpy() -> Any:
+    # numpy is optional, only ModelCursor.to_numpy needs it
+    try:
+        import numpy
+    except ImportError:
+        raise ImportError('ModelCursor.to_numpy needs numpy (pip install numpy)') from None
+    return numpy
+
+
+def _column_projection(fields: list[str]) -> dict[str, int]:
+    # a path inside another requested one is read with it, MongoDB rejects both in a projection
+    projection = {field: 1 for field in fields if not any(field.startswith(other + '.') for other in fields)}
+    if '_id' not in projection:
+        projection['_id'] = 0
+    return projection
+
+
+def _numpy_values(np: Any, values: list, dtype: Any = None) -> Any:
+    if dtype is not None:
+        return np.array(values, dtype=dtype)
+    if not values:
+        return np.array([], dtype=float)
+    if isinstance(values[0], datetime):
+        return np.array(values, dtype='datetime64[ms]')
+    return np.array(values)
+
+
+class _Columns:
+    """
+    Values of some fields of raw documents gathered column by column: per
+    field, the values found at its path (flattened like _path_values) and
+    how many of them each document had, so no model is built per document.
+    """
+    def __init__(self, fields: list[str]):
+        self.fields = list(fields)
+        self.rows = 0
+        self.values: dict[str, list] = {field: [] for field in self.fields}
+        self.lengths: dict[str, list[int]] = {field: [] for field in self.fields}
+        self.many = dict.fromkeys(self.fields, False) # whether an array was found on the path
+        self.chunks: dict[str, list[tuple]] = {field: [] for field in self.fields} # numpy (values, lengths) of each converted batch
+
+    def append(self, doc: RawBSONDocument) -> None:
+        self.rows += 1
+        for field in self.fields:
+            found, many = _path_values(doc, field)
+            self.values[field].extend(_decode(value) for value in found)
+            self.lengths[field].append(len(found))
+            if many:
+                self.many[field] = True
+
+    def lists(self) -> dict[str, list]:
+        # a value per document (None if missing), or the list of values of the paths going through arrays
+        columns = {}
+        for field in self.fields:
+            values, column, start = self.values[field], [], 0
+            for length in self.lengths[field]:
+                column.append(values[start:start + length] if self.many[field] else values[start] if length else None)
+                start += length
+            columns[field] = column
+        return columns
+
+    def convert(self, np: Any, dtypes: dict[str, Any]) -> None:
+        # turns the values gathered so far into arrays, so python objects never outlive a batch
+        for field in self.fields:
+            self.chunks[field].append((_numpy_values(np, self.values[field], dtypes.get(field)), np.array(self.lengths[field], dtype=np.int64)))
+            self.values[field], self.lengths[field] = [], []
+
+    def arrays(self, np: Any, dtypes: dict[str, Any]) -> dict[str, Any]:
+        self.convert(np, dtypes)
+        columns = {}
+        for field, chunks in self.chunks.items():
+            present = [values for values, _ in chunks if len(values)] or [chunks[0][0]]
+            values, lengths = np.concatenate(present), np.concatenate([lengths for _, lengths in chunks])
+            width = max(int(lengths.max(initial=0)), 1) if self.many[field] else 1
+            mask = np.arange(width) >= lengths[:, None] # masked: missing values and padding
+            data = np.zeros((len(lengths), width), dtype=values.dtype)
+            data[~mask] = values
+            columns[field] = np.ma.MaskedArray(data, mask) if self.many[field] else np.ma.MaskedArray(data[:, 0], mask[:, 0])
+        return columns
+
+
+# (definitions file, uri, database) => models built by initApp in this worker process
+_worker_scopes: dict[tuple[str, str, str], dict[str, type]] = {}
+
+
+def _scan_partition(origin: tuple[str, str, str], model_name: str, query: dict, fields: list[str] | None, raw: bool,
+                    batch_size: int | None, prefetched: tuple[str, ...], fn: Callable[['ModelCursor'], Any]) -> Any:
+    # runs in a worker process of ModelCursor.parallel: the model classes are not picklable, so they are built again there
+    scope = _worker_scopes.get(origin)
+    if scope is None:
+        scope = _worker_scopes[origin] = {}
+        initApp(origin[0], origin[1], origin[2], scope, manage_indexes=False)
+    return fn(scope[model_name].find(query, batch_size, raw, fields).prefetch(*prefetched))
+
+
+def _partition_bounds(collection: Collection, key: str, partitions: int, sample_size: int) -> list:
+    """
+    Values of key splitting the collection in partitions ranges of about
+    the same size, taken from a sorted random sample of it (a random cursor
+    on the server, not a scan). Fewer if the sample has fewer distinct values.
+    """
+    pipeline = [{'$sample': {'size': sample_size}}, {'$project': {'_id': 0, 'key': f'${key}'}}, {'$sort': {'key': 1}}]
+    values = [doc['key'] for doc in collection.aggregate(pipeline) if doc.get('key') is not None]
+    return list(dict.fromkeys(values[len(values) * i // partitions] for i in range(1, partitions))) if values else []
+
+
+def _partition_queries(filter: dict, key: str, bounds: list) -> list[dict]:
+    # the first range is 'not >= the first bound', so it also has the documents without key (or with other types)
+    ranges = [{key: {'$not': {'$gte': bounds[0]}}}] if bounds else [{}]
+    ranges += [{key: {'$gte': low, '$lt': high}} for low, high in zip(bounds, bounds[1:])]
+    ranges += [{key: {'$gte': bounds[-1]}}] if bounds else []
+    return [_and(filter, part) if filter and part else filter or part for part in ranges]
+
+
+_STREAM_END = object() # put by every worker of a parallel stream when it finishes
 
-        cls._db.create_index([(indexes['location_index'], pymongo.GEOSPHERE)])
- 
 
 class ModelCursor:
     """
@@ -188,14 +3169,29 @@ class ModelCursor:
 creating unique index => email
     cursor : pymongo.cursor.Cursor
         Pymongo cursor to iterate
+    batch_size : int | None
+        Documents per server batch
 
     Methods
     -------
     __iter__() -> Generator
         Returns an iterator that goes through the cursor elements
         and returns the documents as model objects.
+    iter_batches() -> Generator
+        Same as __iter__ but yields lists of models, one per batch.
+    prefetch(*paths) -> ModelCursor
+        Resolves the given references for a whole batch at once.
+    paginate(sort, page_size, after) -> tuple[list[Model], str | None]
+        A page of the query and the token of the next one.
+    to_columns(fields) -> dict[str, list], to_numpy(fields, dtypes) -> dict[str, MaskedArray]
+        Some fields of every document of the query, column by column.
+    parallel(n, fn, executor, key) -> Generator | list
+        The query split in key ranges read by n workers.
+    limit(n), skip(n), sort(key, direction) -> ModelCursor
+        Passed through to the pymongo cursor, they return the cursor so they can be chained.
     """
-    def __init__(self, model_class: Model, cursor: Cursor):
+    def __init__(self, model_class: Model, cursor: Cursor, batch_size: int | None = None, plan: str | None = None,
+                 filter: dict | None = None, fields: list[str] | None = None):
         """
         Initializes the cursor with the model class and pymongo cursor.
 
@@ -205,9 +3201,311 @@ creating unique index => email
             Class used to create models from the documents being iterated.
         cursor: pymongo.cursor.Cursor
             Pymongo cursor to iterate
+        batch_size : int | None
+            Documents per server batch
+        plan : str | None
+            Explained plan of the query, reported to the profiler
+        filter : dict | None
+            Query of the cursor, needed to paginate it
+        fields : list[str] | None
+            Attributes read by the query, the models are partial (see Model.find)
         """
         self.model = model_class
         self.cursor = cursor
+        self.batch_size = batch_size
+        self.plan = plan
+        self.filter = filter
+        self.prefetched: tuple[str, ...] = ()
+        self.hydrate = model_class._from_doc # builds the model of every document
+        self.options: dict[str, Any] = {} # limit, skip and sort, to query the same documents again
+        self.fields = frozenset(fields) if fields is not None else None
+        self._partial: _Partial | None = None # shared by the partial models of the current batch
+        self._received: int | None = None # documents the cursor had received when that batch started
+        if fields is not None:
+            self.hydrate = self._hydrate_partial
+
+    def prefetch(self, *paths: str) -> Self:
+        """
+        Resolves the declared references at paths (see Model.ref) for every
+        batch with one $in query per referenced model, instead of a
+        find_by_id per document:
+
+            for person in Person.find({}).prefetch('company', 'education.education_centre'):
+                person.ref('company').name
+        """
+        for path in paths:
+            self.model._reference(path)
+        self.prefetched += paths
+        return self
+
+    def _page_query(self, sort: list[tuple[str, int]] | None, after: str | None) -> tuple[dict, list[tuple[str, int]]]:
+        # the filter plus the range predicate starting after the token, and the sort with its _id tie-breaker
+        if self.filter is None:
+            raise TypeError(f'{type(self).__name__} can\'t be paginated, only the cursors of Model.find can')
+        sort = [tuple(key) for key in sort or []]
+        if '_id' not in dict(sort):
+            sort.append(('_id', sort[-1][1] if sort else pymongo.ASCENDING))
+        if after is None:
+            return self.filter, sort
+        token = _decode_token(after)
+        if [tuple(key) for key in token['sort']] != sort:
+            raise ValueError('the continuation token was created with another sort')
+        # (a > x) or (a == x and b > y) or ..., which the index on the sort keys can answer as ranges.
+        # null and missing values sort first, and $gt/$lt never match them, so they get their own branches
+        keyset = []
+        for i, (key, direction) in enumerate(sort):
+            clause = {previous: value for (previous, _), value in zip(sort[:i], token['values'])}
+            value = token['values'][i]
+            if direction == pymongo.ASCENDING:
+                keyset.append({**clause, key: {'$gt': value} if value is not None else {'$ne': None}})
+            elif value is not None: # nothing sorts after null in descending order
+                keyset += [{**clause, key: {'$lt': value}}, {**clause, key: None}]
+        return ({'$and': [self.filter, {'$or': keyset}]} if self.filter else {'$or': keyset}), sort
+
+    @staticmethod
+    def _page_token(doc: dict, sort: list[tuple[str, int]]) -> str:
+        values = [next(iter(_path_values(doc, key)[0]), None) for key, _ in sort]
+        return _encode_token({'sort': [list(key) for key in sort], 'values': values})
+
+    def paginate(self, sort: list[tuple[str, int]] | None = None, page_size: int = 20, after: str | None = None) -> tuple[list[Model], str | None]:
+        """
+        Returns a page of the documents of the query in sort order, and the
+        token to pass as after to get the next one (None on the last page).
+
+        Pages are read with a range predicate on the sort keys after the last
+        document of the previous page, with _id as tie-breaker, instead of
+        skipping the previous pages: with an index on the sort keys (plus
+        _id) any page costs the same as the first one. Documents without a
+        sort key (or with null) come first in ascending order and last in
+        descending order, as MongoDB sorts them. The sort keys should not be
+        arrays nor mix types.
+
+        Parameters
+        ----------
+        sort : list[tuple[str, int]] | None
+            Sort keys and directions, e.g. [('name', 1)]. _id by default
+        page_size : int
+            Models per page
+        after : str | None
+            Token returned with the previous page
+        """
+        return _run(self._paginate_steps(sort, page_size, after))
+
+    def _paginate_steps(self, sort: list[tuple[str, int]] | None, page_size: int, after: str | None) -> Generator:
+        query, sort = self._page_query(sort, after)
+        projection, hidden = self.model._projection(self.fields), set()
+        if projection is not None: # partial models: the token needs the sort keys, which the models don't load
+            for key, _ in sort:
+                if key.split('.')[0] not in projection and key != '_id': # always read
+                    projection[key] = 1
+                    hidden.add(key.split('.')[0])
+        with _profiled(self.model.__name__, 'find') as details:
+            docs = yield _All(self.cursor.collection.find(query, projection).sort(sort).limit(page_size + 1))
+            details['documents'] = len(docs)
+        token = self._page_token(docs[page_size - 1], sort) if len(docs) > page_size else None
+        if hidden:
+            docs = [{name: value for name, value in doc.items() if name not in hidden} for doc in docs]
+        self._partial = None # a page is one batch of its own
+        page = [self.hydrate(doc) for doc in docs[:page_size]]
+        if self.prefetched:
+            yield from self.model._prefetch_steps(page, self.prefetched)
+        return page, token
+
+    def limit(self, n: int) -> Self:
+        self.cursor.limit(n)
+        self.options['limit'] = n
+        return self
+
+    def skip(self, n: int) -> Self:
+        self.cursor.skip(n)
+        self.options['skip'] = n
+        return self
+
+    def sort(self, key: str | list[tuple[str, int]], direction: int | None = None) -> Self:
+        self.cursor.sort(key, direction)
+        self.options['sort'] = [(key, direction or pymongo.ASCENDING)] if isinstance(key, str) else list(key)
+        return self
+
+    def _hydrate_partial(self, doc: dict) -> Model:
+        # models of a find with fields, grouped by the server batch that brought them to load other fields together.
+        # A batch starts when the cursor received more documents. Cursors that don't count them (e.g. in tests)
+        # only approximate it with groups of batch_size, or of the server default for the first batch
+        instance = self.model._from_doc(doc)
+        partial, received = self._partial, getattr(self.cursor, 'retrieved', None)
+        if received is not None:
+            new_batch = received != self._received
+        else:
+            new_batch = partial is None or len(partial.instances) == (self.batch_size or 101)
+        if partial is None or new_batch:
+            partial = self._partial = _Partial(self.model, self.fields)
+            self._received = received
+        partial.instances.append(instance)
+        object.__setattr__(instance, '_partial', partial)
+        return instance
+
+    def parallel(self, n: int, fn: Callable[['ModelCursor'], Any] | None = None, executor: str = 'thread', key: str = '_id',
+                 sample_size: int | None = None) -> Any:
+        """
+        Splits the query in n ranges of key, with about the same number of
+        documents each (bounds taken from a sample of the collection), and
+        reads them with one cursor per worker.
+
+        Without fn the models of every range are streamed back as they are
+        read, in no particular order (threads only). With fn each worker
+        calls fn(cursor) on the cursor of its range and a list with the
+        results is returned, in key order. Threads overlap the queries but
+        share the GIL: CPU heavy fn should use executor='process', whose
+        workers build the models again with initApp (fn must be picklable,
+        e.g. a module function, and return picklable results).
+
+            def count_studies(people):
+                return sum(len(person.education) for person in people if 'education' in person._data)
+
+            sum(Person.find({}, batch_size=1000).parallel(8, count_studies, executor='process'))
+
+        key must be indexed and hold a single value of one type per document,
+        _id by default. limit, skip and sort can't be split, they raise a
+        ValueError.
+
+        Parameters
+        ----------
+        n : int
+            Number of ranges and workers
+        fn : Callable[[ModelCursor], Any] | None
+            Function applied to the cursor of each range
+        executor : str
+            'thread' or 'process'
+        key : str
+            Field whose ranges split the query
+        sample_size : int | None
+            Documents sampled to find the bounds, 100 per range by default
+        """
+        if self.filter is None:
+            raise TypeError(f'{type(self).__name__} can\'t be split, only the cursors of Model.find can')
+        if self.options:
+            raise ValueError(f'parallel scans can\'t {", ".join(self.options)}')
+        if executor not in ('thread', 'process'):
+            raise ValueError(f'executor must be \'thread\' or \'process\', not \'{executor}\'')
+        if fn is None and executor == 'process':
+            raise ValueError('models can only be streamed back from threads, give fn to use processes')
+        collection = self.cursor.collection
+        queries = _partition_queries(self.filter, key, _partition_bounds(collection, key, n, sample_size or 100 * n))
+        fields = sorted(self.fields) if self.fields is not None else None
+        if executor == 'process':
+            if self.model._origin is None:
+                raise TypeError(f'{self.model.__name__} was not built by initApp, its workers could not build it again')
+            raw = collection.codec_options.document_class is RawBSONDocument
+            # spawned, not forked: a forked child would share the sockets of the parent's clients
+            with ProcessPoolExecutor(max_workers=n, mp_context=multiprocessing.get_context('spawn')) as pool:
+                futures = [pool.submit(_scan_partition, self.model._origin, self.model.__name__, query, fields, raw, self.batch_size,
+                                       self.prefetched, fn) for query in queries]
+                return [future.result() for future in futures]
+        cursors = [self._partition(query) for query in queries]
+        if fn is None:
+            return self._stream(cursors)
+        with ThreadPoolExecutor(max_workers=n) as pool:
+            return list(pool.map(fn, cursors))
+
+    def _partition(self, query: dict) -> 'ModelCursor':
+        # a cursor like this one over a range of the query
+        cursor = self.cursor.collection.find(query, self.model._projection(self.fields))
+        if self.batch_size:
+            cursor.batch_size(self.batch_size)
+        partition = ModelCursor(self.model, cursor, self.batch_size, None, query, self.fields)
+        partition.prefetch(*self.prefetched)
+        return partition
+
+    def _stream(self, cursors: list['ModelCursor']) -> Generator:
+        # batches go through a bounded queue, workers stop when the consumer does
+        batches, stop = queue.Queue(maxsize=2 * len(cursors)), threading.Event()
+
+        def put(item):
+            while not stop.is_set():
+                try: return batches.put(item, timeout=0.1)
+                except queue.Full: pass
+
+        def work(cursor):
+            try:
+                for batch in cursor.iter_batches():
+                    put(batch)
+                    if stop.is_set():
+                        return
+            except Exception as e:
+                put(e)
+            finally:
+                put(_STREAM_END)
+
+        with ThreadPoolExecutor(max_workers=len(cursors)) as pool:
+            for cursor in cursors:
+                pool.submit(work, cursor)
+            try:
+                finished = 0
+                while finished < len(cursors):
+                    item = batches.get()
+                    if item is _STREAM_END:
+                        finished += 1
+                    elif isinstance(item, Exception):
+                        raise item
+                    else:
+                        yield from item
+            finally:
+                stop.set()
+
+    def _columns_cursor(self, fields: list[str]) -> Cursor:
+        # the query again, reading only the fields as raw BSON
+        if self.filter is None:
+            raise TypeError(f'{type(self).__name__} can\'t be read as columns, only the cursors of Model.find can')
+        collection = self.cursor.collection.with_options(codec_options=CodecOptions(document_class=RawBSONDocument))
+        return collection.find(self.filter, _column_projection(fields), batch_size=self.batch_size or 0, **self.options)
+
+    def to_columns(self, fields: list[str]) -> dict[str, list]:
+        """
+        Reads only the given fields of the documents of the query, without
+        building models: field => list with the value of every document
+        (None if it is missing). Paths going through arrays, like
+        'education.year_graduated', give the list of values of each document.
+        """
+        return _run(self._columns_steps(fields))
+
+    def to_numpy(self, fields: list[str], dtypes: dict[str, Any] | None = None) -> dict[str, Any]:
+        """
+        Same as to_columns but every field is a numpy masked array, for
+        vectorized analysis of many documents. The values of each batch are
+        converted as soon as it is read, so memory holds arrays, not objects.
+        numpy is only imported here, it is not needed by the rest of the ODM.
+
+            columns = Person.find({}).to_numpy(['education.year_graduated', 'address_loc.coordinates'])
+            columns['education.year_graduated'].count(axis=1).mean() # average studies per person
+            columns['address_loc.coordinates'][:, 0]                 # longitudes
+
+        Parameters
+        ----------
+        fields : list[str]
+            Paths to read, nested or not
+        dtypes : dict[str, Any] | None
+            numpy dtype of some fields, inferred from the values by default
+            (datetimes become datetime64[ms])
+
+        Returns
+        -------
+        dict[str, numpy.ma.MaskedArray]
+            Per field a 1-D array with a value per document, masked where it
+            is missing, or, when the path goes through arrays, a 2-D array with
+            a row per document padded (and masked) to the longest one
+        """
+        return _run(self._columns_steps(fields, _numpy(), dtypes or {}))
+
+    def _columns_steps(self, fields: list[str], np: Any = None, dtypes: dict[str, Any] | None = None) -> Generator:
+        # the columns as lists, or with np as arrays converted every batch
+        columns, size = _Columns(fields), self.batch_size or 1000
+        def append(doc):
+            columns.append(doc)
+            if np is not None and columns.rows % size == 0:
+                columns.convert(np, dtypes)
+        with _profiled(self.model.__name__, 'find') as details:
+            yield _All(self._columns_cursor(fields), append)
+            details['documents'] = columns.rows
+        return columns.lists() if np is None else columns.arrays(np, dtypes)
 
     def __iter__(self) -> Generator:
         """
@@ -217,8 +3515,300 @@ creating unique index => email
         Use next to get the next document from the cursor.
         Use alive to check if more documents exist.
         """
-        for doc in self.cursor:
-            yield self.model(**doc) # we unwrap the python dictionary to the constructor
+        if self.prefetched:
+            for batch in self.iter_batches():
+                yield from batch
+            return
+        yield from self._iter_models()
+
+    def _iter_models(self) -> Generator:
+        from_doc = self.hydrate
+        if profiler is not None:
+            yield from self._iter_profiled()
+            return
+        while self.cursor.alive:
+            doc = next(self.cursor, None)
+            if doc is None:
+                break
+            yield from_doc(doc) # the cursor already gives us a fresh document, no need to copy it
+
+    def _iter_profiled(self) -> Generator:
+        # records the time spent in the cursor (not in the caller's loop body) as one 'find'
+        from_doc = self.hydrate
+        seconds, documents, nbytes = 0.0, 0, 0
+        try:
+            while self.cursor.alive:
+                start = time.perf_counter()
+                doc = next(self.cursor, None)
+                seconds += time.perf_counter() - start
+                if doc is None:
+                    break
+                documents += 1
+                nbytes += len(doc.raw) if type(doc) is RawBSONDocument else len(bson.encode(doc))
+                yield from_doc(doc)
+        finally:
+            if profiler is not None:
+                profiler.record(self.model.__name__, 'find', seconds, documents, nbytes, self.plan)
+
+    def iter_batches(self) -> Generator:
+        """
+        Returns an iterator of lists of models with up to batch_size
+        documents each, matching the server batches.
+        """
+        size = self.batch_size or 101 # the server default for the first batch
+        batch = []
+        for model in self._iter_models():
+            batch.append(model)
+            if len(batch) == size:
+                if self.prefetched: self.model._prefetch(batch, self.prefetched)
+                yield batch
+                batch = []
+        if batch:
+            if self.prefetched: self.model._prefetch(batch, self.prefetched)
+            yield batch
+
+
+class NearCursor(ModelCursor):
+    """
+    ModelCursor over a $geoNear query (see Model.near), nearest first. Every
+    model gets its distance in meta() and the cursor keeps the position of
+    the last one read, so next_token() can resume there: the next page costs
+    the same as the first, instead of computing every previous distance again.
+    """
+    def __init__(self, model_class: Model, cursor: CommandCursor, batch_size: int | None = None, position: tuple[float, list] = (0.0, [])):
+        super().__init__(model_class, cursor, batch_size)
+        self.hydrate = self._hydrate
+        self.distance, self.ids = position[0], list(position[1]) # last distance read and the ids read at it
+
+    def _hydrate(self, doc: dict) -> Model:
+        distance = doc.pop(_DISTANCE_FIELD)
+        instance = self.model._from_doc(doc)
+        object.__setattr__(instance, '_meta', {'distance': distance})
+        if distance != self.distance:
+            self.distance, self.ids = distance, []
+        self.ids.append(doc['_id'])
+        return instance
+
+    def next_token(self) -> str:
+        """
+        Continuation token for the 'after' parameter of Model.near, to get
+        the results following the last one read from this cursor.
+        """
+        return _encode_token({'distance': self.distance, 'ids': self.ids})
+
+
+async def getLocationPointAsync(address: str) -> Point:
+    """
+    getLocationPoint for event loops: local geocoders are called directly,
+    network ones (and their cache lookups) run in a worker thread.
+    """
+    if not geocoder.cacheable:
+        return getLocationPoint(address)
+    return await asyncio.to_thread(getLocationPoint, address)
+
+
+class AsyncModel(Model):
+    """
+    Model whose database operations are coroutines, built by initAppAsync.
+    Attribute handling, validation and change tracking are the same as Model.
+    """
+    __slots__ = ()
+    _db: AsyncCollection
+    _asynchronous = True
+    _locate = staticmethod(getLocationPointAsync)
+
+    def _load_missing(self, name: str) -> bool:
+        # attribute access can't await: partial instances load fields with load()
+        try: partial = object.__getattribute__(self, '_partial')
+        except AttributeError: return False
+        if name in partial.loaded or name not in self._allowed_vars:
+            return False
+        raise AttributeError(f'"{name}" was not loaded by find, await load(\'{name}\') first')
+
+
+    def _load_all(self) -> None:
+        try: object.__getattribute__(self, '_partial')
+        except AttributeError: return
+        raise AttributeError(f'partial {type(self).__name__} instance, await load() first')
+
+
+    async def load(self, *names: str) -> None:
+        """
+        Fetches fields that a find with fields=[...] did not read (all of
+        them by default) for every instance of the same batch.
+        """
+        await _run_async(self._load_steps(list(names)))
+
+
+    async def save(self) -> None:
+        await _run_async(self._save_steps())
+
+
+    async def delete(self) -> None:
+        await _run_async(self._delete_steps())
+
+
+    @classmethod
+    async def delete_many(cls, filter: dict[str, str | dict]) -> int:
+        return await _run_async(cls._delete_many_steps(filter))
+
+
+    @classmethod
+    async def save_many(cls, instances: list[Self], batch_size: int = 1000, insert: bool = False) -> dict[str, Any]:
+        """
+        Model.save_many for event loops, addresses are geocoded concurrently
+        with getLocationPointAsync (still under the geocoder rate limit).
+        """
+        return await _run_async(cls._save_many_steps(instances, batch_size, insert))
+
+
+    @classmethod
+    async def _geocode(cls, instances: list[Self], insert: bool = False, workers: int = 8) -> dict[str, Point | Exception]:
+        async def resolve(address):
+            try: return address, await getLocationPointAsync(address)
+            except ValueError as e: return address, e
+        return dict(await asyncio.gather(*(resolve(address) for address in cls._pending_addresses(instances, insert))))
+
+
+    @classmethod
+    async def insert_many(cls, documents: list[dict], **kwargs) -> tuple[list[Self], dict[str, Any]]:
+        instances = [cls(**document) for document in documents]
+        return instances, await cls.save_many(instances, insert=True, **kwargs)
+
+
+    @classmethod
+    async def view(cls, name: str, key: Any = _MISSING) -> dict | list[dict] | None:
+        return await _run_async(cls._view_read_steps(name, key))
+
+
+    @classmethod
+    async def rebuild_views(cls, *names: str) -> None:
+        await _run_async(cls._rebuild_steps(names))
+
+
+    @classmethod
+    def find(cls, filter: dict[str, str | dict], batch_size: int | None = None, raw: bool = False,
+             fields: list[str] | None = None) -> 'AsyncModelCursor':
+        return AsyncModelCursor(cls, cls._cursor(filter, batch_size, raw, fields), batch_size, filter=filter, fields=fields)
+
+
+    @classmethod
+    async def near(cls, point: Any, max_distance: float | None = None, min_distance: float | None = None, filter: dict | None = None,
+                   limit: int | None = None, after: str | None = None, batch_size: int | None = None) -> 'AsyncNearCursor':
+        if isinstance(point, str):
+            point = await getLocationPointAsync(point)
+        pipeline, position = cls._near_pipeline(_geometry(point), max_distance, min_distance, filter, limit, after)
+        cursor = await (cls._db.aggregate(pipeline, batchSize=batch_size) if batch_size else cls._db.aggregate(pipeline))
+        return AsyncNearCursor(cls, cursor, batch_size, position)
+
+
+    @classmethod
+    async def within(cls, shape: dict | list, filter: dict | None = None, batch_size: int | None = None) -> 'AsyncModelCursor':
+        if isinstance(shape, dict) and 'center' in shape:
+            return await cls.near(shape['center'], max_distance=shape['radius'], filter=filter, batch_size=batch_size)
+        return cls.find(cls._within_filter(shape, filter), batch_size)
+
+
+    @classmethod
+    async def search(cls, text: str, fields: list[str] | None = None, limit: int | None = None, filter: dict | None = None,
+                     project: list[str] | None = None) -> list[Self] | list[dict]:
+        return await _run_async(cls._search_steps(text, fields, limit, filter, project))
+
+
+    @classmethod
+    async def aggregate(cls, pipeline: list[dict], cache: bool = False, optimize: bool = False) -> AsyncCommandCursor | _AsyncCachedCursor:
+        result = await _run_async(cls._aggregate_steps(pipeline, cache, optimize))
+        return _AsyncCachedCursor(result) if cache else result
+
 
-        # TODO: Create generator function and use yield in it
-        # TODO: Use alive variable
+    @classmethod
+    async def explain_optimization(cls, pipeline: list[dict]) -> dict:
+        return await _run_async(cls._explain_steps(pipeline))
+
+
+    @classmethod
+    async def find_by_id(cls, id: str | ObjectId) -> Self | None:
+        return await _run_async(cls._find_by_id_steps(id))
+
+
+    @classmethod
+    async def find_by_ids(cls, ids: list[ObjectId]) -> dict[ObjectId, Self]:
+        return await _run_async(cls._find_by_ids_steps(ids))
+
+
+    async def ref(self, path: str) -> Any:
+        return await _run_async(self._ref_steps(path))
+
+
+    @classmethod
+    async def _prefetch(cls, instances: list[Self], paths: tuple[str, ...]) -> None:
+        await _run_async(cls._prefetch_steps(instances, paths))
+
+
+    @classmethod
+    async def init_class(cls, db_collection: AsyncCollection, indexes: dict[str, str], required_vars: set[str], admissible_vars: set[str],
+                         cache_size: int = 1024, cache_ttl: float | None = None, manage_indexes: bool = True,
+                         references: dict[str, str | dict] | None = None, views: dict[str, dict] | None = None) -> None:
+        await _run_async(cls._init_steps(db_collection, indexes, required_vars, admissible_vars, cache_size, cache_ttl, manage_indexes,
+                                         references, views))
+
+
+class AsyncModelCursor(ModelCursor):
+    """
+    ModelCursor over an asyncio pymongo cursor, iterated with 'async for'.
+    limit, skip and sort are inherited and chain the same way.
+    """
+    cursor: AsyncCursor
+
+    def __iter__(self):
+        raise TypeError('AsyncModelCursor must be iterated with async for')
+
+    async def __aiter__(self):
+        if self.prefetched:
+            async for batch in self.iter_batches():
+                for model in batch:
+                    yield model
+            return
+        async for model in self._aiter_models():
+            yield model
+
+    async def _aiter_models(self):
+        from_doc = self.hydrate
+        while self.cursor.alive:
+            try: doc = await self.cursor.next()
+            except StopAsyncIteration: break
+            yield from_doc(doc)
+
+    async def iter_batches(self):
+        size = self.batch_size or 101 # the server default for the first batch
+        batch = []
+        async for model in self._aiter_models():
+            batch.append(model)
+            if len(batch) == size:
+                if self.prefetched: await self.model._prefetch(batch, self.prefetched)
+                yield batch
+                batch = []
+        if batch:
+            if self.prefetched: await self.model._prefetch(batch, self.prefetched)
+            yield batch
+
+    async def to_list(self) -> list[AsyncModel]:
+        return [model async for model in self]
+
+    def parallel(self, *args, **kwargs):
+        raise TypeError('AsyncModelCursor can\'t be split, gather several finds on the event loop instead')
+
+    async def to_columns(self, fields: list[str]) -> dict[str, list]:
+        return await _run_async(self._columns_steps(fields))
+
+    async def to_numpy(self, fields: list[str], dtypes: dict[str, Any] | None = None) -> dict[str, Any]:
+        return await _run_async(self._columns_steps(fields, _numpy(), dtypes or {}))
+
+    async def paginate(self, sort: list[tuple[str, int]] | None = None, page_size: int = 20, after: str | None = None) -> tuple[list[AsyncModel], str | None]:
+        return await _run_async(self._paginate_steps(sort, page_size, after))
+
+
+class AsyncNearCursor(NearCursor, AsyncModelCursor):
+    """
+    NearCursor iterated with 'async for', returned by AsyncModel.near.
+    """
@@ -1,10 +1,11 @@
+import asyncio
 import pytest
 from unittest.mock import patch, MagicMock
 from geojson import Point
+from bson.objectid import ObjectId
 from geopy.exc import GeocoderTimedOut
-from pymongo import MongoClient
-from pymongo.server_api import ServerApi
-from ODM import initApp, getLocationPoint, ModelCursor
+import ODM
+from ODM import initApp, initAppAsync, getLocationPoint, ModelCursor, AsyncModelCursor, GeocodeCache
 
 # ─────────────────────────────────────────────────────────────
 # 🔧 Configuration Constants
@@ -13,6 +14,7 @@ from ODM import initApp, getLocationPoint, ModelCursor
 DB_NAME = "abd_test"
 MONGO_URI = "mongodb://localhost:27017/"
 TEST_YML_FILE_PATH = "./models_test.yml"
+VIEWS_YML_FILE_PATH = "./models_views_test.yml"
 COLLECTION_NAME = "User"
 
 # ─────────────────────────────────────────────────────────────
@@ -28,16 +30,33 @@ def db_scope():
     scope = {}
     initApp(definitions_path=TEST_YML_FILE_PATH, mongodb_uri=MONGO_URI, db_name=DB_NAME, scope=scope)
     yield scope
-    client = MongoClient(MONGO_URI, server_api=ServerApi('1'))
-    client.drop_database(DB_NAME)
-    client.close()
+    ODM.getClient(MONGO_URI).drop_database(DB_NAME)
+
+@pytest.fixture(scope="function")
+def views_scope():
+    """
+    Same as db_scope, with the User model of the views tests: it declares
+    views and nullifies the boss references to deleted users.
+    """
+    scope = {}
+    initApp(definitions_path=VIEWS_YML_FILE_PATH, mongodb_uri=MONGO_URI, db_name=DB_NAME, scope=scope)
+    yield scope
+    ODM.getClient(MONGO_URI).drop_database(DB_NAME)
+
+@pytest.fixture(autouse=True)
+def geocode_cache(tmp_path, monkeypatch):
+    """
+    Gives every test its own geocoding cache so results do not leak between tests.
+    """
+    cache = GeocodeCache(path=str(tmp_path / "geocode.sqlite"))
+    monkeypatch.setattr(ODM, "geocode_cache", cache)
+    return cache
 
 def get_collection():
     """
     Returns the MongoDB collection used for testing.
     """
-    client = MongoClient(MONGO_URI, server_api=ServerApi('1'))
-    return client[DB_NAME][COLLECTION_NAME]
+    return ODM.getClient(MONGO_URI)[DB_NAME][COLLECTION_NAME]
 
 # ─────────────────────────────────────────────────────────────
 # ✅ ODM Model Tests
@@ -160,3 +179,1011 @@ def test_get_location_point_timeout_failure(mock_nominatim):
 
     with pytest.raises(ValueError, match="No se pudieron obtener coordenadas"):
         getLocationPoint("Dirección que falla")
+
+@patch("ODM.Nominatim")
+def test_get_location_point_cache_hit(mock_nominatim, geocode_cache):
+    """Test a resolved address is served from the cache on later calls."""
+    mock_geolocator = MagicMock()
+    mock_geolocator.geocode.return_value = MagicMock(latitude=40.4168, longitude=-3.7038)
+    mock_nominatim.return_value = mock_geolocator
+
+    first = getLocationPoint("Madrid, España")
+    second = getLocationPoint("  madrid,   ESPAÑA ")
+    assert first.coordinates == second.coordinates == [-3.7038, 40.4168]
+    assert mock_geolocator.geocode.call_count == 1
+    assert geocode_cache.stats()["hits"] == 1
+
+@patch("ODM.Nominatim")
+def test_get_location_point_negative_cache(mock_nominatim, geocode_cache):
+    """Test unknown addresses are remembered and not geocoded again."""
+    mock_geolocator = MagicMock()
+    mock_geolocator.geocode.return_value = None
+    mock_nominatim.return_value = mock_geolocator
+
+    with pytest.raises(ValueError):
+        getLocationPoint("Calle que no existe")
+    calls = mock_geolocator.geocode.call_count
+    with pytest.raises(ValueError):
+        getLocationPoint("Calle que no existe")
+    assert mock_geolocator.geocode.call_count == calls
+
+def test_geocode_cache_persistence(tmp_path):
+    """Test cached coordinates are shared through the SQLite file."""
+    path = str(tmp_path / "shared.sqlite")
+    GeocodeCache(path=path).put("Paris, France", (2.3522, 48.8566))
+    other = GeocodeCache(path=path)
+    assert other.get("paris, france") == (2.3522, 48.8566)
+    assert other.stats()["disk_hits"] == 1
+    assert other.get("London") is ODM._MISSING
+
+@pytest.fixture
+def gazetteer(tmp_path):
+    """
+    Offline geocoder over a small gazetteer file.
+    """
+    path = tmp_path / "gazetteer.csv"
+    path.write_text(
+        "name,lon,lat\n"
+        "28006,-3.6828,40.4319\n"
+        "calle de serrano,-3.6869,40.4261\n"
+        "madrid,-3.7038,40.4168\n"
+        "las palmas de gran canaria,-15.4134,28.1235\n",
+        encoding="utf-8",
+    )
+    return ODM.GazetteerGeocoder(str(path))
+
+def test_gazetteer_lookup(gazetteer):
+    """Test exact, postcode, prefix and fuzzy gazetteer lookups."""
+    assert gazetteer.geocode("Madrid") == (-3.7038, 40.4168)
+    assert gazetteer.geocode("Calle de Serrano, 110, 28006 Madrid, España") == (-3.6828, 40.4319)
+    assert gazetteer.geocode("Las Palmas de Gran Canaria, Islas Canarias") == (-15.4134, 28.1235)
+    assert gazetteer.geocode("Las Palmas, España") == (-15.4134, 28.1235)
+    assert gazetteer.geocode("Madird") == (-3.7038, 40.4168)
+    assert gazetteer.geocode("Tokyo") is None
+
+def test_get_location_point_offline(gazetteer, monkeypatch):
+    """Test getLocationPoint uses the configured geocoder without touching the network."""
+    monkeypatch.setattr(ODM, "geocoder", gazetteer)
+    with patch("ODM.Nominatim") as mock_nominatim:
+        result = getLocationPoint("Calle de Serrano, Madrid")
+        assert result.coordinates == [-3.6869, 40.4261]
+        mock_nominatim.assert_not_called()
+    with pytest.raises(ValueError):
+        getLocationPoint("Tokyo")
+    class Incomplete(ODM.Geocoder):
+        cacheable = False
+    with pytest.raises(TypeError):
+        Incomplete() # geocode is abstract
+
+# ─────────────────────────────────────────────────────────────
+# 📦 Bulk Write Tests
+# ─────────────────────────────────────────────────────────────
+
+def test_save_many(db_scope):
+    """Test bulk inserting and updating instances."""
+    User = db_scope["User"]
+    users = [User(name=f"Paco{i}", email=f"paco{i}@gmail.com", age=18+i) for i in range(10)]
+    result = User.save_many(users, batch_size=3)
+    assert result["inserted"] == 10 and not result["errors"]
+    assert all("_id" in user._data for user in users)
+    assert get_collection().count_documents({}) == 10
+
+    users[0].age = 99
+    result = User.save_many(users[:1])
+    assert result["updated"] == 1
+    assert get_collection().find_one({"_id": users[0]._id})["age"] == 99
+
+def test_save_many_reports_duplicates(db_scope):
+    """Test duplicate keys are reported per document without aborting the batch."""
+    User = db_scope["User"]
+    users, result = User.insert_many([
+        {"name": "Paco", "email": "paco@gmail.com"},
+        {"name": "Paco", "email": "otro@gmail.com"},
+        {"name": "Lola", "email": "lola@gmail.com"},
+    ])
+    assert result["inserted"] == 2
+    assert len(result["errors"]) == 1
+    assert result["errors"][0][0] is users[1]
+    assert "_id" not in users[1]._data
+
+@patch("ODM.Nominatim")
+def test_save_many_geocodes_distinct_addresses(mock_nominatim, db_scope, monkeypatch):
+    """Test each distinct address is geocoded once per bulk save."""
+    monkeypatch.setattr(ODM, "geocoder", ODM.NominatimGeocoder(rate_limiter=ODM.RateLimiter(1000)))
+    mock_geolocator = MagicMock()
+    mock_geolocator.geocode.return_value = MagicMock(latitude=40.4168, longitude=-3.7038)
+    mock_nominatim.return_value = mock_geolocator
+
+    User = db_scope["User"]
+    users = [User(name=f"Paco{i}", email=f"paco{i}@gmail.com", address="Madrid") for i in range(5)]
+    User.save_many(users)
+    assert mock_geolocator.geocode.call_count == 1
+    assert all(user.address_loc["coordinates"] == [-3.7038, 40.4168] for user in users)
+
+# ─────────────────────────────────────────────────────────────
+# 🗂️ Identity Map Tests
+# ─────────────────────────────────────────────────────────────
+
+def test_find_by_id_identity_map(db_scope):
+    """Test repeated lookups return the same cached instance."""
+    User = db_scope["User"]
+    user = User(name="Paco", email="paco@gmail.com", age=18)
+    user.save()
+    User._identity_map.clear()
+
+    first = User.find_by_id(str(user._id))
+    second = User.find_by_id(user._id)
+    assert first is second
+    assert User.cache_stats()["hits"] >= 1
+    assert User.find_by_id("0" * 24) is None
+
+def test_find_by_id_write_invalidation(db_scope):
+    """Test save refreshes and delete invalidates the cached instance."""
+    User = db_scope["User"]
+    user = User(name="Paco", email="paco@gmail.com", age=18)
+    user.save()
+    assert User.find_by_id(user._id) is user
+    user.delete()
+    assert User.find_by_id(user._id) is None
+
+def test_find_by_id_eviction(db_scope):
+    """Test the cache is bounded and evicts the least recently used ids."""
+    User = db_scope["User"]
+    User._identity_map = ODM.LRUCache(maxsize=2)
+    users = [User(name=f"Paco{i}", email=f"paco{i}@gmail.com") for i in range(3)]
+    User.save_many(users)
+    assert len(User._identity_map) == 2
+    assert User.cache_stats()["evictions"] == 1
+
+# ─────────────────────────────────────────────────────────────
+# ✏️ Change Tracking Tests
+# ─────────────────────────────────────────────────────────────
+
+def test_save_sends_only_changed_fields(db_scope):
+    """Test updates only $set and $unset the fields that changed."""
+    User = db_scope["User"]
+    user = User(name="Paco", email="paco@gmail.com", age=18)
+    user.save()
+    user.age = 19
+    del user.email
+    assert user._update_document() == {"$set": {"age": 19}, "$unset": {"email": ""}}
+    user.save()
+    doc = get_collection().find_one({"_id": user._id})
+    assert doc["age"] == 19 and "email" not in doc
+    assert user._update_document() is None
+
+def test_save_without_changes_is_noop(db_scope):
+    """Test saving an unchanged document does not write."""
+    User = db_scope["User"]
+    user = User(name="Paco", email="paco@gmail.com", age=18)
+    user.save()
+    with patch.object(User._db, "update_one") as update_one:
+        user.save()
+        update_one.assert_not_called()
+
+def test_save_instances_built_with_id(views_scope):
+    """Test instances built by hand with an _id write every given field, upserting missing documents."""
+    User = views_scope["User"]
+    user = User(name="Paco", email="paco@gmail.com", age=18)
+    user.save()
+    User(_id=user._data["_id"], name="Paco", email="paco@hotmail.com").save()
+    assert get_collection().find_one({"_id": user._data["_id"]}, {"_id": 0}) == {"name": "Paco", "email": "paco@hotmail.com", "age": 18}
+    lola = User(_id="lola", name="Lola", email="lola@gmail.com", age=30)
+    lola.save()
+    assert get_collection().find_one({"_id": "lola"}) == {"_id": "lola", "name": "Lola", "email": "lola@gmail.com", "age": 30}
+    assert User.view("users_per_age", 18)["users"] == 1 and User.view("users_per_age", 30)["users"] == 1
+    result = User.save_many([User(_id="lola", name="Lola", email="lola@gmail.com", age=18), User(_id="pepe", name="Pepe", email="pepe@gmail.com")])
+    assert result["inserted"] == 1 and result["updated"] == 1
+    assert get_collection().count_documents({}) == 3 and get_collection().find_one({"_id": "lola"})["age"] == 18
+    assert User.view("users_per_age", 18)["users"] == 2 and User.view("users_per_age", 30) is None
+
+def test_save_nested_in_place_changes(db_scope):
+    """Test in-place changes to nested values are saved as path level updates."""
+    User = db_scope["User"]
+    user = User(name="Paco", email="paco@gmail.com", address={"city": "Madrid", "tags": ["a", "b"]})
+    user.address_loc = {"type": "Point", "coordinates": [-3.7038, 40.4168]}
+    user.save()
+    loaded = list(User.find({"_id": user._id}))[0]
+    loaded.address["tags"][1] = "c"
+    loaded.address["zip"] = "28001"
+    assert loaded._update_document() == {"$set": {"address.tags.1": "c", "address.zip": "28001"}}
+    loaded.save()
+    assert get_collection().find_one({"_id": user._id})["address"] == {"city": "Madrid", "tags": ["a", "c"], "zip": "28001"}
+
+# ─────────────────────────────────────────────────────────────
+# ⚡ Compiled Model Tests
+# ─────────────────────────────────────────────────────────────
+
+def test_save_after_reading_nested_values_is_noop(db_scope):
+    """Test reading nested values keeps a BSON snapshot and writes nothing if they are not changed."""
+    User = db_scope["User"]
+    User(name="Paco", email="paco@gmail.com", address={"city": "Madrid", "tags": ["a"]}, address_loc={"type": "Point", "coordinates": [-3.7038, 40.4168]}).save()
+    loaded = list(User.find({"name": "Paco"}))[0]
+    assert loaded.address["tags"] == ["a"]
+    assert isinstance(loaded._modified_vars["address"], ODM._Snapshot)
+    with patch.object(User._db, "update_one") as update_one:
+        loaded.save()
+        update_one.assert_not_called()
+    loaded.address["tags"].append("b")
+    assert loaded._update_document() == {"$set": {"address.tags": ["a", "b"]}}
+
+def test_required_attributes_enforced(db_scope):
+    """Test new instances must define every required attribute."""
+    User = db_scope["User"]
+    with pytest.raises(AttributeError, match="required"):
+        User(name="Paco")
+    with pytest.raises(AttributeError, match="not allowed"):
+        User(name="Paco", email="paco@gmail.com", phone="600000000")
+    with pytest.raises(AttributeError, match="required"):
+        User(_id="x", name="Paco")
+    # documents read from the database are not validated again
+    assert User._from_doc({"_id": "x", "name": "Paco"}).name == "Paco"
+
+def test_model_instances_are_slotted(db_scope):
+    """Test instances have no per-instance __dict__ and reject unknown attributes."""
+    User = db_scope["User"]
+    user = User(name="Paco", email="paco@gmail.com")
+    assert not hasattr(user, "__dict__")
+    assert User._allowed_vars == frozenset({"name", "email", "age", "address", "boss", "address_loc"})
+    with pytest.raises(AttributeError):
+        user.phone = "600000000"
+
+# ─────────────────────────────────────────────────────────────
+# 🔁 Cursor Tests
+# ─────────────────────────────────────────────────────────────
+
+def test_cursor_batches_and_chaining(db_scope):
+    """Test iter_batches and limit/skip/sort chaining."""
+    User = db_scope["User"]
+    User.save_many([User(name=f"Paco{i}", email=f"paco{i}@gmail.com", age=i) for i in range(10)])
+    batches = list(User.find({}, batch_size=4).iter_batches())
+    assert [len(batch) for batch in batches] == [4, 4, 2]
+    assert all(type(user) is User for batch in batches for user in batch)
+    ages = [user.age for user in User.find({}).sort("age", -1).skip(2).limit(3)]
+    assert ages == [7, 6, 5]
+
+def test_cursor_raw_mode(db_scope):
+    """Test raw documents are readable and become writable on change."""
+    User = db_scope["User"]
+    user = User(name="Paco", email="paco@gmail.com", address={"city": "Madrid"})
+    user.address_loc = {"type": "Point", "coordinates": [-3.7038, 40.4168]}
+    user.save()
+    loaded = list(User.find({}, raw=True))[0]
+    assert loaded.name == "Paco"
+    loaded.address["city"] = "Sevilla"
+    loaded.age = 30
+    loaded.save()
+    doc = get_collection().find_one({"_id": user._id})
+    assert doc["address"] == {"city": "Sevilla"} and doc["age"] == 30
+
+# ─────────────────────────────────────────────────────────────
+# ⏳ Asyncio ODM Tests
+# ─────────────────────────────────────────────────────────────
+
+def run_async(test):
+    """
+    Runs a coroutine test against freshly initialised async models and drops the database afterwards.
+    """
+    async def main():
+        scope = {}
+        await initAppAsync(definitions_path=TEST_YML_FILE_PATH, mongodb_uri=MONGO_URI, db_name=DB_NAME, scope=scope)
+        try: await test(scope["User"])
+        finally: await scope["User"]._db.database.client.drop_database(DB_NAME)
+    asyncio.run(main())
+
+def test_async_save_and_find():
+    """Test saving, finding and deleting through the asyncio models."""
+    async def test(User):
+        user = User(name="Paco", email="paco@gmail.com", age=18)
+        await user.save()
+        assert await User.find_by_id(user._id) is user
+        cursor = User.find({"name": "Paco"})
+        assert type(cursor) is AsyncModelCursor
+        docs = await cursor.to_list()
+        assert len(docs) == 1 and docs[0].age == 18
+        await user.delete()
+        assert await User.find_by_id(user._id) is None
+    run_async(test)
+
+def test_async_save_many_and_aggregate():
+    """Test bulk saving and aggregating concurrently on one event loop."""
+    async def test(User):
+        await User.save_many([User(name=f"Paco{i}", email=f"paco{i}@gmail.com", age=18+i) for i in range(10)])
+        counts = await asyncio.gather(*(User.aggregate([{"$match": {"age": {"$gte": age}}}, {"$count": "n"}]) for age in (18, 23)))
+        assert [(await cursor.to_list())[0]["n"] for cursor in counts] == [10, 5]
+        cached = await User.aggregate([{"$count": "n"}], cache=True)
+        assert [doc async for doc in cached] == [{"n": 10}]
+        assert await (await User.aggregate([{"$count": "n"}], cache=True)).to_list() == [{"n": 10}]
+    run_async(test)
+
+# ─────────────────────────────────────────────────────────────
+# 📊 Aggregate Cache Tests
+# ─────────────────────────────────────────────────────────────
+
+def test_aggregate_cache_hit_and_invalidation(db_scope):
+    """Test cached aggregations are reused until the collection is written."""
+    User = db_scope["User"]
+    User.save_many([User(name=f"Paco{i}", email=f"paco{i}@gmail.com", age=18+i) for i in range(5)])
+    pipeline = [{"$match": {"age": {"$gte": 20}}}, {"$count": "n"}]
+    first = list(User.aggregate(pipeline, cache=True))
+    with patch.object(User._db, "aggregate") as aggregate:
+        assert list(User.aggregate(pipeline, cache=True)) == first
+        aggregate.assert_not_called()
+    first[0]["n"] = 99
+    assert list(User.aggregate(pipeline, cache=True)) == [{"n": 3}]
+    User(name="Lola", email="lola@gmail.com", age=40).save()
+    assert next(User.aggregate(pipeline, cache=True)) == {"n": 4}
+
+def test_aggregate_cache_skips_writes_and_unknown_collections(db_scope):
+    """Test $out pipelines and lookups into collections outside the ODM are never cached."""
+    User = db_scope["User"]
+    assert ODM._aggregate_cache_key(User, [{"$out": "copy"}]) is None
+    assert ODM._aggregate_cache_key(User, [{"$lookup": {"from": "Other", "localField": "a", "foreignField": "b", "as": "c"}}]) is None
+    key = ODM._aggregate_cache_key(User, [{"$lookup": {"from": "User", "localField": "a", "foreignField": "b", "as": "c"}}])
+    assert key is not None
+    User(name="Lola", email="lola@gmail.com").save()
+    assert ODM._aggregate_cache_key(User, [{"$lookup": {"from": "User", "localField": "a", "foreignField": "b", "as": "c"}}]) != key
+
+def test_aggregate_cache_separates_databases(db_scope):
+    """Test the same collection in another database neither shares cached results nor replaces the model."""
+    User = db_scope["User"]
+    User(name="Lola", email="lola@gmail.com", age=40).save()
+    other = {}
+    initApp(definitions_path=TEST_YML_FILE_PATH, mongodb_uri=MONGO_URI, db_name=DB_NAME + "_other", scope=other)
+    try:
+        other["User"].save_many([other["User"](name=name, email=f"{name}@gmail.com") for name in ("Ana", "Eva", "Ines")])
+        pipeline = [{"$count": "n"}]
+        assert list(User.aggregate(pipeline, cache=True)) == [{"n": 1}]
+        assert list(other["User"].aggregate(pipeline, cache=True)) == [{"n": 3}]
+        User(name="Pepe", email="pepe@gmail.com", age=30).save()
+        assert list(User.aggregate(pipeline, cache=True)) == [{"n": 2}]
+        assert list(other["User"].aggregate(pipeline, cache=True)) == [{"n": 3}]
+        assert User._model("User") is User and other["User"]._model("User") is other["User"]
+    finally:
+        ODM.getClient(MONGO_URI).drop_database(DB_NAME + "_other")
+
+# ─────────────────────────────────────────────────────────────
+# ⏱️ Profiling Tests
+# ─────────────────────────────────────────────────────────────
+
+def test_profiler_records_operations(db_scope, monkeypatch):
+    """Test timings, document counts and bytes are recorded per model and operation."""
+    events = []
+    monkeypatch.setattr(ODM, "profiler", ODM.Profiler(hooks=[events.append]))
+    User = db_scope["User"]
+    user = User(name="Paco", email="paco@gmail.com", age=18)
+    user.save()
+    user.age = 19
+    user.save()
+    assert len(list(User.find({}))) == 1
+    user.delete()
+
+    summary = User.profile_summary()
+    assert {"insert", "update", "find", "delete"} <= summary.keys()
+    assert summary["find"]["documents"] == 1
+    assert summary["insert"]["bytes"] > 0
+    assert [event["operation"] for event in events] == ["insert", "update", "find", "delete"]
+    assert "User" in ODM.profiler.report()
+
+def test_profiler_explain_sampling(db_scope, monkeypatch):
+    """Test sampled queries record whether an index was used."""
+    monkeypatch.setattr(ODM, "profiler", ODM.Profiler(explain_sample_rate=1.0))
+    User = db_scope["User"]
+    User(name="Paco", email="paco@gmail.com", age=18).save()
+    list(User.find({"name": "Paco"}))
+    list(User.find({"age": 18}))
+    assert User.profile_summary()["find"]["plans"] == {"IXSCAN": 1, "COLLSCAN": 1}
+
+def test_verbose_off(db_scope, monkeypatch, capsys):
+    """Test saves do not print documents when verbose is off."""
+    monkeypatch.setattr(ODM, "verbose", False)
+    User = db_scope["User"]
+    User(name="Paco", email="paco@gmail.com").save()
+    assert capsys.readouterr().out == ""
+
+def test_insert_many_keeps_given_ids(db_scope):
+    """Test insert_many inserts documents that already carry an _id."""
+    User = db_scope["User"]
+    ids = [ObjectId() for _ in range(3)]
+    users, result = User.insert_many([{"_id": id, "name": f"Paco{i}", "email": f"paco{i}@gmail.com"} for i, id in enumerate(ids)])
+    assert result["inserted"] == 3
+    assert sorted(doc["_id"] for doc in get_collection().find({})) == sorted(ids)
+
+# ─────────────────────────────────────────────────────────────
+# 🧭 Index Declaration Tests
+# ─────────────────────────────────────────────────────────────
+
+def test_declared_indexes_created(db_scope):
+    """Test compound and partial indexes declared in the YAML file are created."""
+    indexes = {index["name"]: index for index in get_collection().list_indexes()}
+    assert list(indexes["email_1_age_-1"]["key"].items()) == [("email", 1), ("age", -1)]
+    assert indexes["age_1"]["partialFilterExpression"] == {"age": {"$gte": 18}}
+    assert "name_1" in indexes and "address_loc_2dsphere" in indexes
+
+def test_index_reconciliation(db_scope):
+    """Test a second initApp creates nothing and reports undeclared indexes."""
+    get_collection().create_index([("age", 1), ("name", 1)])
+    scope = {}
+    initApp(definitions_path=TEST_YML_FILE_PATH, mongodb_uri=MONGO_URI, db_name=DB_NAME, scope=scope)
+    assert scope["User"]._index_report == {"created": [], "stale": ["age_1_name_1"]}
+
+def test_index_signature_text_and_options():
+    """Test declared text indexes match the way the server stores them."""
+    declared = ODM._index_specs({"unique_indexes": [], "regular_indexes": [], "location_index": "address_loc",
+                                 "indexes": [{"keys": [["description", "text"], ["name", "text"]], "weights": {"description": 10}}]})
+    existing = [{"name": "description_text_name_text", "key": {"_fts": "text", "_ftsx": 1}, "weights": {"description": 10, "name": 1}},
+                {"name": "address_loc_2dsphere", "key": {"address_loc": "2dsphere"}}]
+    assert ODM._index_plan(declared, existing) == ([], [])
+    # the server lists collations with every default filled in
+    declared = ODM._index_specs({"unique_indexes": [], "regular_indexes": [], "location_index": "address_loc",
+                                 "indexes": [{"keys": ["name"], "collation": {"locale": "es"}}]})
+    collation = {"locale": "es", "caseLevel": False, "caseFirst": "off", "strength": 3, "numericOrdering": False,
+                 "alternate": "non-ignorable", "maxVariable": "punct", "normalization": False, "backwards": False, "version": "57.1"}
+    existing = [{"name": "name_1", "key": {"name": 1}, "collation": collation}, {"name": "address_loc_2dsphere", "key": {"address_loc": "2dsphere"}}]
+    assert ODM._index_plan(declared, existing) == ([], [])
+    existing[0]["collation"] = {**collation, "strength": 2}
+    assert ODM._index_plan(declared, existing)[1] == ["name_1"]
+    text = ODM._index_signature([("description", "text")], {})
+    assert text == ODM._index_signature([("_fts", "text"), ("_ftsx", 1)], {"weights": {"description": 1}, "default_language": "english"})
+    assert text != ODM._index_signature([("_fts", "text"), ("_ftsx", 1)], {"weights": {"description": 1}, "default_language": "spanish"})
+    with pytest.raises(ValueError):
+        ODM._index_specs({"unique_indexes": [], "regular_indexes": [], "location_index": "a", "indexes": [{"keys": ["a"], "colation": {}}]})
+
+def test_initapp_shares_client_and_definitions(db_scope):
+    """Test initApp reuses the process client and the parsed YAML file."""
+    scope = {}
+    with patch.object(ODM.yaml, "safe_load") as safe_load:
+        initApp(definitions_path=TEST_YML_FILE_PATH, mongodb_uri=MONGO_URI, db_name=DB_NAME, scope=scope)
+    safe_load.assert_not_called()
+    assert scope["User"]._db.database.client is db_scope["User"]._db.database.client is ODM.getClient(MONGO_URI)
+
+def test_initapp_without_index_management(db_scope):
+    """Test manage_indexes=False leaves the collection indexes untouched."""
+    get_collection().drop()
+    scope = {}
+    initApp(definitions_path=TEST_YML_FILE_PATH, mongodb_uri=MONGO_URI, db_name=DB_NAME, scope=scope, manage_indexes=False)
+    assert scope["User"]._index_report is None
+    assert [index["name"] for index in get_collection().list_indexes()] in ([], ["_id_"])
+
+# ─────────────────────────────────────────────────────────────
+# 🚀 Pipeline Optimizer Tests
+# ─────────────────────────────────────────────────────────────
+
+def test_optimize_pipeline_rewrites():
+    """Test the foreign filter is pushed down, the join projected and stages merged."""
+    pipeline = [
+        {"$geoNear": {"near": {"type": "Point", "coordinates": [0, 0]}, "distanceField": "distance"}},
+        {"$lookup": {"from": "Company", "localField": "company", "foreignField": "_id", "as": "company"}},
+        {"$unwind": "$company"},
+        {"$match": {"company.name": "Google", "company.size": {"$ne": None}}},
+        {"$group": {"_id": "$company.city", "avg_distance": {"$avg": "$distance"}}},
+    ]
+    assert ODM._lookup_pushdowns(pipeline) == [(1, pipeline[1]["$lookup"], [{"name": "Google"}])]
+    optimized, rewrites = ODM._optimize_pipeline(pipeline, {1: [[1, 2]]})
+    assert optimized[0]["$geoNear"]["query"] == {"company": {"$in": [1, 2]}}
+    assert optimized[1]["$lookup"]["pipeline"] == [{"$project": {"city": 1, "name": 1, "size": 1}}]
+    assert optimized[2:] == pipeline[2:] and len(rewrites) == 3
+    assert "query" not in pipeline[0]["$geoNear"]
+    # too many keys selected: nothing pushed down
+    with patch.object(ODM, "optimizer_max_ids", 1):
+        assert "query" not in ODM._optimize_pipeline(pipeline, {1: [[1, 2]]})[0][0]["$geoNear"]
+    merged, _ = ODM._optimize_pipeline([{"$match": {"a": 1}}, {"$match": {"a": 2}}, {"$project": {"a": 1, "b": 1}}, {"$project": {"a": 1}}], {})
+    assert merged == [{"$match": {"$and": [{"a": 1}, {"a": 2}]}}, {"$project": {"a": 1}}]
+
+def test_aggregate_optimize_same_result(db_scope):
+    """Test an optimized pipeline returns the same documents as the original one."""
+    User = db_scope["User"]
+    boss = get_collection().insert_one({"name": "Paco", "email": "paco@gmail.com"}).inserted_id
+    get_collection().insert_many([{"name": f"Lola{i}", "email": f"lola{i}@gmail.com", "boss": boss if i % 2 else None} for i in range(6)])
+    pipeline = [
+        {"$lookup": {"from": "User", "localField": "boss", "foreignField": "_id", "as": "the_boss"}},
+        {"$match": {"the_boss.name": "Paco"}},
+        {"$project": {"name": 1, "boss_email": "$the_boss.email"}},
+    ]
+    expected = sorted(doc["name"] for doc in User.aggregate(pipeline))
+    assert expected == ["Lola1", "Lola3", "Lola5"]
+    assert sorted(doc["name"] for doc in User.aggregate(pipeline, optimize=True)) == expected
+    # more foreign documents than optimizer_max_ids: read at most one more of them, nothing pushed down
+    with patch.object(ODM, "optimizer_max_ids", 0):
+        assert User.explain_optimization(pipeline)["rewrites"] == ["$lookup User: projected to ['email', 'name']"]
+        assert sorted(doc["name"] for doc in User.aggregate(pipeline, optimize=True)) == expected
+    assert ODM._foreign_keys([{"_id": 1, "tags": [1, 2]}, {"_id": 2, "tags": 2}, {"_id": 3}], "tags") == [1, 2]
+
+# ─────────────────────────────────────────────────────────────
+# 🔗 Reference Prefetch Tests
+# ─────────────────────────────────────────────────────────────
+
+def test_prefetch_references_per_batch(db_scope):
+    """Test prefetch resolves the references of a batch with one query."""
+    User = db_scope["User"]
+    bosses = [User(name=f"Boss{i}", email=f"boss{i}@gmail.com") for i in range(2)]
+    User.save_many(bosses)
+    User.save_many([User(name=f"Paco{i}", email=f"paco{i}@gmail.com", boss=bosses[i % 2]._data["_id"]) for i in range(6)])
+    User._identity_map.clear()
+    with patch.object(User, "_find_by_ids_steps", wraps=User._find_by_ids_steps) as find_by_ids:
+        users = list(User.find({"boss": {"$exists": True}}, batch_size=3).prefetch("boss"))
+    assert find_by_ids.call_count == 2
+    assert [user.ref("boss").name for user in users] == ["Boss0", "Boss1"] * 3
+    assert users[0].ref("boss") is users[2].ref("boss")
+    with pytest.raises(ValueError):
+        User.find({}).prefetch("email")
+
+def test_ref_follows_changes(db_scope):
+    """Test ref loads on demand and reloads when the reference changes."""
+    User = db_scope["User"]
+    boss, other = User(name="Boss", email="boss@gmail.com"), User(name="Other", email="other@gmail.com")
+    User.save_many([boss, other])
+    user = User(name="Paco", email="paco@gmail.com", boss=boss._data["_id"])
+    assert user.ref("boss") is boss
+    user.boss = other._data["_id"]
+    assert user.ref("boss") is other
+    assert ODM._path_values({"education": [{"centre": 1}, {"centre": 2}, {}]}, "education.centre") == ([1, 2], True)
+
+# ─────────────────────────────────────────────────────────────
+# 🌍 Geospatial Query Tests
+# ─────────────────────────────────────────────────────────────
+
+def test_near_pipeline_and_tokens(db_scope):
+    """Test near pages resume from the last distance, skipping the ids already read."""
+    User = db_scope["User"]
+    pipeline, position = User._near_pipeline({"type": "Point", "coordinates": [0, 0]}, 5000, None, {"age": 18}, 2, None)
+    assert pipeline == [{"$geoNear": {"near": {"type": "Point", "coordinates": [0, 0]}, "key": "address_loc", "distanceField": "_distance",
+                                      "spherical": True, "query": {"age": 18}, "maxDistance": 5000}}, {"$limit": 2}]
+    ids = [ObjectId() for _ in range(3)]
+    docs = iter([{"_id": ids[0], "name": "A", "_distance": 1.0}, {"_id": ids[1], "name": "B", "_distance": 2.0},
+                 {"_id": ids[2], "name": "C", "_distance": 2.0}])
+    cursor = ODM.NearCursor(User, MagicMock(alive=True, __next__=lambda self: next(docs)), position=position)
+    assert [(user.name, user.meta()) for user in cursor] == [("A", {"distance": 1.0}), ("B", {"distance": 2.0}), ("C", {"distance": 2.0})]
+    stage = User._near_pipeline({"type": "Point", "coordinates": [0, 0]}, None, None, {"age": 18}, 2, cursor.next_token())[0][0]["$geoNear"]
+    assert stage["minDistance"] == 2.0
+    assert stage["query"] == {"$and": [{"age": 18}, {"_id": {"$nin": ids[1:]}}]}
+    with pytest.raises(ValueError):
+        User.near([0, 0], after="not a token")
+
+def test_near_and_within(db_scope):
+    """Test near sorts by distance and pages with tokens, and within filters by shape."""
+    User = db_scope["User"]
+    for i in range(5):
+        User(name=f"Paco{i}", email=f"paco{i}@gmail.com", address_loc={"type": "Point", "coordinates": [0.01 * i, 0]}).save()
+    first = User.near((0, 0), limit=3)
+    assert [user.name for user in first] == ["Paco0", "Paco1", "Paco2"]
+    assert [user.name for user in User.near((0, 0), limit=3, after=first.next_token())] == ["Paco3", "Paco4"]
+    assert all(user.meta()["distance"] < 2300 for user in User.within({"center": (0, 0), "radius": 2300}))
+    assert sorted(user.name for user in User.within([(0.015, -1), (1, -1), (1, 1), (0.015, 1)])) == ["Paco2", "Paco3", "Paco4"]
+
+# ─────────────────────────────────────────────────────────────
+# 🔎 Text Search Tests
+# ─────────────────────────────────────────────────────────────
+
+def test_text_search_index_ranking():
+    """Test the fallback index ranks terms and honours phrases and exclusions."""
+    index = ODM.TextSearchIndex({"description": 1, "name": 3})
+    index.add(1, {"name": "Paco", "description": "Big Data and cloud"})
+    index.add(2, {"name": "Lola", "description": "Artificial Intelligence, Big Data, Big Data"})
+    index.add(3, {"name": "Big", "description": "Inteligencia Artificial"})
+    assert [id for id, _ in index.search("data")] == [2, 1]
+    assert [id for id, _ in index.search("big")][0] == 3
+    assert [id for id, _ in index.search('"big data" -cloud')] == [2]
+    assert [id for id, _ in index.search("ARTIFICIAL")] == [3, 2]
+
+def test_search_without_text_index(db_scope):
+    """Test Model.search falls back to the in-memory index and sees new writes."""
+    User = db_scope["User"]
+    User.save_many([User(name="Paco Perez", email="paco@gmail.com", age=30), User(name="Lola Perez", email="lola@gmail.com", age=20),
+                    User(name="Paco Lopez", email="lopez@gmail.com", age=40)])
+    assert [user.name for user in User.search("paco perez", fields=["name"])][0] == "Paco Perez"
+    assert User.search("paco", fields=["name"])[0].meta()["score"] > 0
+    assert [user.name for user in User.search("paco", fields=["name"], filter={"age": {"$gt": 35}})] == ["Paco Lopez"]
+    results = User.search("lola", fields=["name"], project=["email"])
+    assert [(doc["email"], "name" in doc) for doc in results] == [("lola@gmail.com", False)] and results[0]["score"] > 0
+    # the ranked ids are read in batches, only until limit of them match
+    with patch.object(ODM, "search_batch_size", 1), patch.object(User._db, "find", wraps=User._db.find) as find:
+        assert [user.name for user in User.search("paco", fields=["name"], filter={"age": {"$gt": 35}})] == ["Paco Lopez"]
+        assert find.call_count == 2
+        assert len(User.search("paco", fields=["name"], filter={"age": {"$gt": 25}}, limit=1)) == 1
+        assert find.call_count == 3
+    User(name="Lola Lopez", email="lola2@gmail.com").save()
+    assert len(User.search("lola", fields=["name"], limit=5)) == 2
+    with pytest.raises(ValueError):
+        User.search("paco")
+
+def test_search_rechecks_dropped_text_index(db_scope):
+    """Test a text search that fails falls back to the in-memory index and checks the text index again."""
+    User = db_scope["User"]
+    User(name="Paco Perez", email="paco@gmail.com").save()
+    User._text_index = {"name": 1} # dropped since it was checked
+    with patch.object(User, "_text_search_steps", side_effect=ODM.OperationFailure("text index required for $text query")):
+        assert [user.name for user in User.search("paco", fields=["name"])] == ["Paco Perez"]
+    assert User._text_index is ODM._MISSING
+    User.search("paco", fields=["name"])
+    assert User._text_index is None
+
+def test_search_with_text_index(db_scope):
+    """Test Model.search uses a text index and ranks by its score."""
+    User = db_scope["User"]
+    get_collection().create_index([("name", "text")])
+    User._text_index = ODM._MISSING
+    User.save_many([User(name="Paco Paco", email="paco@gmail.com"), User(name="Paco Lopez", email="lopez@gmail.com")])
+    results = User.search("paco", limit=1)
+    assert [user.name for user in results] == ["Paco Paco"] and results[0].meta()["score"] > 0
+
+# ─────────────────────────────────────────────────────────────
+# 🧾 Unit of Work Tests
+# ─────────────────────────────────────────────────────────────
+
+def test_session_coalesces_writes(db_scope):
+    """Test a session writes every change of the block with one bulk_write."""
+    User = db_scope["User"]
+    existing = User(name="Lola", email="lola@gmail.com")
+    existing.save()
+    with patch.object(User._db, "bulk_write", wraps=User._db.bulk_write) as bulk_write, ODM.session() as s:
+        boss = User(name="Boss", email="boss@gmail.com")
+        boss.save()
+        paco = User(name="Paco", email="paco@gmail.com", boss=boss)
+        paco.save()
+        paco.age = 30
+        paco.save()
+        existing.age = 20
+        existing.save()
+        existing.email = "lola2@gmail.com"
+        existing.save()
+        assert get_collection().count_documents({}) == 1
+    assert bulk_write.call_count == 1
+    assert s.result == {"inserted": 2, "updated": 1, "deleted": 0, "errors": []}
+    assert get_collection().find_one({"name": "Paco"})["boss"] == boss._data["_id"]
+    assert get_collection().find_one({"name": "Lola"}) == {"_id": existing._data["_id"], "name": "Lola", "email": "lola2@gmail.com", "age": 20}
+
+def test_session_geocodes_before_transaction(db_scope):
+    """Test a transactional session resolves the addresses before starting the transaction."""
+    User = db_scope["User"]
+    client = User._db.database.client
+    with patch.object(User, "_geocode", return_value={}) as geocode, patch.object(client, "start_session", side_effect=RuntimeError):
+        with pytest.raises(RuntimeError):
+            with ODM.session(transaction=True):
+                User(name="Paco", email="paco@gmail.com", address="Madrid").save()
+    geocode.assert_called_once()
+    assert get_collection().count_documents({}) == 0
+
+def test_session_deletes_and_discards(db_scope):
+    """Test deletes are flushed by _id and a failing block writes nothing."""
+    User = db_scope["User"]
+    existing = User(name="Lola", email="lola@gmail.com")
+    existing.save()
+    with pytest.raises(RuntimeError):
+        with ODM.session():
+            paco = User(name="Paco", email="paco@gmail.com")
+            paco.save()
+            raise RuntimeError
+    assert "_id" not in paco._data and get_collection().count_documents({}) == 1
+    with ODM.session() as s:
+        existing.delete()
+        paco.save()
+        paco.delete()
+    assert s.result["deleted"] == 1 and get_collection().count_documents({}) == 0
+    assert User.find_by_id(existing._data["_id"]) is None
+
+def test_session_flush_failures_keep_instances_new(db_scope):
+    """Test a flush that fails leaves the instances it did not write unsaved."""
+    User = db_scope["User"]
+    boss = User(name="Boss", email="boss@gmail.com")
+    with pytest.raises(ValueError):
+        with ODM.session():
+            paco = User(name="Paco", email="paco@gmail.com", boss=boss)
+            paco.save()
+    assert "_id" not in paco._data and paco.boss is boss
+    with pytest.raises(RuntimeError), patch.object(User._db, "bulk_write", side_effect=RuntimeError):
+        with ODM.session():
+            boss.save()
+            paco.save()
+    assert "_id" not in boss._data and "_id" not in paco._data and paco.boss is boss
+    assert get_collection().count_documents({}) == 0
+
+def test_merge_updates():
+    """Test later changes to a path win over earlier ones of it, its parents or children."""
+    merged = ODM._merge_updates([{"$set": {"a.b": 1, "c": 1}, "$unset": {"d": ""}}, {"$set": {"a": {"b": 2}, "d": 3}, "$unset": {"c": ""}}])
+    assert merged == {"$set": {"a": {"b": 2}, "d": 3}, "$unset": {"c": ""}}
+
+# ─────────────────────────────────────────────────────────────
+# 📄 Keyset Pagination Tests
+# ─────────────────────────────────────────────────────────────
+
+def test_paginate_keyset(db_scope):
+    """Test pages follow the sort, break ties by _id and end with a None token."""
+    User = db_scope["User"]
+    User.save_many([User(name=f"Paco{i}", email=f"paco{i}@gmail.com", age=i // 3) for i in range(8)])
+    pages, token = [], None
+    while True:
+        page, token = User.find({"age": {"$lt": 3}}).paginate(sort=[("age", -1)], page_size=3, after=token)
+        pages.append([user.name for user in page])
+        if token is None:
+            break
+    assert pages == [["Paco7", "Paco6", "Paco5"], ["Paco4", "Paco3", "Paco2"], ["Paco1", "Paco0"]]
+    page, token = User.find({}).paginate(sort=[("name", 1)], page_size=8)
+    assert len(page) == 8 and token is None
+    _, token = User.find({}).paginate(sort=[("name", 1)], page_size=2)
+    with pytest.raises(ValueError):
+        User.find({}).paginate(sort=[("age", 1)], after=token)
+    # documents without the sort key come first ascending and last descending, none is skipped
+    User.save_many([User(name=f"Lola{i}", email=f"lola{i}@gmail.com") for i in range(3)])
+    for direction in (1, -1):
+        names, token = [], None
+        while True:
+            page, token = User.find({}).paginate(sort=[("age", direction)], page_size=2, after=token)
+            names += [user.name for user in page]
+            if token is None:
+                break
+        assert len(set(names)) == len(names) == 11
+        assert sorted(names[:3] if direction == 1 else names[-3:]) == ["Lola0", "Lola1", "Lola2"]
+
+# ─────────────────────────────────────────────────────────────
+# 📄 Materialized View Tests
+# ─────────────────────────────────────────────────────────────
+
+
+def test_paginate_partial_models(db_scope):
+    """Test a find with fields pages to the end, its models without the sort keys they did not load."""
+    User = db_scope["User"]
+    User.save_many([User(name=f"Paco{i}", email=f"paco{i}@gmail.com", age=i % 3) for i in range(5)])
+    pages, token = [], None
+    while True:
+        page, token = User.find({}, fields=["email"]).paginate(sort=[("age", 1)], page_size=2, after=token)
+        pages.append([user.email for user in page])
+        if token is None:
+            break
+    assert pages == [["paco0@gmail.com", "paco3@gmail.com"], ["paco1@gmail.com", "paco4@gmail.com"], ["paco2@gmail.com"]]
+    assert page[0]._data.keys() == {"_id", "email"} and page[0].age == 2
+
+def test_view_rows_and_filters():
+    """Test view filters and group keys follow MongoDB array semantics."""
+    person = {"_id": 1, "company": "c1", "education": [{"centre": "a", "year": 2016}, {"centre": "b", "year": 2018}]}
+    assert ODM._matches(person, {"education.year": {"$gte": 2017}})
+    assert not ODM._matches(person, {"education.year": {"$gt": "2017"}})
+    assert ODM._matches(person, {"$or": [{"company": "c2"}, {"education.centre": {"$in": ["b"]}}], "age": None})
+    assert not ODM._matches(person, {"company": {"$exists": False}})
+    view = {"group_by": "education.centre", "count": "studies", "size": {"degrees": "education"}}
+    assert ODM._view_rows(view, person) == {"a": {"studies": 1, "degrees": 2}, "b": {"studies": 1, "degrees": 2}}
+    assert ODM._view_rows({**view, "match": {"company": "c2"}}, person) == {}
+
+def test_views_maintained_and_rebuilt(views_scope):
+    """Test saves, bulk saves and deletes update the views, and a rebuild gives the same result."""
+    User = views_scope["User"]
+    paco = User(name="Paco", email="paco@gmail.com", age=17)
+    paco.save()
+    User.save_many([User(name=f"Lola{i}", email=f"lola{i}@gmail.com", age=30) for i in range(3)])
+    assert User.view("users_per_age", 17) == {"_id": 17, "users": 1}
+    assert User.view("users_per_age", 30) == {"_id": 30, "users": 3}
+    assert User.view("adults", paco._data["_id"]) is None
+    paco.age = 30
+    paco.save()
+    assert User.view("users_per_age", 17) is None
+    assert User.view("users_per_age", 30)["users"] == 4
+    assert User.view("adults", paco._data["_id"]) == {"_id": paco._data["_id"], "name": "Paco", "age": 30}
+    paco.delete()
+    assert User.view("users_per_age", 30)["users"] == 3
+    assert len(User.view("adults")) == 3
+    with pytest.raises(ValueError):
+        User.view("unknown")
+    incremental = sorted(User.view("users_per_age"), key=lambda row: row["_id"])
+    User._db.database["users_per_age"].update_one({"_id": 30}, {"$inc": {"users": 5}}) # drift
+    User.rebuild_views()
+    assert sorted(User.view("users_per_age"), key=lambda row: row["_id"]) == incremental
+    assert len(User.view("adults")) == 3
+
+def test_views_deletes_use_stored_documents(views_scope):
+    """Test deletes remove from the views the documents as stored, not the unsaved changes."""
+    User = views_scope["User"]
+    paco = User(name="Paco", email="paco@gmail.com", age=17)
+    paco.save()
+    paco.age = 30
+    paco.delete()
+    assert User.view("users_per_age") == []
+    lola = User(name="Lola", email="lola@gmail.com", age=20)
+    lola.save()
+    with ODM.session():
+        lola.age = 15
+        lola.delete()
+    assert User.view("users_per_age") == [] and User.view("adults") == []
+    pepe = User(name="Pepe", email="pepe@gmail.com", age=40)
+    pepe.save()
+    get_collection().delete_one({"_id": pepe._data["_id"]}) # outside the ODM: the views drift
+    pepe.delete()
+    assert User.view("users_per_age", 40) == {"_id": 40, "users": 1}
+
+# ─────────────────────────────────────────────────────────────
+# 📄 Columnar Extraction Tests
+# ─────────────────────────────────────────────────────────────
+
+def test_to_columns(db_scope):
+    """Test columns follow the query, its sort and limit, with None for missing fields."""
+    User = db_scope["User"]
+    User.save_many([User(name=f"Paco{i}", email=f"paco{i}@gmail.com", age=i) for i in range(4)] + [User(name="Lola", email="lola@gmail.com")])
+    columns = User.find({}).sort("name", 1).to_columns(["name", "age"])
+    assert columns == {"name": ["Lola", "Paco0", "Paco1", "Paco2", "Paco3"], "age": [None, 0, 1, 2, 3]}
+    assert User.find({"age": {"$gte": 1}}).sort("age", -1).limit(2).to_columns(["age"]) == {"age": [3, 2]}
+
+def test_to_numpy(db_scope):
+    """Test numpy columns are masked where values are missing and 2-D for paths through arrays."""
+    np = pytest.importorskip("numpy")
+    User = db_scope["User"]
+    get_collection().insert_many([
+        {"name": "Paco", "email": "paco@gmail.com", "age": 30, "address_loc": {"type": "Point", "coordinates": [-3.7, 40.4]}},
+        {"name": "Lola", "email": "lola@gmail.com", "address_loc": {"type": "Point", "coordinates": [2.1, 41.3]}},
+        {"name": "Pepe", "email": "pepe@gmail.com", "age": 20},
+    ])
+    columns = User.find({}, batch_size=2).sort("name", 1).to_numpy(["age", "name", "address_loc.coordinates"], dtypes={"age": "float64"})
+    assert columns["age"].dtype == np.float64
+    assert columns["age"].mask.tolist() == [True, False, False]
+    assert columns["age"].mean() == 25
+    assert columns["name"].tolist() == ["Lola", "Paco", "Pepe"]
+    coordinates = columns["address_loc.coordinates"]
+    assert coordinates.shape == (3, 2)
+    assert coordinates[:, 0].tolist() == [2.1, -3.7, None]
+
+# ─────────────────────────────────────────────────────────────
+# 📄 Partial Model Tests
+# ─────────────────────────────────────────────────────────────
+
+def test_find_partial_models(views_scope):
+    """Test partial models load missing fields per batch and saves keep the fields never loaded."""
+    User = views_scope["User"]
+    User.save_many([User(name=f"Paco{i}", email=f"paco{i}@gmail.com", age=20 + i) for i in range(5)])
+    users = list(User.find({}, batch_size=2, fields=["name"]).sort("name", 1))
+    assert users[0]._data.keys() == {"_id", "name"}
+    with patch.object(User._db, "find", wraps=User._db.find) as find:
+        assert [user.age for user in users] == [20, 21, 22, 23, 24]
+        assert users[1].email == "paco1@gmail.com"
+    assert find.call_count == 4 # age for each of the 3 batches, email for the first one
+    assert "email" not in users[2]._data
+
+    users[2].name = "Lola"
+    users[2].save()
+    assert get_collection().find_one({"name": "Lola"})["email"] == "paco2@gmail.com"
+    users[3].age = 40 # loaded first, so the views move it from 23 to 40
+    users[3].save()
+    assert User.view("users_per_age", 23) is None and User.view("users_per_age", 40)["users"] == 1
+    users[4].delete()
+    assert User.view("users_per_age", 24) is None
+    assert len(User.view("adults")) == 4
+    with pytest.raises(AttributeError):
+        User.find({}, fields=["phone"])
+    # grouped by the documents the cursor received from the server, whatever their number
+    cursor = ModelCursor(User, MagicMock(retrieved=3), fields=["name"])
+    first = [cursor.hydrate({"_id": i, "name": "Paco"}) for i in range(3)]
+    cursor.cursor.retrieved = 4
+    last = cursor.hydrate({"_id": 3, "name": "Paco"})
+    assert first[0]._partial is first[2]._partial is not last._partial
+
+# ─────────────────────────────────────────────────────────────
+# 📄 Parallel Scan Tests
+# ─────────────────────────────────────────────────────────────
+
+def count_partition(cursor):
+    # module function, so process workers can unpickle it
+    return sum(1 for _ in cursor)
+
+def test_partition_queries():
+    """Test key ranges cover every document once, also those without the key."""
+    queries = ODM._partition_queries({"age": {"$gte": 18}}, "_id", [10, 20])
+    assert queries == [
+        {"age": {"$gte": 18}, "_id": {"$not": {"$gte": 10}}},
+        {"age": {"$gte": 18}, "_id": {"$gte": 10, "$lt": 20}},
+        {"age": {"$gte": 18}, "_id": {"$gte": 20}},
+    ]
+    assert ODM._partition_queries({}, "_id", []) == [{}]
+
+def test_parallel_scan_threads(db_scope):
+    """Test threads stream every matching model once and fn results come per partition."""
+    User = db_scope["User"]
+    User.save_many([User(name=f"Paco{i}", email=f"paco{i}@gmail.com", age=i) for i in range(50)])
+    names = [user.name for user in User.find({"age": {"$gte": 10}}, batch_size=7).parallel(4)]
+    assert sorted(names) == sorted(f"Paco{i}" for i in range(10, 50))
+    counts = User.find({}).parallel(4, count_partition, key="age")
+    assert sum(counts) == 50 and len(counts) > 1
+    with pytest.raises(ValueError):
+        User.find({}).limit(5).parallel(2)
+    with pytest.raises(ValueError):
+        User.find({}).parallel(2, executor="process")
+
+def test_parallel_scan_processes(db_scope):
+    """Test process workers build the model again and return the fn results."""
+    User = db_scope["User"]
+    User.save_many([User(name=f"Paco{i}", email=f"paco{i}@gmail.com", age=i) for i in range(20)])
+    assert sum(User.find({"age": {"$lt": 15}}).parallel(2, count_partition, executor="process")) == 15
+
+# ─────────────────────────────────────────────────────────────
+# 📄 Referential Integrity Tests
+# ─────────────────────────────────────────────────────────────
+
+def test_without_ids():
+    """Test nullified copies go through arrays like MongoDB paths."""
+    a, b = ObjectId(), ObjectId()
+    person = {"company": a, "education": [{"centre": a, "name": "x"}, {"centre": b}], "tags": [a, b]}
+    assert ODM._without_ids(person, ["company"], {a}) == {**person, "company": None}
+    assert ODM._without_ids(person, ["education", "centre"], {a})["education"] == [{"centre": None, "name": "x"}, {"centre": b}]
+    assert ODM._without_ids(person, ["tags"], {a})["tags"] == [b]
+    assert ODM._without_ids({"name": "x"}, ["company"], {a}) == {"name": "x"}
+
+def test_delete_by_id_cascade_and_restrict(views_scope, monkeypatch):
+    """Test deletes go by _id and cascade or restrict through the declared references."""
+    User = views_scope["User"]
+    boss = User(name="Boss", email="boss@gmail.com")
+    boss.save()
+    managers = [User(name=f"Manager{i}", email=f"manager{i}@gmail.com", boss=boss._data["_id"]) for i in range(2)]
+    User.save_many(managers)
+    User.save_many([User(name=f"Paco{i}", email=f"paco{i}@gmail.com", boss=managers[i % 2]._data["_id"]) for i in range(4)])
+    get_collection().update_one({"_id": boss._data["_id"]}, {"$set": {"age": 50}}) # changed by someone else
+
+    monkeypatch.setitem(User._on_delete, "boss", "restrict")
+    with pytest.raises(ValueError):
+        boss.delete()
+    assert get_collection().count_documents({}) == 7
+    assert User.delete_many({}) == 7 # documents deleted together don't restrict each other
+    assert get_collection().count_documents({}) == 0
+
+    User.save_many([boss, *managers], insert=True)
+    User.save_many([User(name=f"Paco{i}", email=f"paco{i}@gmail.com", boss=managers[i % 2]._data["_id"]) for i in range(4)])
+    monkeypatch.setitem(User._on_delete, "boss", "cascade")
+    with patch.object(User._db, "delete_many", wraps=User._db.delete_many) as delete_many:
+        assert User.delete_many({"name": "Boss"}) == 7
+    assert delete_many.call_count == 1 # one cascade loop of the same model, one delete
+    assert get_collection().count_documents({}) == 0
+    assert User.find_by_id(managers[0]._data["_id"]) is None
+    assert User.view("users_per_age") == [] and User.view("adults") == []
+
+def test_delete_policies_with_async_models(db_scope, monkeypatch):
+    """Test the async models of the same database don't replace the references of the sync ones."""
+    User = db_scope["User"]
+    monkeypatch.setitem(User._on_delete, "boss", "cascade")
+    asyncio.run(initAppAsync(definitions_path=TEST_YML_FILE_PATH, mongodb_uri=MONGO_URI, db_name=DB_NAME, scope={}))
+    boss = User(name="Boss", email="boss@gmail.com")
+    boss.save()
+    User(name="Paco", email="paco@gmail.com", boss=boss._data["_id"]).save()
+    assert User._reference("boss") is User
+    assert User.delete_many({"name": "Boss"}) == 2
+    assert get_collection().count_documents({}) == 0
+
+def test_session_delete_restrict_before_writes(db_scope, monkeypatch):
+    """Test a session checks restrict, against its own saves too, before writing anything."""
+    User = db_scope["User"]
+    monkeypatch.setitem(User._on_delete, "boss", "restrict")
+    boss = User(name="Boss", email="boss@gmail.com")
+    boss.save()
+    paco = User(name="Paco", email="paco@gmail.com", boss=boss._data["_id"])
+    paco.save()
+    with pytest.raises(ValueError), patch.object(User._db, "bulk_write", wraps=User._db.bulk_write) as bulk_write:
+        with ODM.session():
+            lola = User(name="Lola", email="lola@gmail.com")
+            lola.save()
+            boss.delete()
+    bulk_write.assert_not_called()
+    assert "_id" not in lola._data and get_collection().count_documents({}) == 2
+    with ODM.session() as s: # no longer referenced once the session is written
+        paco.boss = None
+        paco.save()
+        boss.delete()
+    assert s.result["deleted"] == 1 and get_collection().count_documents({}) == 1
+    with pytest.raises(ValueError): # referenced by a document of the session
+        with ODM.session():
+            User(name="Lola", email="lola@gmail.com", boss=paco).save()
+            paco.delete()
+    assert get_collection().count_documents({}) == 1
+
+def test_delete_nullify(views_scope):
+    """Test nullify updates the referencing documents with one update_many (per page with views)."""
+    User = views_scope["User"]
+    boss = User(name="Boss", email="boss@gmail.com")
+    boss.save()
+    User.save_many([User(name=f"Paco{i}", email=f"paco{i}@gmail.com", boss=boss._data["_id"]) for i in range(3)])
+    with patch.object(User._db, "update_many", wraps=User._db.update_many) as update_many:
+        boss.delete()
+    assert update_many.call_count == 1
+    assert [doc.get("boss", "missing") for doc in get_collection().find({})] == [None, None, None]
+    # models with views nullify a page of nullify_batch_size documents at a time
+    boss = User(name="Boss", email="boss@gmail.com", age=50)
+    boss.save()
+    get_collection().update_many({"_id": {"$ne": boss._data["_id"]}}, {"$set": {"boss": boss._data["_id"]}})
+    with patch.object(ODM, "nullify_batch_size", 2), patch.object(User._db, "update_many", wraps=User._db.update_many) as update_many:
+        boss.delete()
+    assert update_many.call_count == 2
+    assert [doc["boss"] for doc in get_collection().find({})] == [None, None, None]
+    assert User.view("users_per_age", 50) is None
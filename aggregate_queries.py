@@ -1,136 +1,123 @@
 from ODM import initApp
 import re
 
-initApp(scope=globals())
-
-
-print('Exercise 1')
-res = EducationalCentre.aggregate([
-    { '$match': { 'name': { '$in': [ "Universidad Autónoma de Madrid", "Universidad Politecnica de Madrid" ] } } },
-    { 
-        '$lookup': { 
-            'from': "Person", 
-            'localField': "_id", 
-            'foreignField': "education.education_centre",
-            'as': "students_who_went_there" 
-        } 
-    },
-    { '$unwind': "$students_who_went_there" },
-    { '$replaceRoot': { 'newRoot': "$students_who_went_there" } },
-    { '$project': { 'name': 1 } }
-])
-for r in res: print(r)
-
-
-print('Exercise 2')
-res = Person.aggregate([
-    { '$match': { 'address': re.compile('Madrid', re.IGNORECASE) } },
-    { 
-        '$lookup': {
-            'from': 'EducationalCentre',
-            'localField': 'education.education_centre',
-            'foreignField': '_id',
-            'as': 'education'
-        }
-    },
-    { '$unwind': '$education' },
-    { '$replaceRoot': { 'newRoot': '$education' } },
-    { '$group': { '_id': '$name' } }
-])
-for r in res: print(r)
-
-
-print('Exercise 3')
-res = Person.aggregate([
-    {
-        '$match': {
-            '$or': [
-                { 'description': { '$regex': "Big Data", '$options': "i" } },
-                { 'description': { '$regex': "Artificial Intelligence", '$options': "i" } }
-            ]
-        }
-    },
-    { '$project': { 'name': 1, 'description': 1 } }
-])
-for r in res: print(r)
-
-
-print('Exercise 4')
-Person.aggregate([
-    { '$match': { 'education.year_graduated': { '$gte': 2017 } } },
-    { '$out': 'people_graduated_in_2017_or_later' }
-])
-print('Seemed to run successfully, check in the DB if the collection \'people_graduated_in_2017_or_later\' exists')
-
-
-print('Exercise 5')
-res = Person.aggregate([
-    {
-        '$lookup': {
-            'from': 'Company',
-            'localField': 'company',
-            'foreignField': '_id',
-            'as': 'the_company'
+# exercise number => (model, description, pipeline), also used by scripts/benchmark.py
+PIPELINES = {
+    1: ('EducationalCentre', 'People who have studied at the UPM or UAM', [
+        { '$match': { 'name': { '$in': [ "Universidad Autónoma de Madrid", "Universidad Politecnica de Madrid" ] } } },
+        { 
+            '$lookup': { 
+                'from': "Person", 
+                'localField': "_id", 
+                'foreignField': "education.education_centre",
+                'as': "students_who_went_there" 
+            } 
+        },
+        { '$unwind': "$students_who_went_there" },
+        { '$replaceRoot': { 'newRoot': "$students_who_went_there" } },
+        { '$project': { 'name': 1 } }
+    ]),
+    2: ('Person', 'Universities where people residing in Madrid have studied', [
+        { '$match': { 'address': re.compile('Madrid', re.IGNORECASE) } },
+        { 
+            '$lookup': {
+                'from': 'EducationalCentre',
+                'localField': 'education.education_centre',
+                'foreignField': '_id',
+                'as': 'education'
+            }
+        },
+        { '$unwind': '$education' },
+        { '$replaceRoot': { 'newRoot': '$education' } },
+        { '$group': { '_id': '$name' } }
+    ]),
+    3: ('Person', 'People whose description mentions Big Data or Artificial Intelligence', [
+        {
+            '$match': {
+                '$or': [
+                    { 'description': { '$regex': "Big Data", '$options': "i" } },
+                    { 'description': { '$regex': "Artificial Intelligence", '$options': "i" } }
+                ]
+            }
+        },
+        { '$project': { 'name': 1, 'description': 1 } }
+    ]),
+    4: ('Person', 'People who graduated in 2017 or later, saved in a new collection', [
+        { '$match': { 'education.year_graduated': { '$gte': 2017 } } },
+        { '$out': 'people_graduated_in_2017_or_later' }
+    ]),
+    5: ('Person', 'Average number of studies of people who work at Microsoft', [
+        {
+            '$lookup': {
+                'from': 'Company',
+                'localField': 'company',
+                'foreignField': '_id',
+                'as': 'the_company'
+            }
+        },
+        { '$match': { 'the_company.name': 'Microsoft' } },
+        { '$project': { 'n_studies': { '$size': '$education' } } },
+        {
+            '$group': {
+                '_id': None,
+                'avg_studies': { '$avg': '$n_studies' }
+            }
         }
-    },
-    { '$match': { 'the_company.name': 'Microsoft' } },
-    { '$project': { 'n_studies': { '$size': '$education' } } },
-    {
-        '$group': {
-            '_id': None,
-            'avg_studies': { '$avg': '$n_studies' }
+    ]),
+    6: ('Person', 'Average distance to the Google office of its workers', [
+        {
+            '$geoNear': {
+                'near': { 'type': 'Point', 'coordinates': [-3.692602, 40.456426] },
+                'distanceField': 'distance_to_office',
+                'spherical': True
+            }
+        },
+        {
+            '$lookup': {
+                'from': 'Company',
+                'localField': 'company',
+                'foreignField': '_id',
+                'as': 'company'
+            }
+        },
+        { '$unwind': '$company' },
+        { '$match': { 'company.name': 'Google' } },
+        {
+            '$group': {
+                '_id': None,
+                'avg_distance': { '$avg': '$distance_to_office' }
+            }
         }
-    }
-])
-for r in res: print(r)
+    ]),
+    7: ('Person', 'Three universities that appear most often as study centre', [
+        {
+            '$lookup': {
+                'from': 'EducationalCentre',
+                'localField': 'education.education_centre',
+                'foreignField': '_id',
+                'as': 'education'
+            }
+        },
+        { '$unwind': '$education' },
+        { 
+            '$group': {
+                '_id': '$education.name',
+                'count': { '$sum': 1 }
+            }
+        },
+        { '$sort': { 'count': -1 } },
+        { '$limit': 3 },
+    ]),
+}
 
 
-print('Exercise 6')
-res = Person.aggregate([
-    {
-        '$geoNear': {
-            'near': { 'type': 'Point', 'coordinates': [-3.692602, 40.456426] },
-            'distanceField': 'distance_to_office',
-            'spherical': True
-        }
-    },
-    {
-        '$lookup': {
-            'from': 'Company',
-            'localField': 'company',
-            'foreignField': '_id',
-            'as': 'company'
-        }
-    },
-    { '$unwind': '$company' },
-    { '$match': { 'company.name': 'Google' } },
-    {
-        '$group': {
-            '_id': None,
-            'avg_distance': { '$avg': '$distance_to_office' }
-        }
-    }
-])
-for r in res: print(r)
-
-print('Exercise 7')
-res = Person.aggregate([
-    {
-        '$lookup': {
-            'from': 'EducationalCentre',
-            'localField': 'education.education_centre',
-            'foreignField': '_id',
-            'as': 'education'
-        }
-    },
-    { '$unwind': '$education' },
-    { 
-        '$group': {
-            '_id': '$education.name',
-            'count': { '$sum': 1 }
-        }
-    },
-    { '$sort': { 'count': -1 } },
-    { '$limit': 3 },
-])
-for r in res: print(r)
+if __name__ == '__main__':
+    models = {}
+    initApp(scope=models)
+    for exercise, (model, description, pipeline) in PIPELINES.items():
+        print(f'Exercise {exercise}')
+        res = models[model].aggregate(pipeline)
+        if exercise == 4:
+            print('Seemed to run successfully, check in the DB if the collection \'people_graduated_in_2017_or_later\' exists')
+        else:
+            for r in res: print(r)
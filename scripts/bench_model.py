@@ -0,0 +1,81 @@
+"""
+Micro-benchmark of Model instances: construction, hydration from database
+documents, attribute access and memory per instance. It compares the
+classes built by initApp with a copy of the previous dict based Model.
+It does not need a running MongoDB.
+
+    python -m scripts.bench_model [n_documents]
+"""
+import gc, sys, time, tracemalloc
+
+from ODM import Model
+
+
+class LegacyModel:
+    # the Model implementation before __slots__ and the compiled constructor
+    def __init__(self, **kwargs):
+        super().__setattr__('_data', {})
+        for key in kwargs.keys():
+            if key not in self._required_vars and key not in self._admissible_vars and key != '_id' and key != self._location_var:
+                raise AttributeError(f'\'{key}\' not allowed in {self.__class__.__name__}')
+        self._data.update(kwargs)
+
+    def __getattr__(self, name):
+        if name in {'_modified_vars', '_required_vars', '_admissible_vars', '_db', '_data', '_location_var'}:
+            return super().__getattribute__(name)
+        try: return self._data[name]
+        except KeyError: raise AttributeError(name)
+
+
+REQUIRED = ['name', 'email']
+ADMISSIBLE = ['description', 'company', 'education', 'address']
+
+
+def documents(n: int) -> list[dict]:
+    return [{
+        '_id': i, 'name': f'person{i}', 'email': f'person{i}@email.com', 'description': 'Data analyst',
+        'company': i % 100, 'address': 'Calle de Serrano, 110, 28006 Madrid',
+        'education': [{'name': 'data science', 'year_graduated': 2022, 'education_centre': i % 10}],
+    } for i in range(n)]
+
+
+def timed(label: str, fn, docs: list[dict]) -> list:
+    gc.disable() # keep collections of the previous runs out of the timings
+    start = time.perf_counter()
+    result = fn(docs)
+    elapsed = time.perf_counter() - start
+    gc.enable()
+    print(f'{label:<34} {elapsed * 1e3:9.1f} ms {elapsed / len(docs) * 1e9:9.0f} ns/doc')
+    return result
+
+
+def memory(label: str, fn, docs: list[dict]) -> None:
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    instances = fn(docs)
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    size = sum(stat.size_diff for stat in after.compare_to(before, 'filename'))
+    print(f'{label:<34} {size / len(instances):9.0f} bytes/instance')
+
+
+def main(n: int) -> None:
+    Legacy = type('Person', (LegacyModel,), {'_required_vars': set(REQUIRED), '_admissible_vars': set(ADMISSIBLE), '_location_var': 'address_loc'})
+    Person = type('Person', (Model,), {'__slots__': ()})
+    Person._compile(REQUIRED, ADMISSIBLE, 'address_loc')
+
+    print(f'{n} documents\n')
+    legacy = timed('legacy Model(**doc)', lambda docs: [Legacy(**doc) for doc in docs], documents(n))
+    timed('compiled Model(**doc)', lambda docs: [Person(**doc) for doc in docs], documents(n))
+    compiled = timed('Model._from_doc(doc) (cursor path)', lambda docs: [Person._from_doc(doc) for doc in docs], documents(n))
+    print()
+    timed('legacy attribute access', lambda instances: [(p.name, p.email, p._id) for p in instances], legacy)
+    timed('compiled attribute access', lambda instances: [(p.name, p.email, p._id) for p in instances], compiled)
+    del legacy, compiled
+    print()
+    memory('legacy instance', lambda docs: [Legacy(**doc) for doc in docs], documents(n))
+    memory('compiled instance', lambda docs: [Person._from_doc(doc) for doc in docs], documents(n))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 200_000)
@@ -0,0 +1,211 @@
+"""
+Benchmark suite of the ODM against a local MongoDB.
+
+It fills a separate database with seeded synthetic data (companies,
+educational centres and people with education arrays, references and
+already resolved GeoJSON points, so nothing is geocoded) and times:
+
+- bulk_load: Model.save_many of every document
+- find_by_id: cold (database) and warm (identity map) lookups
+- scan / scan_raw / scan_batches: full ModelCursor iterations of Person
+- scan_prefetch: the same scan resolving company and education centres per batch
+- scan_fields: the same scan reading only the name (partial models)
+- scan_parallel: the same scan split in 4 _id ranges read by 4 threads
+- paginate: every page of Person by name with keyset tokens
+- update_save: single field changes saved one by one
+- search: Model.search on the description text index (exercise 3 without regexes)
+- exercise_1 .. exercise_7: the pipelines of aggregate_queries.py, also with
+  aggregate(optimize=True) as exercise_N_optimized
+- delete_company: Company.delete_many of one company, nullifying the company of its people
+- view_read / rebuild_views: the Person views (exercises 4, 5 and 7 kept up
+  to date by the writes above) read per company, and recomputed from scratch
+
+Results are written as JSON so two runs (e.g. two commits) can be compared:
+
+    python -m scripts.benchmark --people 100000 --output before.json
+    python -m scripts.benchmark --people 100000 --output after.json --compare before.json
+"""
+import argparse, json, platform, random, subprocess, time
+from datetime import datetime, timezone
+
+from bson.objectid import ObjectId
+
+import ODM
+from ODM import initApp
+from aggregate_queries import PIPELINES
+
+# (city, longitude, latitude, postcode prefix)
+CITIES = [
+    ('Madrid', -3.7038, 40.4168, '280'),
+    ('Barcelona', 2.1734, 41.3851, '080'),
+    ('Las Palmas de Gran Canaria', -15.4134, 28.1235, '350'),
+    ('Valencia', -0.3763, 39.4699, '460'),
+    ('Sevilla', -5.9845, 37.3891, '410'),
+]
+STREETS = ['Calle de Serrano', 'Calle de Alcalá', 'Paseo de la Castellana', 'Carrer de Balmes', 'Avinguda Diagonal', 'Calle Mayor']
+COMPANIES = ['Microsoft', 'Google', 'Deloitte', 'Accenture', 'Custom Solutions SA']
+CENTRES = ['Universidad Politecnica de Madrid', 'Universidad Autónoma de Madrid', 'Universidad Complutense de Madrid',
+           'U-TAD: Centro Universitario de Tecnologia y Arte Digital', 'Universitat de Barcelona', 'Universidad de Las Palmas de Gran Canaria']
+DEGREES = ['computer science', 'data science', 'software engineering', 'computer engineering', 'information systems']
+TOPICS = ['backend systems', 'Big Data', 'Artificial Intelligence', 'cloud infrastructure', 'machine learning', 'web technologies', 'DevOps']
+
+
+def address(rng: random.Random) -> tuple[str, dict]:
+    city, lon, lat, postcode = rng.choice(CITIES)
+    text = f'{rng.choice(STREETS)}, {rng.randint(1, 300)}, {postcode}{rng.randint(0, 99):02d} {city}, España'
+    point = {'type': 'Point', 'coordinates': [round(lon + rng.uniform(-0.1, 0.1), 6), round(lat + rng.uniform(-0.1, 0.1), 6)]}
+    return text, point
+
+
+def generate(seed: int, people: int, chunk: int):
+    """
+    Yields (model name, documents) chunks: the companies and centres first,
+    then people referencing them, never holding more than a chunk in memory.
+    """
+    rng = random.Random(seed)
+    companies, centres = [], []
+    for i in range(max(len(COMPANIES), people // 1000)):
+        text, point = address(rng)
+        name = COMPANIES[i] if i < len(COMPANIES) else f'Company {i}'
+        companies.append({'_id': ObjectId(), 'name': name, 'cif': f'B{i:08d}', 'website': f'company{i}.es', 'address': text, 'address_loc': point})
+    for i in range(max(len(CENTRES), people // 2000)):
+        text, point = address(rng)
+        name = CENTRES[i] if i < len(CENTRES) else f'Centro Universitario {i}'
+        centres.append({'_id': ObjectId(), 'name': name, 'website': f'centre{i}.es', 'year_founded': rng.randint(1300, 2015), 'address': text, 'address_loc': point})
+    yield 'Company', companies
+    yield 'EducationalCentre', centres
+
+    for start in range(0, people, chunk):
+        batch = []
+        for i in range(start, min(start + chunk, people)):
+            text, point = address(rng)
+            batch.append({
+                'name': f'person{i}',
+                'email': f'person{i}@email.com',
+                'description': f'Engineer interested in {rng.choice(TOPICS)} and {rng.choice(TOPICS)}.',
+                'address': text,
+                'address_loc': point,
+                'company': rng.choice(companies)['_id'],
+                'education': [
+                    {'name': rng.choice(DEGREES), 'year_graduated': rng.randint(2000, 2026), 'education_centre': rng.choice(centres)['_id']}
+                    for _ in range(rng.choice((1, 1, 2, 2, 3)))
+                ],
+            })
+        yield 'Person', batch
+
+
+class Benchmark:
+    def __init__(self):
+        self.results: dict[str, dict] = {}
+
+    def run(self, name: str, fn, operations: int = 1) -> None:
+        start = time.perf_counter()
+        result = fn()
+        seconds = time.perf_counter() - start
+        operations = result if isinstance(result, int) else operations
+        self.results[name] = {'seconds': seconds, 'operations': operations, 'ops_per_second': operations / seconds if seconds else None}
+        print(f'{name:<20} {seconds:10.3f} s {operations:>10} ops {operations / seconds if seconds else 0:12.1f} ops/s')
+
+
+def git_commit() -> str | None:
+    try: return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError): return None
+
+
+def compare(results: dict, baseline_path: str) -> None:
+    with open(baseline_path) as baseline_file:
+        baseline = json.load(baseline_file)
+    print(f'\ncompared with {baseline_path} ({baseline.get("commit")})')
+    for name, result in results['results'].items():
+        before = baseline['results'].get(name)
+        if before:
+            change = (result['seconds'] - before['seconds']) / before['seconds'] * 100 if before['seconds'] else 0
+            print(f'{name:<20} {before["seconds"]:10.3f} s -> {result["seconds"]:10.3f} s {change:+8.1f}%')
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--people', type=int, default=10_000)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--chunk', type=int, default=10_000, help='documents generated and bulk saved at a time')
+    parser.add_argument('--samples', type=int, default=1_000, help='lookups and updates per scenario')
+    parser.add_argument('--uri', default='mongodb://localhost:27017/')
+    parser.add_argument('--db', default='abd_bench')
+    parser.add_argument('--output', default='benchmark_results.json')
+    parser.add_argument('--compare', help='previous results file to compare with')
+    args = parser.parse_args()
+
+    ODM.verbose = False
+    ODM.getClient(args.uri).drop_database(args.db)
+    models = {}
+    initApp(definitions_path='./models.yml', mongodb_uri=args.uri, db_name=args.db, scope=models)
+    Person = models['Person']
+    bench = Benchmark()
+
+    def load():
+        loaded = 0
+        for model, documents in generate(args.seed, args.people, args.chunk):
+            models[model].insert_many(documents, batch_size=args.chunk)
+            loaded += len(documents)
+        return loaded
+    bench.run('bulk_load', load)
+
+    rng = random.Random(args.seed)
+    ids = [doc['_id'] for doc in Person._db.aggregate([{'$sample': {'size': args.samples}}, {'$project': {'_id': 1}}])]
+    Person._identity_map.clear()
+    bench.run('find_by_id_cold', lambda: sum(Person.find_by_id(id) is not None for id in ids))
+    bench.run('find_by_id_warm', lambda: sum(Person.find_by_id(id) is not None for id in ids))
+
+    bench.run('scan', lambda: sum(1 for _ in Person.find({}, batch_size=1000)))
+    bench.run('scan_raw', lambda: sum(1 for person in Person.find({}, batch_size=1000, raw=True) if person.name))
+    bench.run('scan_batches', lambda: sum(len(batch) for batch in Person.find({}, batch_size=1000).iter_batches()))
+    bench.run('scan_fields', lambda: sum(1 for person in Person.find({}, batch_size=1000, fields=['name']) if person.name))
+    bench.run('scan_parallel', lambda: sum(1 for _ in Person.find({}, batch_size=1000).parallel(4)))
+    bench.run('scan_prefetch', lambda: sum(person.ref('company') is not None
+                                           for person in Person.find({}, batch_size=1000).prefetch('company', 'education.education_centre')))
+
+    def paginate():
+        pages, token = 0, None
+        while pages == 0 or token is not None:
+            _, token = Person.find({}).paginate(sort=[('name', 1)], page_size=1000, after=token)
+            pages += 1
+        return pages
+    bench.run('paginate', paginate)
+
+    people = list(Person.find({'_id': {'$in': ids}}))
+    def update():
+        for person in people:
+            person.description = f'Engineer interested in {rng.choice(TOPICS)}.'
+            person.save()
+        return len(people)
+    bench.run('update_save', update)
+
+    bench.run('search', lambda: len(Person.search('Big Data Artificial Intelligence', limit=100)))
+
+    for exercise, (model, description, pipeline) in PIPELINES.items():
+        bench.run(f'exercise_{exercise}', lambda: sum(1 for _ in models[model].aggregate(pipeline)))
+        if exercise != 4: # $out, rewriting it would only time the same write again
+            bench.run(f'exercise_{exercise}_optimized', lambda: sum(1 for _ in models[model].aggregate(pipeline, optimize=True)))
+
+    company_ids = [company['_id'] for company in models['Company']._db.find({}, {'_id': 1})]
+    bench.run('view_read', lambda: sum(Person.view('studies_per_company', id) is not None for id in company_ids))
+    bench.run('rebuild_views', lambda: Person.rebuild_views() or len(Person._views))
+    bench.run('delete_company', lambda: models['Company'].delete_many({'name': 'Custom Solutions SA'}))
+
+    results = {
+        'commit': git_commit(),
+        'date': datetime.now(timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'people': args.people,
+        'seed': args.seed,
+        'results': bench.results,
+    }
+    with open(args.output, 'w') as output_file:
+        json.dump(results, output_file, indent=4)
+    print(f'\nresults written to {args.output}')
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
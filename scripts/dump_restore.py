@@ -0,0 +1,193 @@
+"""
+Dumps and restores the collections of the models in models.yml, streaming
+documents so memory stays constant whatever the size of the collections.
+
+Every collection is written to <dir>/<Model>/ as part files of --part-size
+documents, newline delimited canonical extended JSON (.ndjson, which keeps
+every BSON type) or concatenated BSON (.bson, like mongodump), optionally
+gzipped, plus a manifest.json listing the finished parts. Collections are
+processed in parallel.
+
+Both commands can be run again after an interruption and continue where they
+stopped: dump from the last _id of the last finished part, restore from the
+first part not restored yet (documents of a part restored halfway are
+reported as skipped duplicates). The views of the models are rebuilt once
+their collection is restored.
+
+    python -m scripts.dump_restore dump --dir dumps/abd --format bson --compress gzip
+    python -m scripts.dump_restore restore --dir dumps/abd --db abd_copy
+"""
+import argparse, gzip, json, os
+from concurrent.futures import ThreadPoolExecutor
+
+import bson
+from bson import json_util
+from bson.raw_bson import RawBSONDocument
+from bson.codec_options import CodecOptions
+from pymongo.errors import BulkWriteError
+
+import ODM
+from ODM import initApp
+
+EXTENSIONS = {'ndjson': '.ndjson', 'bson': '.bson'}
+
+
+def open_part(path: str, mode: str, compress: str):
+    return gzip.open(path, mode) if compress == 'gzip' else open(path, mode)
+
+
+def read_manifest(path: str) -> dict | None:
+    try:
+        with open(path) as manifest_file:
+            return json.load(manifest_file)
+    except FileNotFoundError:
+        return None
+
+
+def write_json(path: str, data: dict) -> None:
+    # written aside and renamed, so an interruption never leaves half a file
+    with open(f'{path}.tmp', 'w') as tmp_file:
+        json.dump(data, tmp_file, indent=4)
+    os.replace(f'{path}.tmp', path)
+
+
+def dump_collection(model, directory: str, format: str, compress: str, part_size: int) -> int:
+    """
+    Writes the documents of model in _id order as part files. Returns the
+    number of documents dumped by this call.
+    """
+    os.makedirs(directory, exist_ok=True)
+    manifest_path = os.path.join(directory, 'manifest.json')
+    manifest = read_manifest(manifest_path) or {'format': format, 'compress': compress, 'parts': [], 'complete': False}
+    if manifest['complete']:
+        return 0
+    format, compress = manifest['format'], manifest['compress'] # a resumed dump keeps its format
+    query = {}
+    if manifest['parts']:
+        query = {'_id': {'$gt': json_util.loads(manifest['parts'][-1]['last_id'])}}
+
+    # raw documents: BSON parts are written without decoding them at all
+    collection = model._db.with_options(codec_options=CodecOptions(document_class=RawBSONDocument))
+    extension = EXTENSIONS[format] + ('.gz' if compress == 'gzip' else '')
+    dumped, part, documents, last_id = 0, None, 0, None
+
+    def finish_part():
+        part.close()
+        name = f'part-{len(manifest["parts"]):05d}{extension}'
+        os.replace(os.path.join(directory, 'part.tmp'), os.path.join(directory, name))
+        manifest['parts'].append({'file': name, 'documents': documents, 'last_id': json_util.dumps(last_id, json_options=json_util.CANONICAL_JSON_OPTIONS)})
+        write_json(manifest_path, manifest)
+
+    for doc in collection.find(query).sort('_id', 1):
+        if part is None:
+            part, documents = open_part(os.path.join(directory, 'part.tmp'), 'wb', compress), 0
+        if format == 'bson':
+            part.write(doc.raw)
+        else:
+            part.write(json_util.dumps(bson.decode(doc.raw), json_options=json_util.CANONICAL_JSON_OPTIONS).encode() + b'\n')
+        documents += 1
+        dumped += 1
+        last_id = doc['_id']
+        if documents == part_size:
+            finish_part()
+            part = None
+    if part is not None:
+        finish_part()
+    manifest['complete'] = True
+    write_json(manifest_path, manifest)
+    return dumped
+
+
+def read_part(path: str, format: str, compress: str):
+    with open_part(path, 'rb', compress) as part:
+        if format == 'bson':
+            # raw documents again: they are inserted as they were dumped, without decoding them
+            yield from bson.decode_file_iter(part, CodecOptions(document_class=RawBSONDocument))
+        else:
+            for line in part:
+                if line.strip():
+                    yield json_util.loads(line)
+
+
+def restore_collection(model, directory: str, batch_size: int) -> dict[str, int]:
+    """
+    Inserts the parts of a dump as they are, batch_size documents per
+    unordered insert_many, without building models: nothing is validated or
+    geocoded again, and a document that fails doesn't stop the others.
+    Returns the inserted, skipped (already there) and failed counts.
+    """
+    manifest = read_manifest(os.path.join(directory, 'manifest.json'))
+    if manifest is None:
+        return {'inserted': 0, 'skipped': 0, 'failed': 0}
+    progress_path = os.path.join(directory, 'restored.json')
+    progress = read_manifest(progress_path) or {'parts': []}
+    counts = {'inserted': 0, 'skipped': 0, 'failed': 0}
+
+    def insert(batch):
+        try:
+            counts['inserted'] += len(model._db.insert_many(batch, ordered=False).inserted_ids)
+        except BulkWriteError as e:
+            counts['inserted'] += e.details['nInserted']
+            for error in e.details['writeErrors']:
+                duplicate = error['code'] == 11000
+                counts['skipped' if duplicate else 'failed'] += 1
+                if not duplicate:
+                    print(f'{model.__name__} {batch[error["index"]]["_id"]}: {error["errmsg"]}')
+
+    for part in manifest['parts']:
+        if part['file'] in progress['parts']:
+            continue
+        batch = []
+        for doc in read_part(os.path.join(directory, part['file']), manifest['format'], manifest['compress']):
+            batch.append(doc)
+            if len(batch) == batch_size:
+                insert(batch)
+                batch = []
+        if batch:
+            insert(batch)
+        progress['parts'].append(part['file'])
+        write_json(progress_path, progress)
+    return counts
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('command', choices=['dump', 'restore'])
+    parser.add_argument('--dir', default='dumps', help='directory with one subdirectory per model')
+    parser.add_argument('--models', nargs='*', help='models to process, all by default')
+    parser.add_argument('--definitions', default='./models.yml')
+    parser.add_argument('--uri', default='mongodb://localhost:27017/')
+    parser.add_argument('--db', default='abd')
+    parser.add_argument('--workers', type=int, default=4, help='collections processed at the same time')
+    parser.add_argument('--format', choices=list(EXTENSIONS), default='ndjson', help='dump format')
+    parser.add_argument('--compress', choices=['gzip', 'none'], default='gzip', help='dump compression')
+    parser.add_argument('--part-size', type=int, default=100_000, help='documents per dump part file')
+    parser.add_argument('--batch-size', type=int, default=1000, help='documents per restore insert_many')
+    parser.add_argument('--drop', action='store_true', help='drop the collections before restoring and restore every part again')
+    args = parser.parse_args()
+
+    ODM.verbose = False
+    models = {}
+    initApp(definitions_path=args.definitions, mongodb_uri=args.uri, db_name=args.db, scope=models)
+    names = args.models or list(models)
+
+    def run(name):
+        directory = os.path.join(args.dir, name)
+        if args.command == 'dump':
+            return dump_collection(models[name], directory, args.format, args.compress, args.part_size)
+        if args.drop:
+            models[name]._db.delete_many({}) # keeps the indexes created by initApp
+            if os.path.exists(os.path.join(directory, 'restored.json')):
+                os.remove(os.path.join(directory, 'restored.json'))
+        counts = restore_collection(models[name], directory, args.batch_size)
+        # the views are recomputed from the restored collection, whatever they held before
+        models[name].rebuild_views()
+        return counts
+
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        for name, result in zip(names, executor.map(run, names)):
+            print(f'{args.command} {name} => {result}')
+
+
+if __name__ == '__main__':
+    main()
@@ -3,28 +3,20 @@ from ODM import initApp
 initApp(scope=globals()) 
 
 upm = EducationalCentre(name='Universidad Politecnica de Madrid', website='upm.es', year_founded=1971, address='Av. Complutense, s/n, Moncloa - Aravaca, 28040 Madrid')
-upm.save()
 uam = EducationalCentre(name='Universidad Autónoma de Madrid', website='uam.es', year_founded=1968, address='C. Francisco Tomás y Valiente, 5, Fuencarral-El Pardo, 28049 Madrid') 
-uam.save()
 ucm = EducationalCentre(name='Universidad Complutense de Madrid', website='ucm.es', year_founded=1293, address='Av. Complutense, s/n, Moncloa - Aravaca, 28040 Madrid')
-ucm.save()
 utad = EducationalCentre(name='U-TAD: Centro Universitario de Tecnologia y Arte Digital', website='u-tad.com', year_founded=2011, address='C. Playa de Liencres, 2 bis, 28290 Las Rozas de Madrid, Madrid')
-utad.save()
 ub = EducationalCentre(name='Universitat de Barcelona', website='ub.edu', year_founded=1450, address='Gran Via de les Corts Catalanes, 585, 08007 Barcelona, España')
-ub.save()
 ulpgc = EducationalCentre(name='Universidad de Las Palmas de Gran Canaria', website='ulpgc.es', year_founded=1989, address='Campus Universitario de Tafira, 35017 Las Palmas de Gran Canaria, Islas Canarias, España')
-ulpgc.save()
+# _ids are assigned by save_many, so the people below can reference them
+EducationalCentre.save_many([upm, uam, ucm, utad, ub, ulpgc])
 
 deloitte = Company(name='Deloitte', cif='D45678901', website='deloitte.com/es', address='Torre Picasso Madrid, Madrid 28020 España')
-deloitte.save()
 accenture = Company(name='Accenture', cif='C34567890', website='accenture.com/es', address='P.º de la Castellana, 85, Tetuán, 28046 Madrid')
-accenture.save()
 microsoft = Company(name='Microsoft', cif='B23456789', website='microsoft.com/es-es/')
-microsoft.save()
 google = Company(name='Google', cif='B12345678', website='google.es', address='C. de San Germán, 10, Tetuán, 28020 Madrid')
-google.save()
 startup = Company(name='Custom Solutions SA', cif='C12345678', website='customsolutions.es', address='Avenida de Europa 10, Pozuelo de Alarcón, Madrid, 28223 España')
-startup.save()
+Company.save_many([deloitte, accenture, microsoft, google, startup])
 
 p1 = Person(
     name='alex',
@@ -35,7 +27,6 @@ p1 = Person(
     education=[{'name': 'computer science', 'year_graduated': 2026, 'education_centre': upm._id}]
 ) 
 
-p1.save()
 p2 = Person(
     name='clara', 
     email='clara@email.com', 
@@ -44,7 +35,6 @@ p2 = Person(
     company=microsoft._id,
     education=[ {'name': 'computer science', 'year_graduated': 2020, 'education_centre': uam._id}, {'name': 'data science', 'year_graduated': 2024, 'education_centre': utad._id} ]
 )
-p2.save()
 
 p3 = Person(
     name='lucas',
@@ -54,7 +44,6 @@ p3 = Person(
     company=deloitte._id,
     education=[ {'name': 'computer engineering', 'year_graduated': 2019, 'education_centre': ucm._id} ]
 )
-p3.save()
 
 p4 = Person(
     name='maria',
@@ -64,7 +53,6 @@ p4 = Person(
     company=deloitte._id,
     education=[ {'name': 'data science', 'year_graduated': 2022, 'education_centre': uam._id} ]
 )
-p4.save()
 
 p5 = Person(
     name='javier',
@@ -74,7 +62,6 @@ p5 = Person(
     company=accenture._id,
     education=[ {'name': 'multimedia engineering', 'year_graduated': 2021, 'education_centre': utad._id} ]
 )
-p5.save()
 
 p6 = Person(
     name='sofia',
@@ -87,7 +74,6 @@ p6 = Person(
         {'name': 'information systems', 'year_graduated': 2020, 'education_centre': ucm._id}
     ]
 )
-p6.save()
 
 p7 = Person(
     name='diego',
@@ -97,7 +83,6 @@ p7 = Person(
     company=google._id,
     education=[{'name': 'computer science', 'year_graduated': 2017, 'education_centre': upm._id}]
 )
-p7.save()
 
 p8 = Person(
     name='laura',
@@ -107,7 +92,6 @@ p8 = Person(
     company=startup._id,
     education=[{'name': 'software engineering', 'year_graduated': 2019, 'education_centre': uam._id}]
 )
-p8.save()
 
 p9 = Person(
     name='marc',
@@ -117,7 +101,6 @@ p9 = Person(
     company=startup._id,
     education=[{'name': 'computer science', 'year_graduated': 2026, 'education_centre': ub._id}]
 )
-p9.save()
 
 p10 = Person(
     name='ana',
@@ -127,5 +110,5 @@ p10 = Person(
     company=startup._id,
     education=[{'name': 'data science', 'year_graduated': 2025, 'education_centre': ulpgc._id}]
 )
-p10.save()
 
+Person.save_many([p1, p2, p3, p4, p5, p6, p7, p8, p9, p10])